@@ -0,0 +1,130 @@
+import fcntl
+import hashlib
+import os
+import requests
+from time import time as _time
+
+_CACHE_DIR = '/tmp/jobrunner_blobs'
+# The most the cached files can take up (in bytes)
+_MAX_SIZE = 50 * 1024 * 1024 * 1024
+_CHUNK = 1024 * 1024
+# Request headers passed on to Shock
+_PASS_HEADERS = ['authorization', 'content-type', 'accept']
+
+
+def pass_headers(headers):
+    """
+    Returns the headers of a client request that are sent upstream.
+    """
+    return dict((k, v) for (k, v) in headers.items()
+                if k.lower() in _PASS_HEADERS)
+
+
+class BlobCache(object):
+    """
+    Keeps the files of Shock nodes on local disk so every job on the node
+    downloads the same file from Shock only once.
+
+    Files are stored by their MD5, which Shock keeps for every node, so
+    nodes with the same content share a file.  Each download checks the
+    client can read the node with its own token first.  Only one job
+    fetches a file at a time (the others wait for it under a lock), and
+    the least recently used files are removed when the cache gets too big.
+    Nodes may be private, so the cache is only readable by its user.
+    """
+
+    def __init__(self, cache_dir=_CACHE_DIR, max_size=_MAX_SIZE,
+                 upstream=None, logger=None):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size)
+        self.upstream = upstream
+        self.logger = logger
+        self.session = requests.Session()
+
+    def url(self, path):
+        return '%s/%s' % (self.upstream.rstrip('/'), path.lstrip('/'))
+
+    def node_file(self, node_id, headers):
+        """
+        Look up a node as the client.  Returns the file info (name, size
+        and checksum) and None, or None and the failed response.
+        """
+        resp = self.session.get(self.url('node/%s' % (node_id)),
+                                headers=pass_headers(headers))
+        if resp.status_code != 200:
+            return (None, resp)
+        try:
+            return (resp.json()['data']['file'], None)
+        except (ValueError, KeyError, TypeError):
+            return (None, resp)
+
+    def _path(self, md5):
+        return os.path.join(self.cache_dir, md5)
+
+    def fetch(self, node_id, md5, headers):
+        """
+        Returns the path of the cached file of a node, downloading it if
+        it isn't cached yet.
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        path = self._path(md5)
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(path):
+                # Eviction goes by the modification time
+                now = _time()
+                os.utime(path, (now, now))
+                return path
+            self._download(node_id, md5, headers, path)
+        self.evict(keep=md5)
+        return path
+
+    def _download(self, node_id, md5, headers, path):
+        url = self.url('node/%s?download_raw' % (node_id))
+        tmp = path + '.tmp'
+        digest = hashlib.md5()
+        with self.session.get(url, headers=pass_headers(headers),
+                              stream=True) as resp:
+            resp.raise_for_status()
+            with open(tmp, 'wb') as f:
+                os.chmod(tmp, 0o600)
+                for chunk in resp.iter_content(_CHUNK):
+                    digest.update(chunk)
+                    f.write(chunk)
+        if digest.hexdigest() != md5:
+            os.unlink(tmp)
+            raise IOError("Checksum mismatch for node %s" % (node_id))
+        os.rename(tmp, path)
+        if self.logger is not None:
+            self.logger.log("Cached Shock node %s" % (node_id))
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used files, other than keep, until the cache
+        fits in its size.  Returns the number removed.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if '.' in name:
+                continue
+            try:
+                st = os.stat(self._path(name))
+            except OSError:
+                continue
+            total += st.st_size
+            if name != keep:
+                entries.append((st.st_mtime, st.st_size, name))
+        removed = 0
+        for (_, size, name) in sorted(entries):
+            if total <= self.max_size:
+                break
+            # Jobs still reading a removed file keep their copy
+            try:
+                os.unlink(self._path(name))
+                removed += 1
+            except OSError:
+                pass
+            total -= size
+        return removed
@@ -2,15 +2,28 @@ from clients.CatalogClient import Catalog
 
 
 class CatalogCache(object):
-    def __init__(self, config):
+    def __init__(self, config, shared=None):
         self.catalog_url = config.get('catalog-service-url')
         self.catalog = Catalog(self.catalog_url, token=config['token'])
         self.catadmin = Catalog(self.catalog_url, token=config['admin_token'])
         self.module_cache = dict()
+        self.mount_cache = dict()
+        # Lookups made ahead of time that haven't been used by the job yet
+        self.prefetched = dict()
+        # A node daemon shares recent lookups between its jobs
+        self.shared = shared
+        if shared is not None:
+            self.resource_cache = shared.resources
+        else:
+            self.resource_cache = dict()
 
     def get_volume_mounts(self, module, method, cgroup):
         if self.catadmin is None:
             return None
+        # A batch of subjobs only looks them up once
+        key = (module, method, cgroup)
+        if key in self.mount_cache:
+            return self.mount_cache[key]
         req = {
             'module_name': module,
             'function_name': method,
@@ -18,18 +31,47 @@ class CatalogCache(object):
         }
         resp = self.catadmin.list_volume_mounts(req)
         if len(resp) > 0:
-            return resp[0]['volume_mounts']
+            mounts = resp[0]['volume_mounts']
         else:
-            return []
+            mounts = []
+        self.mount_cache[key] = mounts
+        return mounts
 
-    def get_module_info(self, module, version):
-        # Look up the module info
-        if module not in self.module_cache:
+    def log_exec_stats(self, stats):
+        # Only the catalog admin can log execution stats
+        self.catadmin.log_exec_stats(stats)
+
+    def _lookup(self, module, version):
+        module_info = None
+        if self.shared is not None:
+            module_info = self.shared.get_module(module, version)
+        if module_info is None:
             req = {'module_name': module}
             if version is not None:
                 req['version'] = version
-            # Get the image version from the catalog and cache it
             module_info = self.catalog.get_module_version(req)
+            if self.shared is not None:
+                self.shared.add_module(module, version, module_info)
+        return module_info
+
+    def prefetch_module_info(self, module, version):
+        """
+        Look up a module before the job needs it.  This doesn't count as
+        a use of the module by the job.
+        """
+        if module in self.module_cache:
+            return self.module_cache[module]
+        module_info = self._lookup(module, version)
+        self.prefetched[(module, version)] = module_info
+        return module_info
+
+    def get_module_info(self, module, version):
+        # Look up the module info
+        if module not in self.module_cache:
+            # Get the image version from the catalog and cache it
+            module_info = self.prefetched.pop((module, version), None)
+            if module_info is None:
+                module_info = self._lookup(module, version)
             module_info['cached'] = False
             self.module_cache[module] = module_info
         else:
@@ -38,3 +80,40 @@ class CatalogCache(object):
             module_info['cached'] = True
 
         return module_info
+
+    def _parse_memory(self, value):
+        # Memory requests are in MB unless they have a unit
+        value = value.upper().rstrip('B')
+        scale = {'K': 1.0 / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+        if value[-1] in scale:
+            return int(float(value[:-1]) * scale[value[-1]])
+        return int(float(value))
+
+    def get_resources(self, module, method):
+        """
+        Returns the CPUs and memory (MB) declared for a method in its
+        client group config (e.g. request_cpus=4, request_memory=2000M).
+        """
+        key = '%s.%s' % (module, method)
+        if key in self.resource_cache:
+            return self.resource_cache[key]
+        resources = {'cpus': 0, 'memory': 0}
+        req = {'module_name': module, 'function_name': method}
+        try:
+            resp = self.catalog.list_client_group_configs(req)
+        except Exception:
+            resp = []
+        for config in resp:
+            for item in config.get('client_groups') or []:
+                if '=' not in item:
+                    continue
+                (name, value) = item.split('=', 1)
+                try:
+                    if name.strip() == 'request_cpus':
+                        resources['cpus'] = float(value)
+                    elif name.strip() == 'request_memory':
+                        resources['memory'] = self._parse_memory(value.strip())
+                except ValueError:
+                    continue
+        self.resource_cache[key] = resources
+        return resources
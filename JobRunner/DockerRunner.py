@@ -1,10 +1,17 @@
 import docker
 import os
 import json
-from threading import Thread
+from collections import deque
+from threading import Thread, Lock
 from time import time as _time
 from time import sleep as _sleep
 import sys
+from .usage import Usage, docker_stats_usage
+
+_LIMIT_KEYS = ['cgroup_parent', 'cpu_period', 'cpu_quota', 'mem_limit',
+               'memswap_limit', 'pids_limit']
+# Launches of an image within this many seconds size its warm pool
+_POOL_WINDOW = 60
 
 
 class DockerRunner:
@@ -13,14 +20,37 @@ class DockerRunner:
 
     """
 
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, stats_interval=10, client=None,
+                 images=None, pool_size=0, gc_threshold=None,
+                 image_state=None):
         """
         Inputs: config dictionary, Job ID, and optional logger
         """
-        self.docker = docker.from_env()
+        # A node daemon passes in its Docker client and image cache
+        self.docker = client if client is not None else docker.from_env()
+        self.images = images if images is not None else dict()
+        # Optionally track image use and remove old images when the disk
+        # fills up
+        self.retention = None
+        if gc_threshold:
+            from .ImageRetention import ImageRetention
+            kwargs = {'logger': logger}
+            if image_state:
+                kwargs['state_file'] = image_state
+            self.retention = ImageRetention(self.docker, gc_threshold,
+                                            **kwargs)
         self.logger = logger
         self.containers = []
         self.threads = []
+        self.stats_interval = stats_interval
+        self.usage = dict()
+        # The time of the last log line sent for each job
+        self.offsets = dict()
+        # Pre-created containers (and their slots) for each pool key
+        self.pool_size = pool_size
+        self.pool = dict()
+        self.launches = dict()
+        self.pool_lock = Lock()
 
     def _sort_logs(self, sout, serr):
         """
@@ -40,10 +70,10 @@ class DockerRunner:
                     lines.append({'line': line, 'is_error': 1})
         return lines
 
-    def _shepherd(self, c, job_id, subjob, queues):
-        last = 1
+    def _shepherd(self, c, job_id, subjob, queues, since=1):
+        last = since
         try:
-            while c.status in ['created', 'running']:
+            while True:
                 c.reload()
                 now = int(_time())
                 sout = c.logs(stdout=True, stderr=False, since=last, until=now,
@@ -54,7 +84,11 @@ class DockerRunner:
                 if self.logger is not None:
                     self.logger.log_lines(lines)
                 last = now
+                self.offsets[job_id] = last
+                if c.status not in ['created', 'running']:
+                    break
                 _sleep(1)
+            self.usage[job_id].finish()
             c.remove()
             self.containers.remove(c)
             for q in queues:
@@ -62,7 +96,28 @@ class DockerRunner:
         except:
             self.logger.error("Unexpected failure")
 
+    def _sample(self, c, usage):
+        # Docker stats blocks for a moment to compute CPU deltas, so this
+        # runs in its own thread instead of in the shepherd.
+        while usage.end is None:
+            try:
+                usage.update(**docker_stats_usage(c.stats(stream=False)))
+            except Exception:
+                break
+            _sleep(self.stats_interval)
+
     def get_image(self, image):
+        if self.retention is not None:
+            # Mark it as used first so it can't be collected under us
+            self.retention.touch(image)
+        if image in self.images:
+            # The image may have been removed since, e.g. by another
+            # runner's GC, so check it is still there
+            try:
+                self.docker.images.get(self.images[image])
+                return self.images[image]
+            except docker.errors.ImageNotFound:
+                del self.images[image]
         # Pull the image from the hub if we don't have it
         pulled = False
         for im in self.docker.images.list():
@@ -72,33 +127,128 @@ class DockerRunner:
                 break
 
         if not pulled:
+            if self.retention is not None:
+                self.retention.collect()
             self.logger.log("Pulling image {}".format(image))
             id = self.docker.images.pull(image).id
+        if self.retention is not None:
+            self.retention.touch(image, id)
+        self.images[image] = id
         return id
 
-    def run(self, job_id, image, env, vols, labels, subjob, queues):
-        c = self.docker.containers.run(image, 'async',
-                                       environment=env,
-                                       detach=True,
-                                       labels=labels,
-                                       volumes=vols)
+    def create(self, image, env, vols, labels, resources=None):
+        """
+        Create a container without starting it.
+        """
+        # resources holds the cgroup_parent, cpu, memory and pids limits
+        limits = dict()
+        for key in _LIMIT_KEYS:
+            if resources is not None and resources.get(key) is not None:
+                limits[key] = resources[key]
+        return self.docker.containers.create(image, 'async',
+                                             environment=env,
+                                             labels=labels,
+                                             volumes=vols,
+                                             **limits)
+
+    def run(self, job_id, image, env, vols, labels, subjob, queues,
+            resources=None):
+        c = self.create(image, env, vols, labels, resources=resources)
+        return self.start(c, job_id, subjob, queues)
+
+    def start(self, c, job_id, subjob, queues):
+        """
+        Start a created container and watch it.
+        """
+        c.start()
+        return self.attach(c, job_id, subjob, queues)
+
+    def attach(self, c, job_id, subjob, queues, since=1):
+        """
+        Watch a started container, sending its logs from the since time.
+        """
         self.containers.append(c)
+        self.usage[job_id] = Usage()
         # Start a thread to monitor output and handle finished containers
-        t = Thread(target=self._shepherd, args=[c, job_id, subjob, queues])
+        t = Thread(target=self._shepherd,
+                   args=[c, job_id, subjob, queues, since])
         self.threads.append(t)
         t.start()
+        if self.stats_interval:
+            t = Thread(target=self._sample, args=[c, self.usage[job_id]],
+                       daemon=True)
+            t.start()
         return c
 
-    def remove(self, c):
-        try:
-            c.kill()
-        except:
-            pass
+    def take_warm(self, key, image):
+        """
+        Returns a pre-created container and its slot for the pool key, or
+        (None, None).  This counts as a launch of the image.
+        """
+        now = _time()
+        with self.pool_lock:
+            launches = self.launches.setdefault(image, deque())
+            launches.append(now)
+            while launches[0] < now - _POOL_WINDOW:
+                launches.popleft()
+            warm = self.pool.get(key)
+            if warm:
+                return warm.pop(0)
+        return (None, None)
+
+    def pool_wanted(self, key, image):
+        """
+        The number of containers to add to a pool.  Each image gets as many
+        as it was launched in the last minute, up to the pool size.
+        """
+        with self.pool_lock:
+            target = min(self.pool_size, len(self.launches.get(image, [])))
+            return max(0, target - len(self.pool.get(key, [])))
+
+    def add_warm(self, key, c, slot):
+        with self.pool_lock:
+            self.pool.setdefault(key, []).append((c, slot))
+
+    def drain_pool(self):
+        """
+        Empty the pool.  Returns the unused containers and their slots,
+        which the caller has to remove.
+        """
+        with self.pool_lock:
+            warm = [w for items in self.pool.values() for w in items]
+            self.pool = dict()
+        return warm
 
+    def find(self, job_id):
+        """
+        Returns the containers on the node for a job and its subjobs by
+        container id.
+        """
+        found = dict()
+        for c in self.docker.containers.list(all=True,
+                                             filters={'label': 'job_id'}):
+            owner = c.labels.get('parent_job_id') or c.labels.get('job_id')
+            if owner == job_id:
+                found[c.id] = c
+        return found
+
+    def remove(self, c, grace=10):
+        """
+        Stop a container (SIGTERM, then SIGKILL after grace seconds) and
+        remove it.  Returns False if it was already gone.
+        """
         try:
-            c.remove()
-        except:
+            c.stop(timeout=grace)
+        except docker.errors.NotFound:
+            return False
+        except docker.errors.APIError:
+            # e.g. it was never started
             pass
+        try:
+            c.remove(force=True)
+        except docker.errors.NotFound:
+            return False
+        return True
 
     # def cleanup_all(self):
     #     for c in self.containers:
@@ -0,0 +1,134 @@
+import fcntl
+import json
+import os
+import shutil
+from time import time as _time
+
+# Shared by every job runner on the node
+_STATE_FILE = '/tmp/jobrunner_images.json'
+# Images used more recently than this (in seconds) are never removed
+_MIN_AGE = 3600
+# How often (in seconds) one runner records the use of the same image
+_TOUCH_INTERVAL = 60
+
+
+class ImageRetention(object):
+    """
+    Tracks when each image was last used on the node and removes the
+    least recently used ones when the disk gets too full.
+
+    The last use times are kept in a JSON file that is locked while it
+    is updated, so all of the job runners on a node share it.  Only
+    images that were pulled for jobs are tracked and removed.
+    """
+
+    def __init__(self, client, threshold, state_file=_STATE_FILE,
+                 root=None, min_age=_MIN_AGE, logger=None):
+        self.docker = client
+        self.threshold = float(threshold)
+        self.state_file = state_file
+        self.root = root
+        self.min_age = min_age
+        self.logger = logger
+        self.touched = dict()
+
+    def _update(self, func):
+        # Run func on the state with the state file locked and save it
+        with open(self.state_file + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.state_file) as f:
+                    state = json.load(f)
+            except (IOError, OSError, ValueError):
+                state = {'images': {}}
+            result = func(state)
+            tmp = self.state_file + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp, self.state_file)
+        return result
+
+    def touch(self, image, image_id=None):
+        """
+        Record a use of an image.  The id is kept from an earlier use if
+        it isn't known yet.
+        """
+        now = _time()
+        if image_id is None and \
+                now - self.touched.get(image, 0) < _TOUCH_INTERVAL:
+            return
+        self.touched[image] = now
+
+        def _touch(state):
+            entry = state['images'].setdefault(image, {'id': None})
+            entry['last_used'] = now
+            if image_id is not None:
+                entry['id'] = image_id
+
+        self._update(_touch)
+
+    def disk_usage(self):
+        """
+        Returns the used and total bytes of the Docker data disk.
+        """
+        if self.root is None:
+            self.root = self.docker.info().get('DockerRootDir',
+                                               '/var/lib/docker')
+        du = shutil.disk_usage(self.root)
+        return (du.used, du.total)
+
+    def _unique_sizes(self):
+        # Removing an image only frees the layers no other image uses
+        sizes = dict()
+        try:
+            images = self.docker.df().get('Images') or []
+        except Exception:
+            return sizes
+        for im in images:
+            shared = max(im.get('SharedSize', 0), 0)
+            sizes[im['Id']] = max(im.get('Size', 0) - shared, 0)
+        return sizes
+
+    def collect(self):
+        """
+        Remove least recently used images that aren't in use until the
+        disk is below the threshold (a fraction of the disk).  Returns
+        the removed images.
+        """
+        (used, total) = self.disk_usage()
+        need = used - int(self.threshold * total)
+        if need <= 0:
+            return []
+        in_use = set()
+        for c in self.docker.containers.list(all=True):
+            in_use.add(c.attrs.get('Image'))
+        sizes = self._unique_sizes()
+        now = _time()
+
+        def _collect(state):
+            removed = []
+            left = need
+            order = sorted(state['images'].items(),
+                           key=lambda item: item[1].get('last_used', 0))
+            for (image, entry) in order:
+                if left <= 0:
+                    break
+                if now - entry.get('last_used', 0) < self.min_age or \
+                        entry.get('id') in in_use:
+                    continue
+                try:
+                    self.docker.images.remove(image)
+                except Exception as e:
+                    if 'not found' not in str(e).lower():
+                        # Probably in use by a container that just started
+                        continue
+                del state['images'][image]
+                removed.append(image)
+                left -= sizes.get(entry.get('id'), 0)
+            return removed
+
+        removed = self._update(_collect)
+        if self.logger is not None and len(removed) > 0:
+            self.logger.log("Removed unused images: %s" % (
+                            ', '.join(removed)))
+        return removed
@@ -0,0 +1,169 @@
+import json
+import os
+import socket
+import sys
+from copy import deepcopy
+from threading import Thread, Lock
+from .JobRunner import JobRunner
+from .shared import SharedResources
+
+
+def _send(conn, msg):
+    conn.sendall(json.dumps(msg).encode('utf-8') + b'\n')
+
+
+def _recv(conn):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = conn.recv(65536)
+        if not chunk:
+            return None
+        data += chunk
+    return json.loads(data.decode('utf-8'))
+
+
+def submit_job(path, job_id, njs_url, token, admin_token, config):
+    """
+    Hand a job to the node daemon listening on path and wait for it to
+    finish.  Returns the daemon's response, which has the job output as
+    result, or an exit_code and error.  Raises OSError if there is no
+    daemon to connect to.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(path)
+    try:
+        _send(conn, {
+            'job_id': job_id,
+            'njs_url': njs_url,
+            'token': token,
+            'admin_token': admin_token,
+            'config': config
+        })
+        resp = _recv(conn)
+    except (OSError, ValueError):
+        # The job may have started, so it can't be run anywhere else
+        resp = None
+    finally:
+        conn.close()
+    if resp is None:
+        return {'error': 'The job daemon went away', 'exit_code': 2}
+    return resp
+
+
+class JobDaemon(object):
+    """
+    A long-lived node daemon that runs jobs handed to it over a unix
+    socket.
+
+    Each job gets its own JobRunner in a thread, so job state is kept
+    apart, but the Docker client, auth token cache, service clients and
+    catalog and image caches are shared.  Clients wait on the connection
+    until their job finishes, and closing it cancels the job.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.shared = SharedResources()
+        self.jobs = dict()
+        self.lock = Lock()
+        self.sock = None
+
+    def _watch_client(self, conn, jr):
+        # The client only closes the connection if it was killed
+        try:
+            while conn.recv(1024):
+                pass
+        except OSError:
+            pass
+        if jr.job_id in self.jobs:
+            jr.shutdown(None, None)
+
+    def _run_job(self, conn, req):
+        config = deepcopy(req.get('config') or {})
+        config['client_pid'] = req.get('client_pid')
+        # The callback server app is global state, so each job's server
+        # has to run in its own process.
+        config['callback_server'] = 'process'
+        job_id = req['job_id']
+        jr = None
+        try:
+            jr = JobRunner(config, req['njs_url'], job_id, req['token'],
+                           req['admin_token'], shared=self.shared)
+            with self.lock:
+                self.jobs[job_id] = jr
+            Thread(target=self._watch_client, args=[conn, jr],
+                   daemon=True).start()
+            resp = {'result': jr.run()}
+        except SystemExit as e:
+            # run() exits if the job was already run or canceled
+            resp = {'exit_code': e.code}
+        except Exception as e:
+            resp = {'error': str(e), 'exit_code': 2}
+        finally:
+            with self.lock:
+                self.jobs.pop(job_id, None)
+            if jr is not None:
+                jr.cbs.kill()
+        try:
+            _send(conn, resp)
+        except OSError:
+            pass
+        conn.close()
+
+    def _handle(self, conn):
+        try:
+            req = _recv(conn)
+        except (OSError, ValueError):
+            req = None
+        if req is None or 'job_id' not in req:
+            conn.close()
+            return
+        # Unix sockets tell us who is on the other end
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                12)
+        req['client_pid'] = int.from_bytes(creds[:4], sys.byteorder)
+        self._run_job(conn, req)
+
+    def start(self):
+        """
+        Listen on the socket.  Only the daemon's user can connect.
+        """
+        # Sanic is loaded once here instead of in every callback server
+        from . import callback_server  # noqa: F401
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old = os.umask(0o177)
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(old)
+        self.sock.listen(64)
+
+    def serve(self):
+        """
+        Accept jobs until stop is called.
+        """
+        while True:
+            try:
+                (conn, _) = self.sock.accept()
+            except OSError:
+                break
+            Thread(target=self._handle, args=[conn], daemon=True).start()
+
+    def stop(self):
+        """
+        Stop accepting jobs and cancel the running ones.
+        """
+        if self.sock is not None:
+            try:
+                # This wakes up a thread blocked in accept
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+        with self.lock:
+            for jr in self.jobs.values():
+                jr.shutdown(None, None)
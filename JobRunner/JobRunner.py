@@ -4,16 +4,40 @@ from .logger import Logger
 from clients.NarrativeJobServiceClient import NarrativeJobService as NJS
 from clients.authclient import KBaseAuth
 from .MethodRunner import MethodRunner
-from .callback_server import start_callback_server
 import json
 from socket import gethostname
-from threading import Thread
+from threading import Thread, current_thread, main_thread
 from multiprocessing import process, Process, Queue
 from .provenance import Provenance
+from .SubjobScheduler import SubjobScheduler
+from .cgroups import get_limits
+from .ipc import Channel
+from .reaper import hold_lock, release_lock, reap_orphans
+from .jobstate import state_path, save_state, load_state
+from .output import scan_output
 from queue import Empty
+from queue import Queue as ThreadQueue
 import socket
 import signal
-from .CatalogCache import CatalogCache
+from time import time as _time
+
+_CPU_PERIOD = 100000
+# Subjob outputs larger than this (in bytes) are passed to the callback
+# server by reference.  By default all of them are.
+_INLINE_OUTPUT_SIZE = 0
+# Keys the callback server adds to an output it streams
+_STREAM_KEYS = {'finished', 'resource_usage'}
+# How often (in seconds) a resumable job saves its state, and how long
+# the containers of a runner that died are kept for a new one to resume
+_STATE_INTERVAL = 10
+_RESUME_GRACE = 600
+
+
+def _start_callback_server(*args):
+    # Sanic is only needed by the callback server, so import it in the
+    # child process instead of paying for it on every job start.
+    from .callback_server import start_callback_server
+    start_callback_server(*args)
 
 
 class JobRunner(object):
@@ -23,27 +47,123 @@ class JobRunner(object):
     to support subjobs and provenenace calls.
     """
 
-    def __init__(self, config, njs_url, job_id, token, admin_token):
+    def __init__(self, config, njs_url, job_id, token, admin_token,
+                 shared=None):
         """
-        inputs: config dictionary, NJS URL, Job id, Token, Admin Token
+        inputs: config dictionary, NJS URL, Job id, Token, Admin Token and
+        optional SharedResources from a node daemon
         """
-        self.njs = NJS(url=njs_url)
+        self.shared = shared
+        if shared is not None:
+            self.njs = shared.get_njs(njs_url)
+        else:
+            self.njs = NJS(url=njs_url)
         self.logger = Logger(njs_url, job_id, njs=self.njs)
         self.token = token
+        # The callback server can run in its own process (the default) or
+        # in a thread of this one, where it shares the job's state.
+        self.in_process = config.get('callback_server') == 'thread'
+        if self.in_process:
+            self.jr_queue = ThreadQueue()
+            self.callback_queue = None
+        elif config.get('ipc') == 'channel':
+            # The shared memory channel is opt-in
+            self.jr_queue = Channel()
+            self.callback_queue = Channel()
+        else:
+            self.jr_queue = Queue()
+            self.callback_queue = Queue()
+        # A resumable job saves its state in the work directory so a new
+        # runner can pick up its containers if this one dies
+        self.resume = bool(config.get('resume')) and \
+            config.get('runtime', 'docker') == 'docker'
+        self.resume_grace = int(config.get('resume_grace', _RESUME_GRACE))
+        self.state_file = state_path(config.get('workdir', '/mnt/awe/condor'))
+        self.resume_state = None
+        if self.resume:
+            self.resume_state = load_state(self.state_file, job_id)
+        self.registry = dict()
+        # Containers can download Shock files through a node-wide cache in
+        # the callback server
+        self.blob_options = None
+        if config.get('shock_cache_dir'):
+            self.blob_options = {'cache_dir': config['shock_cache_dir']}
+            if config.get('shock_cache_size'):
+                self.blob_options['max_size'] = config['shock_cache_size']
+        # Start the callback server first so that importing Sanic and
+        # binding the socket overlap with the rest of the job setup.
+        port = 0
+        if self.resume_state is not None:
+            # The containers being resumed still call back to the old port
+            port = self.resume_state.get('port', 0)
+        self._init_callback_url(port)
+        self._start_callback_server()
         self.client_group = os.environ.get("AWE_CLIENTGROUP", "None")
         self.admin_token = admin_token
         self.config = self._init_config(config, job_id, njs_url)
         self.hostname = gethostname()
-        self.auth = KBaseAuth(config.get('auth-service-url'))
+        if shared is not None:
+            self.auth = shared.get_auth(config.get('auth-service-url'))
+        else:
+            self.auth = KBaseAuth(config.get('auth-service-url'))
         self.job_id = job_id
         self.workdir = config.get('workdir', '/mnt/awe/condor')
-        self.jr_queue = Queue()
-        self.callback_queue = Queue()
         self.prov = None
-        self._init_callback_url()
-        self.mr = MethodRunner(self.config, job_id, logger=self.logger)
-        self.cc = CatalogCache(config)
-        signal.signal(signal.SIGINT, self.shutdown)
+        # The slot's own limits are the default budget for subjobs
+        self.slot_limits = get_limits(self.config['cgroup'])
+        slot_memory = (self.slot_limits['memory'] or 0) // (1024 * 1024)
+        self.scheduler = SubjobScheduler(
+            max_jobs=int(config.get('max_subjobs', 0)),
+            max_cpus=float(config.get('max_subjob_cpus',
+                                      self.slot_limits['cpus'] or 0)),
+            max_memory=int(config.get('max_subjob_memory', slot_memory)),
+            root=job_id)
+        self.mr = MethodRunner(self.config, job_id, logger=self.logger,
+                               shared=shared)
+        # Holding this lock tells reapers on the node that the job's
+        # containers still have a runner
+        self.lock = None
+        self.lock_dir = config.get('lock_dir')
+        if config.get('runtime', 'docker') == 'docker':
+            try:
+                self.lock = self._hold_lock()
+            except BlockingIOError:
+                self.logger.error("Another runner has this job's lock")
+        self._cc = None
+        # Submit times and catalog info for the exec stats of each job
+        self.created = dict()
+        self.job_info = dict()
+        self.inline_output_size = int(config.get('inline_output_size',
+                                                 _INLINE_OUTPUT_SIZE))
+        # Subjobs of the listed modules can be answered from a node-wide
+        # cache of their outputs
+        self.result_cache = None
+        if config.get('result_cache_modules'):
+            from .ResultCache import ResultCache
+            kwargs = {'logger': self.logger}
+            if config.get('result_cache_dir'):
+                kwargs['cache_dir'] = config['result_cache_dir']
+            if config.get('result_cache_size'):
+                kwargs['max_size'] = config['result_cache_size']
+            self.result_cache = ResultCache(config['result_cache_modules'],
+                                            **kwargs)
+        self.cache_keys = dict()
+        self.cached = dict()
+        # Identical subjobs of these modules submitted while one is running
+        # share its output instead of starting their own container
+        modules = config.get('single_flight_modules') or ''
+        if isinstance(modules, str):
+            modules = modules.split(',')
+        self.single_flight = set(m.strip() for m in modules if m.strip())
+        self.inflight = dict()
+        self.flight_keys = dict()
+        self.followers = dict()
+        # Subjobs from a map submission after the first
+        self.batched = set()
+        # Signals can only be handled in the main thread.  A daemon
+        # cancels its jobs itself.
+        if current_thread() is main_thread():
+            signal.signal(signal.SIGINT, self.shutdown)
 
     def _init_config(self, config, job_id, njs_url):
         """
@@ -52,12 +172,24 @@ class JobRunner(object):
         config['hostname'] = gethostname()
         config['job_id'] = job_id
         config['njs_url'] = njs_url
-        config['cgroup'] = self._get_cgroup()
+        # A daemon runs the job in the cgroup of the client that sent it
+        config['cgroup'] = self._get_cgroup(config.get('client_pid'))
         token = self.token
         config['token'] = token
         config['admin_token'] = self.admin_token
         return config
 
+    @property
+    def cc(self):
+        """
+        The catalog cache is created on first use since the catalog
+        client is large and isn't needed by jobs that fail early.
+        """
+        if self._cc is None:
+            from .CatalogCache import CatalogCache
+            self._cc = CatalogCache(self.config, shared=self.shared)
+        return self._cc
+
     def _check_job_status(self):
         """
         returns True if the job is still okay to run.
@@ -77,19 +209,54 @@ class JobRunner(object):
             self.logger.error("Missing workdir")
             raise OSError("Missing Working Directory")
 
-    def _get_cgroup(self):
-        pid = os.getpid()
+    def _get_cgroup(self, pid=None):
+        if pid is None:
+            pid = os.getpid()
         cfile = "/proc/%d/cgroup" % (pid)
         if not os.path.exists(cfile):
             return None
         with open(cfile) as f:
             for line in f:
                 if line.find('htcondor') > 0:
-                    items = line.split(':')
+                    items = line.rstrip('\n').split(':')
                     if len(items) == 3:
                         return items[2]
         return "Unknown"
 
+    def _get_container_limits(self, module, method):
+        """
+        Size a container from the slot's cgroup.  Each container gets an
+        equal share of the slot (one share for the main job and one per
+        concurrent subjob), or what it declares in the catalog if that is
+        more.  With 'cgroup_parent' set containers are also placed under
+        the slot cgroup.  That is opt-in since the slot's path isn't a
+        valid parent under Docker's systemd cgroup driver.
+        """
+        cgroup = self.config['cgroup']
+        limits = {}
+        if cgroup is not None and cgroup != 'Unknown' and \
+                self.config.get('cgroup_parent'):
+            limits['cgroup_parent'] = cgroup
+        if self.config.get('container_pids_limit'):
+            limits['pids_limit'] = int(self.config['container_pids_limit'])
+        slot = self.slot_limits
+        if slot['cpus'] is None and slot['memory'] is None:
+            return limits
+        shares = self.scheduler.max_jobs + 1 if self.scheduler.max_jobs else 1
+        declared = self.cc.get_resources(module, method)
+        if slot['cpus'] is not None:
+            cpus = max(slot['cpus'] / shares, declared['cpus'])
+            cpus = min(cpus, slot['cpus'])
+            limits['cpu_period'] = _CPU_PERIOD
+            limits['cpu_quota'] = int(cpus * _CPU_PERIOD)
+        if slot['memory'] is not None:
+            memory = max(slot['memory'] // shares,
+                         declared['memory'] * 1024 * 1024)
+            memory = min(memory, slot['memory'])
+            limits['mem_limit'] = memory
+            limits['memswap_limit'] = memory
+        return limits
+
     def _submit(self, config, job_id, data, subjob=True):
         (module, method) = data['method'].split('.')
         version = data.get('service_ver')
@@ -100,6 +267,9 @@ class JobRunner(object):
         if not module_info['cached']:
             fstr = 'Running module {}: url: {} commit: {}'
             self.logger.log(fstr.format(module, git_url, git_commit))
+        elif job_id in self.batched:
+            # The rest of a batch use the module the first one looked up
+            self.batched.discard(job_id)
         else:
             version = module_info['version']
             f = 'WARNING: Module {} was already used once for this job. '
@@ -107,14 +277,232 @@ class JobRunner(object):
             f += 'commit: {} version: {} release: release'
             self.logger.error(f.format(module, git_url, git_commit, version))
 
+        if subjob and self._check_result_cache(config, job_id, data,
+                                               module_info):
+            return
         vm = self.cc.get_volume_mounts(module, method, self.client_group)
         config['volume_mounts'] = vm
+        config['resources'] = self._get_container_limits(module, method)
+        # Each job gets its own callback path so the server can tell
+        # which job submitted a subjob.
         action = self.mr.run(config, module_info, data, job_id,
-                             callback=self.callback_url, subjob=subjob,
-                             fin_q=self.jr_queue)
+                             callback=self.callback_url + job_id,
+                             subjob=subjob, fin_q=self.jr_queue)
+        c = self.mr.job_containers.get(job_id)
+        entry = self.registry.setdefault(job_id, dict())
+        entry.pop('data', None)
+        entry.update({'status': 'running',
+                      'container': c.id if c is not None else None,
+                      'slot': self.mr.job_slots.get(job_id)})
         self._update_prov(action)
+        self._save_state()
+        if not subjob:
+            # NJS logs the main job's stats when it finishes
+            return
+        app_id = data.get('app_id') or ''
+        self.job_info[job_id] = {
+            'user_id': config.get('user'),
+            'app_module_name': app_id.split('/')[0] if app_id else None,
+            'app_id': app_id.split('/')[-1] if app_id else None,
+            'func_module_name': module,
+            'func_name': method,
+            'git_commit_hash': git_commit,
+            'creation_time': self.created.pop(job_id, _time()),
+            'exec_start_time': _time(),
+            'job_id': job_id
+        }
+
+    def _check_result_cache(self, config, job_id, data, module_info):
+        """
+        Answer a subjob from the result cache if it can be.  Returns True
+        if it was, or remembers the key to cache its output under.
+        """
+        module = data['method'].split('.')[0]
+        if self.result_cache is None or not self.result_cache.allows(module):
+            return False
+        key = self.result_cache.key(module_info['git_commit_hash'],
+                                    data['method'], config.get('user'),
+                                    data.get('params'))
+        # The job gets its own link to the output, which stays even if
+        # another runner evicts it from the cache
+        path = self.result_cache.get(key, os.path.join(
+            self.mr.subjobdir, job_id, 'output.json'))
+        ref = None
+        if path is not None:
+            try:
+                ref = scan_output(path)
+            except (OSError, ValueError) as e:
+                self.logger.log("Ignoring bad cached result: %s" % (e))
+        if ref is None:
+            self.cache_keys[job_id] = key
+            return False
+        self.logger.log('Using cached result for subjob %s' % (job_id))
+        # The module that made the output is still part of the provenance
+        self._update_prov({
+            'name': module,
+            'ver': data.get('service_ver'),
+            'code_url': module_info['git_url'],
+            'commit': module_info['git_commit_hash']
+        })
+        ref['path'] = path
+        self.cached[job_id] = ref
+        self.jr_queue.put(['finished', job_id, None])
+        return True
+
+    def _cache_result(self, job_id, of, is_error):
+        key = self.cache_keys.pop(job_id, None)
+        if key is None or of is None or is_error:
+            return
+        try:
+            self.result_cache.put(key, of)
+        except OSError as e:
+            self.logger.log("Failed to cache result: %s" % (e))
+
+    def _log_exec_stats(self, job_id, is_error):
+        """
+        Report a finished subjob to the catalog.  Returns the job's
+        resource usage.
+        """
+        usage = self.mr.get_usage(job_id)
+        if usage is not None:
+            fstr = 'Resource usage for job {}: {}'
+            self.logger.log(fstr.format(job_id, json.dumps(usage)))
+        stats = self.job_info.pop(job_id, None)
+        if stats is None:
+            return usage
+        stats['finish_time'] = _time()
+        stats['is_error'] = 1 if is_error else 0
+        Thread(target=self._send_exec_stats, args=[stats]).start()
+        return usage
+
+    def _send_output(self, job_id, subjob):
+        """
+        Pass the output of a finished job to the callback server.  Subjob
+        outputs are validated without loading them and only a reference
+        to the file crosses the queue; the callback server streams the
+        file to the client.  Returns the output if it was loaded.
+        """
+        if subjob and job_id in self.cached:
+            # A cache hit ran no container, so there are no stats to report
+            self._post_output('output_file', job_id, self.cached.pop(job_id))
+            return None
+        if subjob:
+            (of, output) = self.mr.check_output(job_id)
+            if of is None:
+                pass
+            elif os.path.getsize(of) > self.inline_output_size:
+                (ref, output) = self.mr.get_output_ref(job_id, path=of)
+                if ref is not None and _STREAM_KEYS.intersection(ref['keys']):
+                    # Splicing the keys in would duplicate them
+                    output = self.mr.get_output(job_id, path=of)
+                elif ref is not None:
+                    is_error = 'error' in ref['keys']
+                    self._cache_result(job_id, of, is_error)
+                    ref['resource_usage'] = self._log_exec_stats(job_id,
+                                                                 is_error)
+                    self._post_output('output_file', job_id, ref)
+                    return None
+            else:
+                output = self.mr.get_output(job_id, path=of)
+        else:
+            output = self.mr.get_output(job_id, subjob=False)
+        if subjob:
+            self._cache_result(job_id, of, 'error' in output)
+        usage = self._log_exec_stats(job_id, 'error' in output)
+        if usage is not None:
+            output['resource_usage'] = usage
+        # Nothing asks the callback server for the main job's output
+        if subjob:
+            self._post_output('output', job_id, output)
+        return output
+
+    def _post_output(self, mtype, job_id, output):
+        # Subjobs that joined this one get the same output
+        key = self.flight_keys.pop(job_id, None)
+        if key is not None:
+            del self.inflight[key]
+        for jid in [job_id] + self.followers.pop(job_id, []):
+            self.callback_queue.put([mtype, jid, output])
+
+    def _send_exec_stats(self, stats):
+        try:
+            self.cc.log_exec_stats(stats)
+        except Exception:
+            err = "Failed to log execution stats for %s" % (stats['job_id'])
+            self.logger.error(err)
+
+    def _join_inflight(self, job_id, data):
+        """
+        Attach a subjob to an identical one that is queued or running, if
+        its module allows it.  Returns True if it was attached.
+        """
+        if data['method'].split('.')[0] not in self.single_flight:
+            return False
+        key = json.dumps([data['method'], data.get('service_ver'),
+                          data.get('params')], sort_keys=True)
+        leader = self.inflight.get(key)
+        if leader is None:
+            self.inflight[key] = job_id
+            self.flight_keys[job_id] = key
+            return False
+        fstr = 'Subjob {} joined identical subjob {}'
+        self.logger.log(fstr.format(job_id, leader))
+        self.followers.setdefault(leader, []).append(job_id)
+        self.registry[job_id] = {'status': 'joined', 'leader': leader}
+        self._save_state()
+        return True
+
+    def _queue_subjob(self, job_id, data):
+        self.created[job_id] = _time()
+        parent = data.get('parent_job_id') or self.job_id
+        # Warm containers call back with their slot instead of a job id
+        parent = self.mr.slot_jobs.get(parent, parent)
+        resources = {}
+        if self.scheduler.max_cpus or self.scheduler.max_memory:
+            (module, method) = data['method'].split('.')
+            resources = self.cc.get_resources(module, method)
+        self.scheduler.add(job_id, parent, data,
+                           cpus=resources.get('cpus', 0),
+                           memory=resources.get('memory', 0))
+        self.registry[job_id] = {'status': 'queued', 'data': data,
+                                 'parent': parent,
+                                 'cpus': resources.get('cpus', 0),
+                                 'memory': resources.get('memory', 0)}
+        self._save_state()
+
+    def _queue_batch(self, config, jobs):
+        """
+        Queue the subjobs of a map submission together.  Returns the
+        number queued.
+        """
+        ct = 0
+        for (job_id, data) in jobs:
+            if self._join_inflight(job_id, data):
+                continue
+            self._queue_subjob(job_id, data)
+            if ct > 0:
+                self.batched.add(job_id)
+            ct += 1
+        self._run_queued(config)
+        fstr = 'Subjob batch of {} queued ({} running)'
+        self.logger.log(fstr.format(len(jobs), len(self.scheduler.running)))
+        return ct
+
+    def _run_queued(self, config):
+        """
+        Start any queued subjobs that fit under the concurrency limits.
+        """
+        while True:
+            item = self.scheduler.next()
+            if item is None:
+                break
+            (job_id, data) = item
+            self._submit(config, job_id, data)
 
     def _cancel(self):
+        dropped = self.scheduler.clear()
+        if len(dropped) > 0:
+            self.logger.log("Dropped %d queued subjobs" % (len(dropped)))
         self.mr.cleanup_all()
 
     def shutdown(self, sig, bt):
@@ -123,30 +511,44 @@ class JobRunner(object):
         # Send a cancel to the queue
         self.jr_queue.put(['cancel', None, None])
 
-    def _watch(self, config):
+    def _watch(self, config, ct=1):
         # Run a thread to check for expired token
         # Run a thread for 7 day max job runtime
         cont = True
-        ct = 1
+        last_check = 0
+        last_save = _time()
         while cont:
             try:
                 req = self.jr_queue.get(timeout=1)
                 if req[0] == 'submit':
-                    # TODO fail if there are too many subjobs already
-                    self._submit(config, req[1], req[2])
-                    ct += 1
+                    if not self._join_inflight(req[1], req[2]):
+                        self._queue_subjob(req[1], req[2])
+                        self._run_queued(config)
+                        if self.scheduler.is_queued(req[1]):
+                            fstr = 'Subjob {} queued ({} running)'
+                            nrun = len(self.scheduler.running)
+                            self.logger.log(fstr.format(req[1], nrun))
+                        ct += 1
+                elif req[0] == 'submit_map':
+                    ct += self._queue_batch(config, req[2])
                 elif req[0] == 'finished':
                     subjob = True
                     job_id = req[1]
                     if job_id == self.job_id:
                         subjob = False
-                    output = self.mr.get_output(job_id, subjob=subjob)
-                    self.callback_queue.put(['output', job_id, output])
+                    else:
+                        self.scheduler.finished(job_id)
+                        self._run_queued(config)
+                    output = self._send_output(job_id, subjob)
+                    if job_id in self.registry:
+                        self.registry[job_id]['status'] = 'finished'
+                        self._save_state()
                     ct -= 1
                     if not subjob:
                         if ct > 0:
-                            err = "Orphaned containers may be present"
+                            err = "Removing subjobs left running"
                             self.logger.error(err)
+                            self.mr.cleanup_all()
                         return output
                 elif req[0] == 'cancel':
                     self._cancel()
@@ -156,13 +558,21 @@ class JobRunner(object):
             if ct == 0:
                 # This shouldn't happen
                 return
-            # Run cancellation / finish job checker
+            # Keep the log offsets up to date for a resume
+            if self.resume and _time() - last_save >= _STATE_INTERVAL:
+                self._save_state()
+                last_save = _time()
+            # Run cancellation / finish job checker.  Messages can arrive
+            # much faster than NJS should be polled.
+            if _time() - last_check < 1:
+                continue
+            last_check = _time()
             if not self._check_job_status():
                 self.logger.error("Job canceled or unexpected error")
                 self._cancel()
                 return {'error': 'Canceled or unexpected error'}
 
-    def _init_callback_url(self):
+    def _init_callback_url(self, port=0):
         # Find a free port and Start up callback server
         if os.environ.get('CALLBACK_IP') is not None:
             self.ip = os.environ.get('CALLBACK_IP')
@@ -172,15 +582,163 @@ class JobRunner(object):
             s.connect(("gmail.com", 80))
             self.ip = s.getsockname()[0]
             s.close()
-        sock = socket.socket()
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind(('', 0))
-        self.port = sock.getsockname()[1]
-        sock.close()
+        # Keep the socket bound and hand it to the callback server so
+        # the port can't be taken before the server is listening.
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.sock.bind((self.ip, port))
+        except OSError:
+            if port == 0:
+                raise
+            err = "Callback port %d is taken, resumed jobs can't call back"
+            self.logger.error(err % (port))
+            self.sock.bind((self.ip, 0))
+        self.port = self.sock.getsockname()[1]
         url = 'http://%s:%s/' % (self.ip, self.port)
         self.logger.log("Job runner recieved Callback URL %s" % (url))
         self.callback_url = url
 
+    def _start_callback_server(self):
+        if self.in_process:
+            from .callback_server import CallbackThread
+            self.cbs = CallbackThread(self.jr_queue, self.token, self.sock,
+                                      blob_options=self.blob_options)
+            self.callback_queue = self.cbs.queue
+            self.cbs.start()
+            return
+        cb_args = [self.ip, self.port, self.jr_queue, self.callback_queue,
+                   self.token, self.sock, self.blob_options]
+        self.cbs = Process(target=_start_callback_server, args=cb_args,
+                           daemon=True)
+        self.cbs.start()
+        # The server process has its own copy of the socket now
+        self.sock.close()
+
+    def _wait_for_callback_server(self, timeout=60):
+        """
+        Block until the callback server reports that it is listening.
+        Containers can't be started before then or their first callback
+        could fail.
+        """
+        deferred = []
+        try:
+            while True:
+                try:
+                    req = self.jr_queue.get(timeout=timeout)
+                except Empty:
+                    self.logger.error("Callback server failed to start")
+                    raise OSError("Callback server failed to start")
+                if req[0] == 'ready':
+                    return True
+                deferred.append(req)
+        finally:
+            # Anything else (e.g. a cancel) is left for _watch
+            for req in deferred:
+                self.jr_queue.put(req)
+
+    def _prefetch(self, cc, params):
+        try:
+            (module, method) = params['method'].split('.')
+            module_info = cc.prefetch_module_info(module,
+                                                  params.get('service_ver'))
+            self.mr.get_image(module_info['docker_img_name'])
+        except Exception as e:
+            # The job will try again and report any error
+            self.logger.log("Image prefetch failed: %s" % (e))
+
+    def _hold_lock(self):
+        # Reapers read how long to keep a resumable job from the lock
+        kwargs = {'grace': self.resume_grace if self.resume else 0}
+        if self.lock_dir is not None:
+            kwargs['lock_dir'] = self.lock_dir
+        return hold_lock(self.job_id, **kwargs)
+
+    def _reap(self):
+        # Clean up after runners on this node that died
+        kwargs = {'logger': self.logger}
+        if self.lock_dir is not None:
+            kwargs['lock_dir'] = self.lock_dir
+        try:
+            reap_orphans(self.mr.runner.docker, **kwargs)
+        except Exception as e:
+            self.logger.log("Orphan cleanup failed: %s" % (e))
+
+    def _save_state(self):
+        """
+        Save the jobs, their containers and log offsets, and the provenance
+        so a new runner can resume the job.
+        """
+        if not self.resume:
+            return
+        offsets = self.mr.runner.offsets
+        for (job_id, entry) in self.registry.items():
+            if job_id in offsets:
+                entry['since'] = offsets[job_id]
+        state = {
+            'job_id': self.job_id,
+            'port': self.port,
+            'jobs': self.registry,
+            'prov': self.prov.prov if self.prov is not None else None
+        }
+        try:
+            save_state(self.state_file, state)
+            # Tells reapers the job can still be resumed
+            if self.lock is not None:
+                os.utime(self.lock.name)
+        except OSError as e:
+            self.logger.error("Failed to save job state: %s" % (e))
+
+    def _clear_state(self):
+        if self.resume and os.path.exists(self.state_file):
+            os.unlink(self.state_file)
+
+    def _resume(self, config, params):
+        """
+        Pick up the job from the state saved by a runner that died.  Live
+        containers are watched again from their log offsets, the outputs of
+        the ones that finished are collected and queued subjobs are queued
+        again.  Returns the number of jobs left to finish.
+        """
+        state = self.resume_state
+        self.logger.log('Resuming job from %s' % (self.state_file))
+        if state.get('prov') is not None:
+            self.prov.restore(state['prov'])
+            self.callback_queue.put(['prov', None, self.prov.get_prov()])
+        running = dict()
+        slots = dict()
+        for (job_id, entry) in state['jobs'].items():
+            self.registry[job_id] = entry
+            if entry.get('slot') is not None:
+                slots[job_id] = entry['slot']
+            if entry['status'] == 'joined':
+                self.followers.setdefault(entry['leader'], []).append(job_id)
+            elif job_id == self.job_id:
+                # A main job that finished is collected again
+                running[job_id] = entry
+            elif entry['status'] == 'running':
+                running[job_id] = entry
+                self.scheduler.started(job_id, entry['parent'],
+                                       cpus=entry.get('cpus', 0),
+                                       memory=entry.get('memory', 0))
+        self.mr.reattach(running, self.jr_queue, slots=slots)
+        ct = len(running)
+        for (job_id, entry) in state['jobs'].items():
+            if job_id == self.job_id:
+                continue
+            if entry['status'] == 'finished':
+                # Its parent may not have the output yet
+                self._send_output(job_id, True)
+            elif entry['status'] == 'queued':
+                self._queue_subjob(job_id, entry['data'])
+                ct += 1
+        self._run_queued(config)
+        if self.job_id not in running:
+            self._submit(config, self.job_id, params, subjob=False)
+            ct += 1
+        self._save_state()
+        return ct
+
     def _update_prov(self, action):
         self.prov.add_subaction(action)
         self.callback_queue.put(['prov', None, self.prov.get_prov()])
@@ -222,13 +780,25 @@ class JobRunner(object):
         params = job_params[0]
         config = job_params[1]
         config['job_id'] = self.job_id
+        if self.blob_options is not None:
+            self.callback_queue.put(['shock_url', None, config['shock.url']])
+            config['shock_proxy_url'] = self.callback_url + 'shock'
+
+        if self.lock is not None:
+            Thread(target=self._reap, daemon=True).start()
+
+        # Resolve and pull the image while the rest of the job is set up
+        t = Thread(target=self._prefetch, args=[self.cc, params],
+                   daemon=True)
+        t.start()
 
         server_version = config['ee.server.version']
         fstr = 'Server version of Execution Engine: {}'
         self.logger.log(fstr.format(server_version))
 
         # Update job as started and log it
-        self.njs.update_job({'job_id': self.job_id, 'is_started': 1})
+        if self.resume_state is None:
+            self.njs.update_job({'job_id': self.job_id, 'is_started': 1})
 
         self._init_workdir()
         config['workdir'] = self.workdir
@@ -236,22 +806,28 @@ class JobRunner(object):
 
         self.prov = Provenance(params)
 
-        # Start the callback server
-        cb_args = [self.ip, self.port, self.jr_queue, self.callback_queue,
-                   self.token]
-        cbs = Process(target=start_callback_server, args=cb_args)
-        cbs.start()
+        # The callback server was started in __init__.  Make sure it is
+        # listening before the first container can call back to it.
+        self._wait_for_callback_server()
 
-        # Submit the main job
-        self._submit(config, self.job_id, params, subjob=False)
+        # Submit the main job, or pick it up where a runner that died
+        # left it
+        if self.resume_state is not None:
+            ct = self._resume(config, params)
+        else:
+            self._submit(config, self.job_id, params, subjob=False)
+            ct = 1
 
-        output = self._watch(config)
-        # TODO: Check to see if job completes and returns too much data
-        cbs.kill()
+        output = self._watch(config, ct=ct)
+        self.mr.drain_pool()
+        self.mr.refdata.release()
+        self.cbs.kill()
         self.logger.log('Job is done')
         self.njs.finish_job(self.job_id, output)
-        # TODO: Attempt to clean up any running docker containers
-        #       (if something crashed, for example)
+        self._clear_state()
+        if self.lock is not None:
+            release_lock(self.lock)
+            self.lock = None
         return output
 
         # Run docker or shifter	and keep a record of container id and
@@ -1,11 +1,26 @@
-from .DockerRunner import DockerRunner
-from .ShifterRunner import ShifterRunner
 import os
 import json
 from time import time as _time
 from time import sleep as _sleep
 from configparser import ConfigParser
 import sys
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import count
+from threading import Thread, Lock
+from .output import scan_output
+from .RefDataCache import RefDataCache
+
+# Outputs larger than this (in bytes) are rejected
+_MAX_OUTPUT_SIZE = 100 * 1024 * 1024
+# Seconds a container gets to stop before it is killed, and the longest
+# a cleanup waits for all of them
+_STOP_GRACE = 10
+_CLEANUP_DEADLINE = 30
+# Where the job-wide shared scratch directory is mounted by default
+_SHARED_SCRATCH = '/kb/module/work/shared'
+# The labels a warm container shares with the subjob that started the pool
+_POOL_LABELS = ['condor_id', 'image_name', 'image_version', 'njs_endpoint',
+                'user_name']
 
 # TODO: Get secure params (e.g. username and password)
 # Write out config file with all kbase endpoints / secure params
@@ -19,7 +34,7 @@ class MethodRunner:
     and returning output via a queue.
     """
 
-    def __init__(self, config, job_id, logger=None):
+    def __init__(self, config, job_id, logger=None, shared=None):
         """
         Inputs: config dictionary, Job ID, and optional logger
         """
@@ -30,13 +45,57 @@ class MethodRunner:
         self.workdir = config.get('workdir', '/mnt/awe/condor')
         # self.basedir = os.path.join(self.workdir, 'job_%s' % (self.job_id))
         self.refbase = config.get('refdata_dir', '/tmp/ref')
+        # Reference data can be staged onto local disk
+        kwargs = {'local_dir': config.get('refdata_local_dir')}
+        if config.get('refdata_local_size'):
+            kwargs['max_size'] = config['refdata_local_size']
+        self.refdata = RefDataCache(self.refbase, logger=logger, **kwargs)
+        self.max_output_size = int(config.get('max_output_size',
+                                              _MAX_OUTPUT_SIZE))
         self.job_dir = os.path.join(self.workdir, 'workdir')
+        # Optionally the main job and all its subjobs mount one scratch
+        # directory so they can hand files over by path
+        scratch = config.get('shared_scratch')
+        self.scratch_dir = os.path.join(self.workdir, 'shared')
+        self.scratch_bind = None
+        if scratch:
+            scratch = str(scratch)
+            self.scratch_bind = scratch if scratch.startswith('/') \
+                else _SHARED_SCRATCH
         runtime = config.get('runtime', 'docker')
         self.containers = []
+        self.job_containers = dict()
+        # Subjobs run in warm containers get the slot's work directory
+        self.pool_size = 0
+        self.job_slots = dict()
+        self.slot_jobs = dict()
+        self.slots = count(1)
+        self.filling = set()
+        self.fill_lock = Lock()
+        # Only one pull of an image at a time
+        self.image_lock = Lock()
+        self.image_locks = dict()
+        interval = float(config.get('stats_interval', 10))
+        # Only import the runtime we need.  The docker module is
+        # expensive to import and useless under Shifter.
         if runtime == 'docker':
-            self.runner = DockerRunner(logger=logger)
+            from .DockerRunner import DockerRunner
+            self.pool_size = int(config.get('warm_pool', 0))
+            kwargs = {
+                'stats_interval': interval,
+                'pool_size': self.pool_size,
+                'gc_threshold': config.get('image_gc_threshold'),
+                'image_state': config.get('image_state_file')
+            }
+            if shared is not None:
+                kwargs['client'] = shared.docker
+                kwargs['images'] = shared.images
+            self.runner = DockerRunner(logger=logger, **kwargs)
         elif runtime == 'shifter':
-            self.runner = ShifterRunner(logger=logger)
+            from .ShifterRunner import ShifterRunner
+            self.runner = ShifterRunner(
+                logger=logger, stats_interval=interval,
+                node_cache=config.get('shifter_image_cache'))
         else:
             raise OSError("Unknown runtime")
 
@@ -55,7 +114,7 @@ class MethodRunner:
         conf_prop['global'] = {
           'kbase_endpoint': config['kbase.endpoint'],
           'workspace_url': config['workspace.srv.url'],
-          'shock_url': config['shock.url'],
+          'shock_url': config.get('shock_proxy_url', config['shock.url']),
           'handle_url': config['handle.url'],
           'auth_service_url': config['auth-service-url'],
           'auth_service_url_allow_insecure':
@@ -84,9 +143,20 @@ class MethodRunner:
 
         return True
 
+    def get_image(self, image):
+        """
+        Make sure an image is on the node and return its id.  A job waits
+        here for a pull that is already running (e.g. a prefetch).
+        """
+        with self.image_lock:
+            lock = self.image_locks.setdefault(image, Lock())
+        with lock:
+            return self.runner.get_image(image)
+
     def _get_job_dir(self, job_id, subjob=False):
         if subjob:
-            return os.path.join(self.subjobdir, job_id)
+            slot = self.job_slots.get(job_id, job_id)
+            return os.path.join(self.subjobdir, slot)
         else:
             return self.job_dir
 
@@ -97,15 +167,11 @@ class MethodRunner:
         This is a blocking call.  It will not return until the
         job/process exits.
         """
-        # Mkdir workdir/tmp
-        job_dir = self._get_job_dir(job_id, subjob=subjob)
-        if not os.path.exists(job_dir):
-            os.mkdir(job_dir)
         (module, method) = params['method'].split('.')
         version = params.get('service_ver')
 
         image = module_info['docker_img_name']
-        id = self.runner.get_image(image)
+        id = self.get_image(image)
 
         if id is None:
             self.logger.error("No id returned for image")
@@ -115,13 +181,8 @@ class MethodRunner:
             self.logger.log(fstr.format(params['method'], job_id))
         self.logger.log('Running docker container for image: {}'.format(image))
 
-        # Initialize workdir
-        self._init_workdir(config, job_dir, params)
-
         # Run the container
-        vols = {
-            job_dir: {'bind': '/kb/module/work', 'mode': 'rw'}
-        }
+        vols = dict()
         if 'volume_mounts' in config:
             for v in config['volume_mounts']:
                 k = v['host_dir']
@@ -137,9 +198,32 @@ class MethodRunner:
         # Check to see if that image exists, and if refdata exists
         # paths to tmp dirs, refdata, volume mounts/binds
         if 'data_version' in module_info:
-            ref_data = os.path.join(self.refbase, module_info['data_folder'],
-                                    module_info['data_version'])
+            ref_data = self.refdata.get(module_info['data_folder'],
+                                        module_info['data_version'])
             vols[ref_data] = {'bind': '/data', 'mode': 'ro'}
+        if self.scratch_bind is not None:
+            if not os.path.exists(self.scratch_dir):
+                os.makedirs(self.scratch_dir, exist_ok=True)
+            vols[self.scratch_dir] = {'bind': self.scratch_bind,
+                                      'mode': 'rw'}
+        # A warm container for a subjob already has its volumes and
+        # limits, so only the same ones can use it.
+        key = None
+        c = None
+        if subjob and self.pool_size:
+            key = json.dumps([image, vols, config.get('resources')],
+                             sort_keys=True)
+            (c, slot) = self.runner.take_warm(key, image)
+            if c is not None:
+                self.job_slots[job_id] = slot
+                self.slot_jobs[slot] = job_id
+
+        # Mkdir workdir/tmp and initialize it
+        job_dir = self._get_job_dir(job_id, subjob=subjob)
+        if not os.path.exists(job_dir):
+            os.mkdir(job_dir)
+        self._init_workdir(config, job_dir, params)
+
         # TODO: Handle extra volumes
         env = {
             'SDK_CALLBACK_URL': callback
@@ -155,7 +239,7 @@ class MethodRunner:
             "job_id": job_id,
             "method_name": "TODO",
             "njs_endpoint": "https://kbase.us/services/njs_wrapper",
-            "parent_job_id": "",
+            "parent_job_id": self.job_id if subjob else "",
             "user_name": config['user'],
             "wsid": str(params.get('wsid', ''))
         }
@@ -168,40 +252,222 @@ class MethodRunner:
             'commit': module_info['git_commit_hash']
         }
         # TODO Do we need to do more for error handling?
-        c = self.runner.run(job_id, image, env, vols, labels, subjob, [fin_q])
+        if c is not None:
+            self.logger.log('Using a warm container for {}'.format(job_id))
+            self.runner.start(c, job_id, subjob, [fin_q])
+        else:
+            job_vols = dict(vols)
+            job_vols[job_dir] = {'bind': '/kb/module/work', 'mode': 'rw'}
+            c = self.runner.run(job_id, image, env, job_vols, labels, subjob,
+                                [fin_q], resources=config.get('resources'))
+        # Top up the pool once the job itself is on its way
+        if key is not None:
+            self._fill_pool(key, image, vols, labels, callback, job_id,
+                            config.get('resources'))
         self.containers.append(c)
+        self.job_containers[job_id] = c
         return action
 
-    def get_output(self, job_id, subjob=True):
-        # Attempt to read output file and see if it is well formed
-        # Throw errors if not
+    def reattach(self, jobs, fin_q, slots=None):
+        """
+        Pick up the running jobs of a runner that died.  jobs maps each job
+        id to its container id and log offset, and slots maps jobs that ran
+        in warm containers to their slots.  Live containers are watched
+        again and a job whose container is gone is reported as finished so
+        its output is collected.  Any other containers of the job (e.g.
+        unused warm ones) are removed.
+        """
+        self.subjobdir = os.path.join(self.workdir, 'subjobs')
+        for (job_id, slot) in (slots or {}).items():
+            self.job_slots[job_id] = slot
+            self.slot_jobs[slot] = job_id
+        found = self.runner.find(self.job_id)
+        for (job_id, entry) in jobs.items():
+            subjob = job_id != self.job_id
+            c = found.pop(entry.get('container'), None)
+            if c is None:
+                fin_q.put(['finished', job_id, None])
+                continue
+            self.logger.log('Reattaching to container for {}'.format(job_id))
+            self.runner.attach(c, job_id, subjob, [fin_q],
+                               since=entry.get('since', 1))
+            self.containers.append(c)
+            self.job_containers[job_id] = c
+        if len(found) > 0:
+            self._teardown(list(found.values()), 0, _CLEANUP_DEADLINE)
+
+    def _fill_pool(self, key, image, vols, labels, callback, job_id,
+                   resources):
+        """
+        Top up the warm containers for a pool key in the background.  Each
+        one gets a new slot directory and a callback URL for the slot.
+        """
+        wanted = self.runner.pool_wanted(key, image)
+        if wanted == 0:
+            return
+        with self.fill_lock:
+            if key in self.filling:
+                return
+            self.filling.add(key)
+        # Any method of the image may use a warm container, so it only
+        # gets the labels that don't depend on the subjob
+        slabels = dict((k, labels[k]) for k in _POOL_LABELS if k in labels)
+        slabels['parent_job_id'] = self.job_id
+        base = callback[:len(callback) - len(job_id)]
+
+        def _fill():
+            try:
+                for i in range(wanted):
+                    slot = 'warm-%d' % (next(self.slots))
+                    slot_dir = os.path.join(self.subjobdir, slot)
+                    os.mkdir(slot_dir)
+                    svols = dict(vols)
+                    svols[slot_dir] = {'bind': '/kb/module/work',
+                                       'mode': 'rw'}
+                    env = {'SDK_CALLBACK_URL': base + slot}
+                    c = self.runner.create(image, env, svols,
+                                           dict(slabels, job_id=slot),
+                                           resources=resources)
+                    self.runner.add_warm(key, c, slot)
+            except Exception as e:
+                self.logger.error('Failed to create warm containers: %s' % e)
+            finally:
+                with self.fill_lock:
+                    self.filling.discard(key)
+
+        Thread(target=_fill, daemon=True).start()
+
+    def drain_pool(self):
+        """
+        Remove the warm containers that weren't used and their slots.
+        """
+        if not self.pool_size:
+            return
+        warm = self.runner.drain_pool()
+        self._teardown([c for (c, slot) in warm], 0, _CLEANUP_DEADLINE)
+        for (c, slot) in warm:
+            slot_dir = os.path.join(self.subjobdir, slot)
+            try:
+                os.rmdir(slot_dir)
+            except OSError:
+                pass
+
+    def _teardown(self, containers, grace, deadline):
+        # Stop and remove all the containers at once
+        report = {'removed': 0, 'gone': 0, 'failed': 0, 'pending': 0}
+        if len(containers) == 0:
+            return report
+        pool = ThreadPoolExecutor(max_workers=min(32, len(containers)))
+        futures = [pool.submit(self.runner.remove, c, grace)
+                   for c in containers]
+        (done, pending) = wait(futures, timeout=deadline)
+        # Anything still stopping is left to finish in the background
+        pool.shutdown(wait=False)
+        for f in done:
+            if f.exception() is not None:
+                report['failed'] += 1
+            elif f.result():
+                report['removed'] += 1
+            else:
+                report['gone'] += 1
+        report['pending'] = len(pending)
+        return report
+
+    def _output_error(self, name, message):
+        return {
+            'error': {
+                "code": -32601,
+                "name": name,
+                "message": message,
+                "error": message
+            }
+        }
+
+    def check_output(self, job_id, subjob=True):
+        """
+        Find the output file of a job and check its size without reading
+        it.  Returns the path and None, or None and an error result.
+        """
         of = os.path.join(self._get_job_dir(job_id, subjob=subjob),
                           'output.json')
-        if os.path.exists(of):
-            with open(of) as json_file:
-                output = json.load(json_file)
-        else:
+        if not os.path.exists(of):
             self.logger.error("No output")
-            result = {
-                'error': {
-                    "code": -32601,
-                    "name": "Output not found",
-                    "message": "No output generated",
-                    "error": "No output generated"
-                }
-            }
+            return (None, self._output_error("Output not found",
+                                             "No output generated"))
+        size = os.path.getsize(of)
+        if self.max_output_size and size > self.max_output_size:
+            fstr = "Output is too large ({} bytes, the limit is {} bytes)"
+            err = fstr.format(size, self.max_output_size)
+            self.logger.error(err)
+            return (None, self._output_error("Output too large", err))
+        return (of, None)
+
+    def get_output_ref(self, job_id, subjob=True, path=None):
+        """
+        Validate the output of a job without loading it into memory.
+        Returns a reference to the file (path, size and top-level keys)
+        and None, or None and an error result.  path is the output file
+        if check_output already found it.
+        """
+        of = path
+        if of is None:
+            (of, err) = self.check_output(job_id, subjob=subjob)
+            if of is None:
+                return (None, err)
+        try:
+            info = scan_output(of)
+        except ValueError as e:
+            self.logger.error("Malformed output: %s" % (e))
+            return (None, self._output_error("Malformed output", str(e)))
+        if 'error' in info['keys']:
+            self.logger.error("Error in job")
+        info['path'] = of
+        return (info, None)
 
-            return result
+    def get_output(self, job_id, subjob=True, path=None):
+        # Attempt to read output file and see if it is well formed
+        # Throw errors if not
+        of = path
+        if of is None:
+            (of, err) = self.check_output(job_id, subjob=subjob)
+            if of is None:
+                return err
+        try:
+            with open(of) as json_file:
+                output = json.load(json_file)
+        except ValueError as e:
+            self.logger.error("Malformed output: %s" % (e))
+            return self._output_error("Malformed output", str(e))
+        if not isinstance(output, dict):
+            self.logger.error("Malformed output")
+            return self._output_error("Malformed output",
+                                      "Output is not a JSON object")
 
         if 'error' in output:
             self.logger.error("Error in job")
 
         return output
 
-    def cleanup_all(self):
-        for c in self.containers:
-            try:
-                self.runner.remove(c)
-            except OSError:
-                continue
-        return True
+    def get_usage(self, job_id):
+        """
+        Returns the resource usage summary for a finished job, or None if
+        it wasn't sampled.  The samples are dropped.
+        """
+        usage = self.runner.usage.pop(job_id, None)
+        if usage is None:
+            return None
+        return usage.summary()
+
+    def cleanup_all(self, grace=_STOP_GRACE, deadline=_CLEANUP_DEADLINE):
+        """
+        Stop and remove all of the job's containers in parallel.  Each one
+        gets a SIGTERM and then a SIGKILL after the grace period, and the
+        cleanup gives up waiting after the deadline.  Returns the number
+        removed, already gone, failed and still stopping.
+        """
+        self.drain_pool()
+        report = self._teardown(list(self.containers), grace, deadline)
+        fstr = ('Cleanup removed {removed} containers ({gone} already gone, '
+                '{failed} failed, {pending} still stopping)')
+        self.logger.log(fstr.format(**report))
+        return report
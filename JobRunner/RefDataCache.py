@@ -0,0 +1,193 @@
+import fcntl
+import os
+import shutil
+
+# The most the staged reference data can take up (in bytes)
+_MAX_SIZE = 100 * 1024 * 1024 * 1024
+
+
+def _du(path):
+    total = 0
+    for (root, dirs, files) in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class RefDataCache(object):
+    """
+    Stages reference data from the shared filesystem onto local disk so
+    jobs read their reference databases locally.
+
+    A data version is copied on first use and later jobs on the node
+    mount the same copy.  Each copy is made under a lock for its version
+    and renamed into place, so a job never sees half of one and only jobs
+    that need that version wait for it.  Each job holds a shared lock on
+    the versions it uses, and the least recently used versions that no
+    job holds are removed to keep under the size limit.  Without a local
+    directory the shared copy is used directly.
+    """
+
+    def __init__(self, refbase, local_dir=None, max_size=_MAX_SIZE,
+                 logger=None):
+        self.refbase = refbase
+        self.local_dir = local_dir
+        self.max_size = int(max_size)
+        self.logger = logger
+        self.held = dict()
+
+    def _log(self, line):
+        if self.logger is not None:
+            self.logger.log(line)
+
+    def get(self, folder, version):
+        """
+        Returns the directory to mount for a data version.
+        """
+        src = os.path.join(self.refbase, folder, version)
+        if not os.path.isdir(src):
+            # The job may not read it, so leave any failure to the job
+            if self.logger is not None:
+                self.logger.error("Missing reference data (%s)" % (src))
+            return src
+        if self.local_dir is None:
+            return src
+        try:
+            return self._stage(folder, version, src)
+        except OSError as e:
+            self._log("Failed to stage reference data: %s" % (e))
+            self._release(folder, version)
+            return src
+
+    def _hold(self, folder, version, dest):
+        # Stops the version being evicted while this job uses it
+        if (folder, version) in self.held:
+            return
+        while True:
+            f = open(dest + '.lock', 'a')
+            fcntl.flock(f, fcntl.LOCK_SH)
+            # Eviction unlinks the lock file, so check this is still it
+            try:
+                if os.stat(dest + '.lock').st_ino == os.fstat(
+                        f.fileno()).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            f.close()
+        self.held[(folder, version)] = f
+
+    def _release(self, folder, version):
+        f = self.held.pop((folder, version), None)
+        if f is not None:
+            f.close()
+
+    def _stage(self, folder, version, src):
+        dest = os.path.join(self.local_dir, folder, version)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        # A staged version can't be evicted once it's held, so no other
+        # lock is needed to use it
+        self._hold(folder, version, dest)
+        if not os.path.exists(dest):
+            with open(dest + '.staging', 'a') as staging:
+                fcntl.flock(staging, fcntl.LOCK_EX)
+                # Another job may have staged it while this one waited
+                if not os.path.exists(dest) and \
+                        not self._copy(src, dest, staging):
+                    self._release(folder, version)
+                    return src
+        # The modification time orders the versions for eviction
+        os.utime(dest)
+        return dest
+
+    def _copy(self, src, dest, staging):
+        size = _du(src)
+        if size > self.max_size:
+            self._log("Reference data %s is too big to stage" % (src))
+            return False
+        with open(os.path.join(self.local_dir, '.staging.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.evict(size)
+            # Other jobs count the space this copy takes while it's made
+            staging.truncate(0)
+            staging.write(str(size))
+            staging.flush()
+        tmp = dest + '.tmp'
+        if os.path.exists(tmp):
+            # Left by a job that died while staging
+            shutil.rmtree(tmp)
+        self._log("Staging reference data %s" % (src))
+        shutil.copytree(src, tmp)
+        os.rename(tmp, dest)
+        return True
+
+    def _versions(self):
+        versions = []
+        for folder in os.listdir(self.local_dir):
+            fdir = os.path.join(self.local_dir, folder)
+            if not os.path.isdir(fdir):
+                continue
+            for version in os.listdir(fdir):
+                path = os.path.join(fdir, version)
+                if version.endswith('.tmp') or not os.path.isdir(path):
+                    continue
+                versions.append((os.path.getmtime(path), path))
+        return sorted(versions)
+
+    def _staging(self):
+        # The space reserved by copies other jobs are making
+        total = 0
+        for folder in os.listdir(self.local_dir):
+            fdir = os.path.join(self.local_dir, folder)
+            if not os.path.isdir(fdir):
+                continue
+            for name in os.listdir(fdir):
+                if not name.endswith('.staging'):
+                    continue
+                with open(os.path.join(fdir, name)) as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                        # No job is copying this version
+                        continue
+                    except BlockingIOError:
+                        pass
+                    try:
+                        total += int(f.read() or 0)
+                    except ValueError:
+                        pass
+        return total
+
+    def evict(self, need=0):
+        """
+        Remove the least recently used versions that aren't in use until
+        need more bytes fit under the size limit.  This has to be called
+        with the staging lock held.  Returns the removed directories.
+        """
+        versions = [(path, _du(path)) for (_, path) in self._versions()]
+        total = sum(size for (_, size) in versions) + self._staging()
+        removed = []
+        for (path, size) in versions:
+            if total + need <= self.max_size:
+                break
+            with open(path + '.lock', 'a') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                shutil.rmtree(path)
+                os.unlink(path + '.lock')
+            total -= size
+            removed.append(path)
+        if len(removed) > 0:
+            self._log("Removed staged reference data: %s" % (
+                      ', '.join(removed)))
+        return removed
+
+    def release(self):
+        """
+        Let the versions this job used be evicted.
+        """
+        for key in list(self.held):
+            self._release(*key)
@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import shutil
+from time import time as _time
+
+_CACHE_DIR = '/tmp/jobrunner_results'
+# The most the cached outputs can take up (in bytes)
+_MAX_SIZE = 10 * 1024 * 1024 * 1024
+
+
+class ResultCache(object):
+    """
+    Keeps the outputs of subjobs on the node so an identical call can be
+    answered without running a container.
+
+    Only the methods of allowed modules are cached, since a method has to
+    give the same output for the same inputs.  Outputs are keyed by the
+    module's git commit, the method, the user and the parameters, and the
+    least recently used ones are removed when the cache gets too big.
+    Every job runner on the node shares the cache directory, which only
+    its user can read.
+    """
+
+    def __init__(self, modules, cache_dir=_CACHE_DIR, max_size=_MAX_SIZE,
+                 logger=None):
+        if isinstance(modules, str):
+            modules = [m.strip() for m in modules.split(',') if m.strip()]
+        self.modules = set(modules)
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size)
+        self.logger = logger
+
+    def allows(self, module):
+        return module in self.modules
+
+    def key(self, git_commit, method, user, params):
+        """
+        Returns the cache key for a call.  The parameters are serialized
+        with sorted keys so the same call always gets the same key.
+        """
+        data = json.dumps([git_commit, method, user, params], sort_keys=True,
+                          separators=(',', ':'))
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, '%s.json' % (key))
+
+    def get(self, key, dest=None):
+        """
+        Returns the path of the cached output for a key, or None.  With
+        dest the output is linked (or copied) there and dest is returned,
+        so another runner evicting it can't remove it from under the job.
+        """
+        path = self._path(key)
+        try:
+            # Eviction goes by the modification time
+            now = _time()
+            os.utime(path, (now, now))
+            if dest is None:
+                return path
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            tmp = '%s.%d.tmp' % (dest, os.getpid())
+            try:
+                os.link(path, tmp)
+            except OSError:
+                # e.g. the job's directory is on another filesystem
+                shutil.copyfile(path, tmp)
+            os.rename(tmp, dest)
+        except OSError:
+            return None
+        return dest
+
+    def put(self, key, output_path):
+        """
+        Copy a job's output.json into the cache and evict old outputs if
+        the cache is over its size.
+        """
+        size = os.path.getsize(output_path)
+        if size > self.max_size:
+            return False
+        if not os.path.exists(self.cache_dir):
+            # Outputs may hold private data
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        tmp = '%s.%d.tmp' % (self._path(key), os.getpid())
+        shutil.copyfile(output_path, tmp)
+        os.chmod(tmp, 0o600)
+        os.rename(tmp, self._path(key))
+        self.evict()
+        return True
+
+    def evict(self):
+        """
+        Remove least recently used outputs until the cache fits in its
+        size.  Returns the number removed.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.json'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        removed = 0
+        for (_, size, name) in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(os.path.join(self.cache_dir, name))
+                removed += 1
+            except OSError:
+                # Another runner got to it first
+                pass
+            total -= size
+        if removed and self.logger is not None:
+            self.logger.log("Evicted %d cached results" % (removed))
+        return removed
@@ -1,12 +1,21 @@
-import docker
-import os
+import fcntl
 import json
+import os
+import signal
 from threading import Thread
-from time import time as _time
-from time import sleep as _sleep
-from subprocess import Popen, PIPE
-import sys
+from subprocess import Popen, PIPE, STDOUT, TimeoutExpired
 from select import select
+from time import sleep as _sleep
+from time import time as _time
+from .usage import Usage, proc_tree_usage
+
+# How long (in seconds) a pull can take before it is given up on
+_PULL_TIMEOUT = 1800
+# How long (in seconds) lookups in the node cache are trusted
+_NODE_CACHE_TTL = 600
+# Bytes read from a pipe at a time, and the longest line kept whole
+_READ_SIZE = 65536
+_MAX_LINE = 1024 * 1024
 
 
 class ShifterRunner:
@@ -15,67 +24,242 @@ class ShifterRunner:
 
     """
 
-    def __init__(self, logger=None):
+    def __init__(self, logger=None, stats_interval=10, node_cache=None,
+                 pull_timeout=_PULL_TIMEOUT):
         """
         Inputs: config dictionary, Job ID, and optional logger
         """
         self.logger = logger
         self.containers = []
         self.threads = []
+        self.stats_interval = stats_interval
+        self.usage = dict()
+        self.shifterimg = 'shifterimg'
+        # Image ids found by this process, and optionally a file shared
+        # by the node
+        self.images = dict()
+        self.node_cache = node_cache
+        self.pull_timeout = pull_timeout
 
     def _readio(self, p, job_id, queues):
-        cont = True
-        last = False
-        while cont:
-            rlist = [p.stdout, p.stderr]
-            x = select(rlist, [], [], 1)[0]
-            for f in x:
-                if f == p.stderr:
-                    error = True
-                else:
-                    error = False
-                l = f.readline().decode('utf-8')
-                if len(l) > 0:
-                    self.logger.log_lines([{'line': l, 'error': error}])
-            if last:
-                cont = False
-            if p.poll() is not None:
-                last = True
+        """
+        Read everything the pipes have each time select wakes up and log
+        the complete lines from both in one batch.  Partial lines are
+        kept until their newline arrives.
+        """
+        streams = {p.stdout.fileno(): 0, p.stderr.fileno(): 1}
+        partial = dict((fd, b'') for fd in streams)
+        for fd in streams:
+            os.set_blocking(fd, False)
+        open_fds = list(streams)
+        while open_fds:
+            ready = select(open_fds, [], [], 1)[0]
+            if not ready and p.poll() is not None:
+                # Exited, and anything its children left open is ignored
+                break
+            lines = []
+            for fd in ready:
+                data = b''
+                eof = False
+                while True:
+                    try:
+                        chunk = os.read(fd, _READ_SIZE)
+                    except BlockingIOError:
+                        break
+                    if not chunk:
+                        eof = True
+                        break
+                    data += chunk
+                parts = (partial[fd] + data).split(b'\n')
+                partial[fd] = parts.pop()
+                if eof or len(partial[fd]) > _MAX_LINE:
+                    parts.append(partial[fd])
+                    partial[fd] = b''
+                if eof:
+                    open_fds.remove(fd)
+                for line in parts:
+                    if len(line) > 0:
+                        lines.append({
+                            'line': line.decode('utf-8', 'replace'),
+                            'is_error': streams[fd]
+                        })
+            if len(lines) > 0:
+                self.logger.log_lines(lines)
+        p.wait()
+        self.usage[job_id].finish()
         for q in queues:
             q.put(['finished', job_id, None])
 
-    def get_image(self, image):
-        # Do a shifterimg images
-        lookcmd = ['shifterimg', 'lookup', image]
-        proc = Popen(lookcmd, stdout=PIPE, stderr=PIPE)
-        stdout, stderr = proc.communicate()
-        id = stdout.decode('utf-8').rsplit()
-        if id == '':
-            cmd = ['shifterimg', 'pull', image]
-            proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
-            stdout, stderr = proc.communicate()
-            proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
-            stdout, stderr = proc.communicate()
-            id = stdout.decode('utf-8').rsplit()
+    def _sample(self, p, usage):
+        while usage.end is None and p.poll() is None:
+            usage.update(**proc_tree_usage(p.pid))
+            _sleep(self.stats_interval)
 
+    def _lookup(self, image):
+        # Returns the image id or None if the gateway doesn't have it
+        proc = Popen([self.shifterimg, 'lookup', image], stdout=PIPE,
+                     stderr=PIPE)
+        try:
+            stdout, stderr = proc.communicate(timeout=60)
+        except TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            return None
+        id = stdout.decode('utf-8').strip()
+        if proc.returncode != 0 or id == '':
+            return None
         return id
 
-    def run(self, job_id, image, env, vols, labels, subjob, queues):
+    def _update_node_cache(self, func):
+        # Run func on the node cache with it locked and save it
+        with open(self.node_cache + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.node_cache) as f:
+                    cache = json.load(f)
+            except (IOError, OSError, ValueError):
+                cache = dict()
+            result = func(cache)
+            tmp = self.node_cache + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(cache, f)
+            os.rename(tmp, self.node_cache)
+        return result
+
+    def _cached(self, image):
+        if image in self.images:
+            return self.images[image]
+        if self.node_cache is None:
+            return None
+        try:
+            with open(self.node_cache) as f:
+                entry = json.load(f).get(image)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry is None or _time() - entry['time'] > _NODE_CACHE_TTL:
+            return None
+        self.images[image] = entry['id']
+        return entry['id']
+
+    def _remember(self, image, id):
+        self.images[image] = id
+        if self.node_cache is None:
+            return
+
+        def _add(cache):
+            cache[image] = {'id': id, 'time': _time()}
+
+        try:
+            self._update_node_cache(_add)
+        except (IOError, OSError):
+            pass
+
+    def _pull(self, image, deadline):
+        """
+        Run one pull and log its status as it changes.  The gateway may
+        still be working on it when the command exits, so the caller
+        polls the lookup after this.
+        """
+        self.logger.log("Pulling image {}".format(image))
+        proc = Popen([self.shifterimg, 'pull', image], stdout=PIPE,
+                     stderr=STDOUT, bufsize=0)
+        os.set_blocking(proc.stdout.fileno(), False)
+        buf = b''
+        last = None
+        while True:
+            wait = deadline - _time()
+            if wait <= 0:
+                proc.kill()
+                break
+            ready = select([proc.stdout], [], [], min(wait, 5))[0]
+            if ready:
+                data = proc.stdout.read()
+                if data is None:
+                    continue
+                if not data:
+                    break
+                buf += data
+                # shifterimg rewrites its status on one line with \r
+                lines = buf.replace(b'\r', b'\n').split(b'\n')
+                buf = lines.pop()
+                for line in lines:
+                    status = line.decode('utf-8', 'replace').strip()
+                    if status and status != last:
+                        fstr = "Pull of {}: {}"
+                        self.logger.log(fstr.format(image, status))
+                        last = status
+            elif proc.poll() is not None:
+                break
+        proc.wait()
+
+    def get_image(self, image):
+        """
+        Returns the Shifter id of an image, pulling it if the gateway
+        doesn't have it, or None if it can't be pulled.
+        """
+        id = self._cached(image)
+        if id is not None:
+            return id
+        id = self._lookup(image)
+        if id is None:
+            deadline = _time() + self.pull_timeout
+            self._pull(image, deadline)
+            delay = 1
+            id = self._lookup(image)
+            while id is None and _time() + delay < deadline:
+                _sleep(delay)
+                delay = min(delay * 2, 30)
+                id = self._lookup(image)
+            if id is None:
+                self.logger.error("Failed to pull image {}".format(image))
+                return None
+        self._remember(image, id)
+        return id
+
+    def run(self, job_id, image, env, vols, labels, subjob, queues,
+            resources=None):
+        # Shifter runs inside the slot's cgroup, so resources are
+        # already bounded by the batch system.
         cmd = [
             'shifter',
             '--image=%s' % (image)
             ]
         # TODO: Do somehting with the labels
-        newenv = os.environ
+        # A daemon runs many jobs in this process, so the job's settings
+        # mustn't leak into its environment
+        newenv = os.environ.copy()
         for e in env.keys():
             newenv[e] = env[e]
-        proc = Popen(cmd, bufsize=0, stdout=PIPE, stderr=PIPE, env=newenv)
+        # The job gets its own process group so it can be stopped as a whole
+        proc = Popen(cmd, bufsize=0, stdout=PIPE, stderr=PIPE, env=newenv,
+                     start_new_session=True)
+        self.usage[job_id] = Usage()
         out = Thread(target=self._readio, args=[proc, job_id, queues])
         self.threads.append(out)
         out.start()
+        if self.stats_interval:
+            t = Thread(target=self._sample, args=[proc, self.usage[job_id]],
+                       daemon=True)
+            t.start()
         self.containers.append(proc)
         return proc
 
-    def remove(self, c):
-        # TODO
-        pass
+    def remove(self, c, grace=10):
+        """
+        Stop a job's processes (SIGTERM, then SIGKILL after grace seconds).
+        Returns False if it had already exited.
+        """
+        if c.poll() is not None:
+            return False
+        try:
+            os.killpg(c.pid, signal.SIGTERM)
+            c.wait(grace)
+        except ProcessLookupError:
+            return False
+        except TimeoutExpired:
+            try:
+                os.killpg(c.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            c.wait()
+        return True
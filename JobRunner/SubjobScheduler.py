@@ -0,0 +1,123 @@
+from collections import deque
+from itertools import count
+
+
+class SubjobScheduler(object):
+    """
+    This class queues subjob submissions and decides when they can run.
+
+    Subjobs are limited by a maximum count and optionally by the total CPUs
+    and memory (MB) they declare.  A limit of 0 means unlimited.  Pending
+    subjobs are kept in a FIFO per parent.  Deeper subjobs go first, since
+    their parents are holding a slot while they wait, and then the parent
+    with the fewest running subjobs goes first so one parent can't starve
+    its siblings.  A running subjob with subjobs of its own is waiting on
+    them, so it doesn't count against the limits while they are queued or
+    running.  Otherwise a parent could hold the slot its children need.
+    """
+
+    def __init__(self, max_jobs=0, max_cpus=0, max_memory=0, root=None):
+        self.max_jobs = max_jobs
+        self.max_cpus = max_cpus
+        self.max_memory = max_memory
+        self.pending = dict()
+        self.running = dict()
+        self.parent_running = dict()
+        self.depth = {root: 0}
+        self.cpus = 0
+        self.memory = 0
+        self._seq = count()
+
+    def add(self, job_id, parent, data, cpus=0, memory=0):
+        """
+        Queue a subjob.  Call next() to get the subjobs that can run.
+        """
+        self.depth[job_id] = self.depth.get(parent, 0) + 1
+        item = (next(self._seq), job_id, parent, data, cpus or 0, memory or 0)
+        self.pending.setdefault(parent, deque()).append(item)
+
+    def _waiting(self, job_id):
+        return job_id in self.pending or \
+            self.parent_running.get(job_id, 0) > 0
+
+    def _fits(self, cpus, memory):
+        njobs = len(self.running)
+        used_cpus = self.cpus
+        used_memory = self.memory
+        for (job_id, (_, jcpus, jmemory)) in self.running.items():
+            if self._waiting(job_id):
+                njobs -= 1
+                used_cpus -= jcpus
+                used_memory -= jmemory
+        if njobs == 0:
+            # Always let something run, even if it is oversized
+            return True
+        if self.max_jobs and njobs >= self.max_jobs:
+            return False
+        if self.max_cpus and used_cpus + cpus > self.max_cpus:
+            return False
+        if self.max_memory and used_memory + memory > self.max_memory:
+            return False
+        return True
+
+    def _rank(self, parent):
+        seq = self.pending[parent][0][0]
+        return (-self.depth.get(parent, 0),
+                self.parent_running.get(parent, 0), seq)
+
+    def next(self):
+        """
+        Returns the (job_id, data) of the next subjob to start, or None if
+        nothing can start right now.  The subjob is counted as running.
+        """
+        for parent in sorted(self.pending, key=self._rank):
+            (_, job_id, _, data, cpus, memory) = self.pending[parent][0]
+            if not self._fits(cpus, memory):
+                continue
+            self.pending[parent].popleft()
+            if len(self.pending[parent]) == 0:
+                del self.pending[parent]
+            self.running[job_id] = (parent, cpus, memory)
+            self.parent_running[parent] = \
+                self.parent_running.get(parent, 0) + 1
+            self.cpus += cpus
+            self.memory += memory
+            return (job_id, data)
+        return None
+
+    def started(self, job_id, parent, cpus=0, memory=0):
+        """
+        Count a subjob that is already running, e.g. one picked up from a
+        runner that died.
+        """
+        self.depth[job_id] = self.depth.get(parent, 0) + 1
+        self.running[job_id] = (parent, cpus or 0, memory or 0)
+        self.parent_running[parent] = self.parent_running.get(parent, 0) + 1
+        self.cpus += cpus or 0
+        self.memory += memory or 0
+
+    def finished(self, job_id):
+        """
+        Release the resources held by a finished subjob.
+        """
+        if job_id not in self.running:
+            return
+        (parent, cpus, memory) = self.running.pop(job_id)
+        self.parent_running[parent] -= 1
+        self.cpus -= cpus
+        self.memory -= memory
+
+    def is_queued(self, job_id):
+        for items in self.pending.values():
+            for item in items:
+                if item[1] == job_id:
+                    return True
+        return False
+
+    def clear(self):
+        """
+        Drop all pending subjobs and return their ids.
+        """
+        ids = [item[1] for items in self.pending.values() for item in items]
+        self.pending = dict()
+        return ids
@@ -1,31 +1,154 @@
 from sanic import Sanic
-from sanic.response import json
+from sanic.response import json, stream, raw
 from sanic.exceptions import abort
+import os
+import re
 import uuid
-from queue import Empty
+import json as json_lib
+from queue import Empty, Full
+from queue import Queue as ThreadQueue
+from threading import Thread
 import asyncio
 
+_CHUNK = 1024 * 1024
+# How often (in seconds) messages from the job runner are read when no
+# client is polling
+_DRAIN_INTERVAL = 1
+# How often (in seconds) a blocked upload checks its Shock request is alive
+_PUT_TIMEOUT = 1
+# Response headers that only apply to the proxy's own connection
+_HOP_HEADERS = ['connection', 'content-length', 'content-encoding',
+                'transfer-encoding', 'keep-alive']
+_NODE = re.compile(r'^node/([^/?]+)$')
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
 app = Sanic()
 outputs = dict()
+output_files = dict()
 prov = None
+# Events for the sync calls waiting on each job
+waiters = dict()
+# The optional caching proxy for Shock downloads
+blob_cache = None
 
 
-def _check_finished():
+def _record(mtype, fjob_id, output):
     global prov
+    if mtype == 'output':
+        outputs[fjob_id] = output
+    elif mtype == 'output_file':
+        # Only a reference to the subjob's output.json is sent
+        output_files[fjob_id] = output
+    elif mtype == 'prov':
+        prov = output
+    elif mtype == 'shock_url':
+        # The job runner only learns the Shock URL from the job
+        if blob_cache is not None:
+            blob_cache.upstream = output
+    if fjob_id in waiters:
+        waiters[fjob_id].set()
+
+
+def _check_finished():
     in_q = app.config['in_q']
+    if in_q is None:
+        # An in-process server is sent its messages directly
+        return
     try:
         # Flush the queue
         while True:
-            [mtype, fjob_id, output] = in_q.get(block=False)
-            if mtype == 'output':
-                outputs[fjob_id] = output
-            elif mtype == 'prov':
-                prov = output
+            _record(*in_q.get(block=False))
     except Empty:
         pass
 
-async def _process_rpc(data, token):
+
+def _stream_output(ref, wrap):
+    """
+    Stream a subjob's output.json straight from its workdir.  The
+    finished flag (and resource usage) is spliced in after the opening
+    brace, so the output is never parsed or copied in memory.
+    """
+    extra = {'finished': True}
+    if ref.get('resource_usage') is not None:
+        extra['resource_usage'] = ref['resource_usage']
+    head = json_lib.dumps(extra)[:-1]
+
+    async def streaming_fn(response):
+        if wrap:
+            await response.write('{"result": [')
+        with open(ref['path'], 'rb') as f:
+            chunk = f.read(_CHUNK)
+            # The output was checked to be an object when it finished
+            chunk = chunk[chunk.index(b'{') + 1:]
+            if ref.get('empty'):
+                await response.write(head + '}')
+            else:
+                await response.write(head + ', ')
+                while chunk:
+                    await response.write(chunk)
+                    chunk = f.read(_CHUNK)
+        if wrap:
+            await response.write(']}')
+
+    return stream(streaming_fn, content_type='application/json')
+
+
+def _get_output(job_id, wrap=True):
+    if job_id in output_files:
+        return _stream_output(output_files[job_id], wrap)
+    resp = outputs.get(job_id)
+    if resp is None:
+        return None
+    resp['finished'] = True
+    if wrap:
+        return {'result': [resp]}
+    return resp
+
+
+def _load_output(ref):
+    try:
+        with open(ref['path']) as f:
+            resp = json_lib.load(f)
+    except (OSError, ValueError) as e:
+        message = 'Failed to load the output: %s' % (e)
+        return {
+            'error': {
+                'code': -32601,
+                'name': 'Output not readable',
+                'message': message,
+                'error': message
+            }
+        }
+    if ref.get('resource_usage') is not None:
+        resp['resource_usage'] = ref['resource_usage']
+    return resp
+
+
+def _get_state(job_id):
+    # Like _check_job, but the output is loaded so many can be returned
+    if job_id in output_files:
+        # Keep the loaded output so later polls don't read it again
+        resp = _load_output(output_files.pop(job_id))
+        outputs[job_id] = resp
+        resp = dict(resp)
+    elif job_id in outputs:
+        resp = dict(outputs[job_id])
+    else:
+        return {'finished': False}
+    resp['finished'] = True
+    return resp
+
+
+def _respond(resp):
+    if isinstance(resp, dict):
+        return json(resp)
+    return resp
+
+
+async def _process_rpc(data, token, parent_job_id=None):
     (module, method) = data['method'].split('.')
+    if parent_job_id is not None:
+        data['parent_job_id'] = parent_job_id
     # async submi job
     if method.startswith('_') and method.endswith('_submit'):
         if token != app.config.get('token'):
@@ -34,17 +157,35 @@ async def _process_rpc(data, token):
         data['method'] = '%s.%s' % (module, method[1:-7])
         app.config['out_q'].put(['submit',  job_id, data])
         return {'result': job_id}
+    # async submit of the method for each of a list of parameters
+    elif method.startswith('_') and method.endswith('_map'):
+        if token != app.config.get('token'):
+            abort(401)
+        data['method'] = '%s.%s' % (module, method[1:-4])
+        jobs = []
+        for params in data.get('params') or []:
+            job = dict(data)
+            job['params'] = params
+            jobs.append([str(uuid.uuid1()), job])
+        app.config['out_q'].put(['submit_map', None, jobs])
+        return {'result': [[job_id for (job_id, job) in jobs]]}
+    # check many jobs
+    elif method == '_check_jobs':
+        if 'params' not in data:
+            abort(404)
+        _check_finished()
+        return {'result': [[_get_state(job_id)
+                            for job_id in data['params'][0]]]}
     # check job
     elif method.startswith('_check_job'):
         if 'params' not in data:
             abort(404)
         job_id = data['params'][0]
         _check_finished()
-        resp = {'finished': False}
-        if job_id in outputs:
-            resp = outputs[job_id]
-            resp['finished'] = True
-        return {'result': [resp]}
+        resp = _get_output(job_id)
+        if resp is None:
+            resp = {'result': [{'finished': False}]}
+        return resp
     # Provenance
     elif method.startswith('get_provenance'):
         _check_finished()
@@ -54,17 +195,22 @@ async def _process_rpc(data, token):
             abort(401)
         job_id = str(uuid.uuid1())
         data['method'] = '%s.%s' % (module, method[1:-7])
+        waiters[job_id] = asyncio.Event()
         app.config['out_q'].put(['submit',  job_id, data])
         try:
             while True:
                 _check_finished()
-                if job_id in outputs:
-                    resp = outputs[job_id]
-                    resp['finished'] = True
+                resp = _get_output(job_id, wrap=False)
+                if resp is not None:
                     return resp
-                await asyncio.sleep(1)
+                try:
+                    await asyncio.wait_for(waiters[job_id].wait(), 1)
+                except asyncio.TimeoutError:
+                    pass
         except:
             return {'error': 'Timeout'}
+        finally:
+            waiters.pop(job_id, None)
 
 
 @app.route("/", methods=['GET', 'POST'])
@@ -72,18 +218,263 @@ async def root(request):
         data = request.json
         if request.method == 'POST' and data is not None and 'method' in data:
             token = request.headers.get('Authorization')
-            return json(await _process_rpc(data, token))
+            return _respond(await _process_rpc(data, token))
         return json({})
 
 
-def start_callback_server(ip, port, out_queue, in_queue, token):
+@app.route("/<parent_job_id>", methods=['GET', 'POST'])
+async def job_root(request, parent_job_id):
+    # Each container is given a callback URL ending in its job id
+    data = request.json
+    if request.method == 'POST' and data is not None and 'method' in data:
+        token = request.headers.get('Authorization')
+        return _respond(await _process_rpc(data, token, parent_job_id))
+    return json({})
+
+
+def _byte_range(header, size):
+    # Returns the first and last byte of a single range
+    m = _RANGE.match(header.strip())
+    if m is None or m.group(1) == m.group(2) == '':
+        raise ValueError('Unsupported range')
+    if m.group(1) == '':
+        start = max(size - int(m.group(2)), 0)
+        end = size - 1
+    else:
+        start = int(m.group(1))
+        end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+    if start > end:
+        raise ValueError('Unsatisfiable range')
+    return (start, end)
+
+
+def _serve_blob(request, path, info):
+    """
+    Send a cached file, or the requested range of it.
+    """
+    size = os.path.getsize(path)
+    headers = {'Accept-Ranges': 'bytes'}
+    if request.query_string == 'download' and info.get('name'):
+        headers['Content-Disposition'] = \
+            'attachment; filename=%s' % (info['name'])
+    (start, end) = (0, size - 1)
+    status = 200
+    if request.headers.get('Range'):
+        try:
+            (start, end) = _byte_range(request.headers['Range'], size)
+        except ValueError:
+            return raw(b'', status=416,
+                       headers={'Content-Range': 'bytes */%d' % (size)})
+        status = 206
+        headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+
+    async def streaming_fn(response):
+        left = end - start + 1
+        with open(path, 'rb') as f:
+            f.seek(start)
+            while left > 0:
+                chunk = f.read(min(_CHUNK, left))
+                if not chunk:
+                    break
+                left -= len(chunk)
+                await response.write(chunk)
+
+    return stream(streaming_fn, status=status, headers=headers,
+                  content_type='application/octet-stream')
+
+
+class _Body(object):
+    """
+    A request body read from a queue as the client sends it.  The length
+    is known if the client sent one, so it isn't re-sent chunked.
+    """
+
+    def __init__(self, chunks, length=None):
+        self.chunks = chunks
+        self.length = length
+
+    def __len__(self):
+        return int(self.length)
+
+    def __iter__(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            yield chunk
+
+
+async def _forward(request, path):
+    """
+    Pass a request on to Shock, streaming the body both ways.
+    """
+    from .BlobCache import pass_headers
+    loop = asyncio.get_event_loop()
+    url = blob_cache.url(path)
+    if request.query_string:
+        url += '?' + request.query_string
+    chunks = ThreadQueue(16)
+    data = None
+    if request.method in ['POST', 'PUT']:
+        data = _Body(chunks, request.headers.get('Content-Length'))
+        if data.length is None:
+            data = iter(data)
+    headers = pass_headers(request.headers)
+    fut = loop.run_in_executor(None, lambda: blob_cache.session.request(
+        request.method, url, data=data, headers=headers, stream=True))
+    while True:
+        chunk = await request.stream.read()
+        # Once the request to Shock is over the rest of the body is dropped
+        while data is not None and not fut.done():
+            try:
+                await loop.run_in_executor(None, lambda: chunks.put(
+                    chunk, timeout=_PUT_TIMEOUT))
+                break
+            except Full:
+                pass
+        if chunk is None:
+            break
+    resp = await fut
+    headers = dict((k, v) for (k, v) in resp.headers.items()
+                   if k.lower() not in _HOP_HEADERS + ['content-type'])
+    content = resp.iter_content(_CHUNK)
+
+    async def streaming_fn(response):
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, next, content, None)
+                if chunk is None:
+                    break
+                await response.write(chunk)
+        finally:
+            resp.close()
+
+    return stream(streaming_fn, status=resp.status_code, headers=headers,
+                  content_type=resp.headers.get('Content-Type', 'text/plain'))
+
+
+@app.route("/shock/<path:path>", methods=['GET', 'POST', 'PUT', 'DELETE'],
+           stream=True)
+async def shock_proxy(request, path):
+    # Containers are given this as their Shock URL when the proxy is on
+    _check_finished()
+    if blob_cache is None or blob_cache.upstream is None:
+        abort(404)
+    m = _NODE.match(path)
+    if request.method != 'GET' or m is None or \
+            request.query_string not in ['download', 'download_raw']:
+        return await _forward(request, path)
+    loop = asyncio.get_event_loop()
+    headers = dict(request.headers)
+    (info, resp) = await loop.run_in_executor(
+        None, blob_cache.node_file, m.group(1), headers)
+    if info is None:
+        return raw(resp.content, status=resp.status_code,
+                   content_type=resp.headers.get('Content-Type',
+                                                 'text/plain'))
+    md5 = (info.get('checksum') or {}).get('md5')
+    if not md5:
+        return await _forward(request, path)
+    try:
+        blob = await loop.run_in_executor(None, blob_cache.fetch, m.group(1),
+                                          md5, headers)
+    except OSError as e:
+        # Includes HTTP errors and checksum mismatches
+        if blob_cache.logger is not None:
+            blob_cache.logger.log("Failed to cache Shock node %s: %s" % (
+                                  m.group(1), e))
+        return await _forward(request, path)
+    return _serve_blob(request, blob, info)
+
+
+async def _notify_ready(app, loop):
+    # Tell the job runner it is safe to start containers
+    app.config['out_q'].put(['ready', None, None])
+
+
+async def _drain(app, loop):
+    # Keep reading the job runner's messages so its side of the queue
+    # can't fill up while nothing polls
+    async def _read():
+        while True:
+            _check_finished()
+            await asyncio.sleep(_DRAIN_INTERVAL)
+
+    loop.create_task(_read())
+
+
+def _init_blob_cache(options):
+    global blob_cache
+    if options is not None:
+        from .BlobCache import BlobCache
+        blob_cache = BlobCache(**options)
+
+
+def start_callback_server(ip, port, out_queue, in_queue, token, sock=None,
+                          blob_options=None):
     conf = {
         'token': token,
         'out_q': out_queue,
         'in_q': in_queue
     }
     app.config.update(conf)
-    app.run(host=ip, port=port, debug=False, access_log=False)
+    _init_blob_cache(blob_options)
+    app.register_listener(_notify_ready, 'after_server_start')
+    app.register_listener(_drain, 'after_server_start')
+    if sock is not None:
+        app.run(sock=sock, debug=False, access_log=False)
+    else:
+        app.run(host=ip, port=port, debug=False, access_log=False)
+
+
+class LocalQueue(object):
+    """
+    Hands messages from the job runner straight to an in-process
+    server's event loop, so nothing is copied or serialized.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def put(self, msg, block=True, timeout=None):
+        self.loop.call_soon_threadsafe(_record, *msg)
+
+
+class CallbackThread(Thread):
+    """
+    Runs the callback server on an asyncio loop in a thread of the job
+    runner instead of in its own process.  Messages for the server go
+    through the queue attribute.
+    """
+
+    def __init__(self, out_queue, token, sock, blob_options=None):
+        super().__init__(daemon=True)
+        self.loop = asyncio.new_event_loop()
+        self.queue = LocalQueue(self.loop)
+        self.sock = sock
+        app.config.update({
+            'token': token,
+            'out_q': out_queue,
+            'in_q': None
+        })
+        _init_blob_cache(blob_options)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        # In async mode Sanic doesn't install signal handlers, which only
+        # work in the main thread, or trigger the server listeners.
+        server = self.loop.run_until_complete(
+            app.create_server(sock=self.sock, access_log=False,
+                              return_asyncio_server=True))
+        app.config['out_q'].put(['ready', None, None])
+        self.loop.run_forever()
+        server.close()
+        self.loop.run_until_complete(server.wait_closed())
+        self.loop.close()
+        self.sock.close()
+
+    def kill(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8000)
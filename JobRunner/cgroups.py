@@ -0,0 +1,57 @@
+import os
+
+_CGROUP_ROOT = '/sys/fs/cgroup'
+# Anything this large is the kernel's way of saying "no limit"
+_UNLIMITED = 2 ** 60
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (OSError, IOError):
+        return None
+
+
+def _cpu_limit(root, cgroup):
+    # cgroup v2
+    value = _read(os.path.join(root, cgroup, 'cpu.max'))
+    if value is not None:
+        (quota, period) = value.split()
+        if quota == 'max':
+            return None
+        return float(quota) / float(period)
+    # cgroup v1
+    for ctl in ['cpu', 'cpu,cpuacct']:
+        base = os.path.join(root, ctl, cgroup)
+        quota = _read(os.path.join(base, 'cpu.cfs_quota_us'))
+        period = _read(os.path.join(base, 'cpu.cfs_period_us'))
+        if quota is not None and period is not None:
+            if int(quota) <= 0:
+                return None
+            return float(quota) / float(period)
+    return None
+
+
+def _memory_limit(root, cgroup):
+    value = _read(os.path.join(root, cgroup, 'memory.max'))
+    if value is None:
+        value = _read(os.path.join(root, 'memory', cgroup,
+                                   'memory.limit_in_bytes'))
+    if value is None or value == 'max' or int(value) >= _UNLIMITED:
+        return None
+    return int(value)
+
+
+def get_limits(cgroup, root=_CGROUP_ROOT):
+    """
+    Returns the CPU (in cores) and memory (in bytes) limits of a cgroup.
+    A limit is None if it isn't set or can't be read.
+    """
+    limits = {'cpus': None, 'memory': None}
+    if cgroup is None or cgroup == 'Unknown':
+        return limits
+    cgroup = cgroup.strip().lstrip('/')
+    limits['cpus'] = _cpu_limit(root, cgroup)
+    limits['memory'] = _memory_limit(root, cgroup)
+    return limits
@@ -0,0 +1,151 @@
+import json
+import mmap
+import os
+import struct
+import tempfile
+from multiprocessing import Lock
+from queue import Empty, Full
+from select import select
+from time import sleep as _sleep
+from time import time as _time
+
+# Message types that can cross a channel
+_TYPES = ['submit', 'finished', 'output', 'output_file', 'prov', 'cancel',
+          'ready', 'submit_map', 'shock_url']
+_CODES = dict((t, i) for (i, t) in enumerate(_TYPES))
+# Read and write counters at the start of the mapping
+_HEADER = struct.Struct('=QQ')
+# Length, type and job id length at the start of each message
+_RECORD = struct.Struct('=IBH')
+# Set in the type of a message whose body was written to a file
+_SPILLED = 0x80
+
+
+class Channel(object):
+    """
+    A queue between the JobRunner and the callback server built on a
+    shared memory ring buffer, with a pipe to wake up the reader.
+
+    It has the same put/get interface as multiprocessing.Queue.  Messages
+    are [type, job_id, data] lists where data is JSON, and are encoded
+    directly into the buffer, so there is no feeder thread or pickling.
+    Any number of processes and threads can put, but only one can get.
+    The buffer is shared by forking, so the channel has to be created
+    before the other process is started.
+
+    Messages bigger than a quarter of the buffer are written to a file
+    and only its path goes through the buffer, so no message is too big
+    to send.  A put waits while the buffer is full, so the reader has to
+    keep up.
+    """
+
+    def __init__(self, size=4 * 1024 * 1024, spill_dir=None):
+        self.size = size
+        self.spill_dir = spill_dir
+        self._buf = mmap.mmap(-1, _HEADER.size + size)
+        self._lock = Lock()
+        (self._rfd, self._wfd) = os.pipe()
+        os.set_blocking(self._rfd, False)
+        os.set_blocking(self._wfd, False)
+
+    def _encode(self, msg):
+        (mtype, job_id, data) = msg
+        if mtype not in _CODES:
+            raise ValueError('Unknown message type %s' % (mtype))
+        code = _CODES[mtype]
+        jid = b'' if job_id is None else job_id.encode('utf-8')
+        body = b'' if data is None else json.dumps(data).encode('utf-8')
+        if _RECORD.size + len(jid) + len(body) > self.size // 4:
+            (fd, path) = tempfile.mkstemp(prefix='jobrunner-ipc-',
+                                          dir=self.spill_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(body)
+            body = path.encode('utf-8')
+            code |= _SPILLED
+        head = _RECORD.pack(_RECORD.size + len(jid) + len(body), code,
+                            len(jid))
+        return head + jid + body
+
+    def _decode(self, rec):
+        (_, code, jlen) = _RECORD.unpack_from(rec)
+        start = _RECORD.size
+        job_id = rec[start:start + jlen].decode('utf-8') if jlen else None
+        body = rec[start + jlen:]
+        if code & _SPILLED:
+            path = body.decode('utf-8')
+            with open(path, 'rb') as f:
+                body = f.read()
+            os.unlink(path)
+            code &= ~_SPILLED
+        data = json.loads(body.decode('utf-8')) if body else None
+        return [_TYPES[code], job_id, data]
+
+    def _copy_in(self, pos, data):
+        pos = pos % self.size
+        first = min(len(data), self.size - pos)
+        base = _HEADER.size
+        self._buf[base + pos:base + pos + first] = data[:first]
+        if first < len(data):
+            self._buf[base:base + len(data) - first] = data[first:]
+
+    def _copy_out(self, pos, length):
+        pos = pos % self.size
+        first = min(length, self.size - pos)
+        base = _HEADER.size
+        data = self._buf[base + pos:base + pos + first]
+        if first < length:
+            data += self._buf[base:base + length - first]
+        return data
+
+    def put(self, msg, block=True, timeout=None):
+        rec = self._encode(msg)
+        deadline = None if timeout is None else _time() + timeout
+        while True:
+            with self._lock:
+                (head, tail) = _HEADER.unpack_from(self._buf)
+                if self.size - (tail - head) >= len(rec):
+                    self._copy_in(tail, rec)
+                    _HEADER.pack_into(self._buf, 0, head, tail + len(rec))
+                    break
+            # The reader is behind.  This should be rare, so just poll.
+            if not block or (deadline is not None and _time() > deadline):
+                raise Full()
+            _sleep(0.001)
+        # The reader only sleeps after it has seen an empty buffer, so
+        # it only needs a wakeup when this is the first message.
+        if head == tail:
+            try:
+                os.write(self._wfd, b'\0')
+            except BlockingIOError:
+                # The pipe is full of wakeups already
+                pass
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else _time() + timeout
+        while True:
+            with self._lock:
+                (head, tail) = _HEADER.unpack_from(self._buf)
+                if head != tail:
+                    (length, ) = struct.unpack('=I', self._copy_out(head, 4))
+                    rec = self._copy_out(head, length)
+                    _HEADER.pack_into(self._buf, 0, head + length, tail)
+                    return self._decode(rec)
+            if not block:
+                raise Empty()
+            wait = None
+            if deadline is not None:
+                wait = deadline - _time()
+                if wait <= 0:
+                    raise Empty()
+            select([self._rfd], [], [], wait)
+            try:
+                while os.read(self._rfd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def put_nowait(self, msg):
+        return self.put(msg, block=False)
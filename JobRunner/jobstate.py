@@ -0,0 +1,34 @@
+import json
+import os
+
+# Written to the job's work directory so a new runner can resume the job
+_STATE_FILE = 'jobrunner_state.json'
+
+
+def state_path(workdir):
+    return os.path.join(workdir, _STATE_FILE)
+
+
+def save_state(path, state):
+    """
+    Write the state of a job atomically so a crash can't leave half of it.
+    """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.rename(tmp, path)
+
+
+def load_state(path, job_id):
+    """
+    Returns the saved state of a job, or None if there isn't any for the
+    job or it can't be read.
+    """
+    try:
+        with open(path) as f:
+            state = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(state, dict) or state.get('job_id') != job_id:
+        return None
+    return state
@@ -0,0 +1,149 @@
+import codecs
+import re
+
+_CHUNK = 1024 * 1024
+_MAX_KEY = 256
+# The longest number or literal that may be left over at a chunk boundary
+_MAX_LITERAL = 1024
+_WS = re.compile(r'[ \t\n\r]*')
+# A number or a literal, including the ones Python's json module writes
+_LIT = (r'-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?'
+        r'|true|false|null|NaN|Infinity|-Infinity')
+_LITERAL = re.compile(_LIT)
+# Where a number or literal ends
+_TOKEN = re.compile(r'[^ \t\n\r,\]}]*')
+# The body of a string, starting after its opening quote.  It stops at
+# the closing quote, a bad character or an escape cut off by the chunk.
+_STR = (r'[^"\\\x00-\x1f]*'
+        r'(?:\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})[^"\\\x00-\x1f]*)*')
+_STRING = re.compile(_STR)
+# Runs of scalar values in nested arrays and objects are checked in one
+# match, which keeps long lists of numbers or strings fast.
+_SCALAR = r'(?:"%s"|%s)' % (_STR, _LIT)
+_ARRAY_RUN = re.compile(r'(?:[ \t\n\r]*%s[ \t\n\r]*,)*' % (_SCALAR))
+_OBJECT_RUN = re.compile(
+    r'(?:[ \t\n\r]*"%s"[ \t\n\r]*:[ \t\n\r]*%s[ \t\n\r]*,)*' % (_STR, _SCALAR))
+_CLOSE = {'{': '}', '[': ']'}
+
+
+def scan_output(path, chunk_size=_CHUNK):
+    """
+    Check that a file holds a single valid JSON object without loading it.
+
+    The file is read in chunks and checked as it goes, so it accepts what
+    json.load would.  Returns a dict with the size, the top-level keys and
+    whether the object is empty.  Raises ValueError if the file isn't a
+    JSON object.
+    """
+    stack = []
+    # What may come next: start, key, first_key (a key or '}'), colon,
+    # value, first_value (a value or ']'), next (',' or a close) or end
+    expect = 'start'
+    in_string = False
+    key = None
+    keys = []
+    size = 0
+    buf = ''
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            size += len(data)
+            final = not data
+            buf += decoder.decode(data, final=final)
+            pos = 0
+            n = len(buf)
+            while pos < n:
+                if in_string:
+                    end = _STRING.match(buf, pos).end()
+                    if key is not None and len(key) < _MAX_KEY:
+                        key.append(buf[pos:end])
+                    pos = end
+                    if pos == n:
+                        break
+                    if buf[pos] == '"':
+                        in_string = False
+                        pos += 1
+                        if key is not None:
+                            keys.append(''.join(key)[:_MAX_KEY])
+                            key = None
+                        continue
+                    if not final and buf[pos] == '\\' and n - pos < 6:
+                        # The escape continues in the next chunk
+                        break
+                    raise ValueError('Invalid string in output')
+                pos = _WS.match(buf, pos).end()
+                if pos == n:
+                    break
+                c = buf[pos]
+                if expect == 'end':
+                    raise ValueError('Extra data after the output object')
+                if expect == 'start':
+                    if c != '{':
+                        raise ValueError('Output is not a JSON object')
+                    stack.append('}')
+                    expect = 'first_key'
+                    pos += 1
+                    continue
+                if len(stack) > 1:
+                    if stack[-1] == ']' and expect in ('value', 'first_value'):
+                        end = _ARRAY_RUN.match(buf, pos).end()
+                        if end > pos:
+                            pos = end
+                            expect = 'value'
+                            continue
+                    elif stack[-1] == '}' and expect in ('key', 'first_key'):
+                        end = _OBJECT_RUN.match(buf, pos).end()
+                        if end > pos:
+                            pos = end
+                            expect = 'key'
+                            continue
+                if c == '"':
+                    if expect in ('key', 'first_key'):
+                        if len(stack) == 1:
+                            key = []
+                        expect = 'colon'
+                    elif expect in ('value', 'first_value'):
+                        expect = 'next'
+                    else:
+                        raise ValueError('Unexpected string in output')
+                    in_string = True
+                    pos += 1
+                elif c == ':':
+                    if expect != 'colon':
+                        raise ValueError("Unexpected ':' in output")
+                    expect = 'value'
+                    pos += 1
+                elif c == ',':
+                    if expect != 'next':
+                        raise ValueError("Unexpected ',' in output")
+                    expect = 'key' if stack[-1] == '}' else 'value'
+                    pos += 1
+                elif c == '}' or c == ']':
+                    first = 'first_key' if c == '}' else 'first_value'
+                    if stack[-1] != c or expect not in ('next', first):
+                        raise ValueError('Mismatched brackets in output')
+                    stack.pop()
+                    expect = 'next' if stack else 'end'
+                    pos += 1
+                elif expect not in ('value', 'first_value'):
+                    raise ValueError('Unexpected %r in output' % (c))
+                elif c in _CLOSE:
+                    stack.append(_CLOSE[c])
+                    expect = 'first_key' if c == '{' else 'first_value'
+                    pos += 1
+                else:
+                    end = _TOKEN.match(buf, pos).end()
+                    if end == n and not final and n - pos <= _MAX_LITERAL:
+                        # The value may continue in the next chunk
+                        break
+                    if _LITERAL.fullmatch(buf, pos, end) is None:
+                        raise ValueError('Invalid value in output')
+                    pos = end
+                    expect = 'next'
+            buf = buf[pos:]
+            if final:
+                break
+    if expect != 'end' or in_string:
+        raise ValueError('Output is truncated')
+    return {'size': size, 'keys': keys, 'empty': len(keys) == 0}
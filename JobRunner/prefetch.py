@@ -0,0 +1,45 @@
+import sys
+from clients.CatalogClient import Catalog
+
+
+class _PrintLogger(object):
+    def log(self, line):
+        print(line)
+
+    def error(self, line):
+        print(line, file=sys.stderr)
+
+
+def _get_runner(runtime, logger):
+    if runtime == 'shifter':
+        from .ShifterRunner import ShifterRunner
+        return ShifterRunner(logger=logger, stats_interval=0)
+    from .DockerRunner import DockerRunner
+    return DockerRunner(logger=logger, stats_interval=0)
+
+
+def prefetch_images(catalog_url, modules, runtime='docker', runner=None):
+    """
+    Pull the images for a list of modules before any jobs need them.
+    Each module is a name, or name:version where version is a release
+    tag (release, beta or dev), a semantic version or a commit hash.
+    Returns the modules that failed.
+    """
+    logger = _PrintLogger()
+    catalog = Catalog(catalog_url)
+    if runner is None:
+        runner = _get_runner(runtime, logger)
+    failed = []
+    for item in modules:
+        (module, _, version) = item.partition(':')
+        req = {'module_name': module}
+        if version:
+            req['version'] = version
+        try:
+            image = catalog.get_module_version(req)['docker_img_name']
+            runner.get_image(image)
+            logger.log("Prefetched {} for {}".format(image, item))
+        except Exception as e:
+            logger.error("Failed to prefetch {}: {}".format(item, e))
+            failed.append(item)
+    return failed
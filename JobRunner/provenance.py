@@ -26,5 +26,12 @@ class Provenance(object):
             action = data
             self.prov['subactions'].append(action)
 
+    def restore(self, prov):
+        """
+        Pick up the provenance saved by an earlier run of the job.
+        """
+        self.prov = prov
+        self.actions = dict((a['name'], a) for a in prov['subactions'])
+
     def get_prov(self):
         return [self.prov]
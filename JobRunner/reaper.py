@@ -0,0 +1,105 @@
+import fcntl
+import os
+from time import time as _time
+from concurrent.futures import ThreadPoolExecutor
+
+# Each running job runner holds a lock on a file here named by its job
+_LOCK_DIR = '/tmp/jobrunner-locks'
+
+
+def _lock_path(lock_dir, job_id):
+    return os.path.join(lock_dir, '%s.lock' % (job_id))
+
+
+def hold_lock(job_id, lock_dir=_LOCK_DIR, grace=0):
+    """
+    Mark a job runner as alive for as long as the returned file is open.
+    A runner that can be resumed gives the seconds its containers are kept
+    after its last touch of the file, which is written in the file.
+    """
+    if not os.path.exists(lock_dir):
+        os.makedirs(lock_dir, exist_ok=True)
+    f = open(_lock_path(lock_dir, job_id), 'a')
+    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    f.truncate(0)
+    if grace:
+        f.write('%d\n' % (grace))
+        f.flush()
+    return f
+
+
+def release_lock(f):
+    os.unlink(f.name)
+    f.close()
+
+
+def _is_dead(lock_dir, job_id):
+    # Only a lock file that is left but not locked shows the runner died.
+    # A job without one may have a runner that uses another lock
+    # directory (or a private /tmp) or doesn't take a lock at all.
+    try:
+        with open(_lock_path(lock_dir, job_id)) as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            grace = f.read().strip()
+            mtime = os.fstat(f.fileno()).st_mtime
+    except OSError:
+        return False
+    # A runner that can be resumed keeps touching its lock file, and a
+    # new runner may still pick up its containers
+    try:
+        grace = int(grace or 0)
+    except ValueError:
+        grace = 0
+    return _time() - mtime >= grace
+
+
+def _remove_lock(lock_dir, job_id):
+    # Only remove the file if nothing has locked it since
+    try:
+        with open(_lock_path(lock_dir, job_id), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.unlink(f.name)
+    except OSError:
+        pass
+
+
+def _owner(labels):
+    # Subjob containers belong to the main job's runner
+    return labels.get('parent_job_id') or labels.get('job_id')
+
+
+def reap_orphans(client, lock_dir=_LOCK_DIR, logger=None):
+    """
+    Kill and remove the job containers on the node whose job runner is
+    gone, i.e. their job's lock file is left but nothing holds the lock.
+    A resumable job is left for a new runner until the grace in its lock
+    file has passed.  Returns the ids of the jobs that were reaped.
+    """
+    containers = client.containers.list(all=True,
+                                        filters={'label': 'job_id'})
+    orphans = dict()
+    dead = dict()
+    for c in containers:
+        owner = _owner(c.labels)
+        if owner not in dead:
+            dead[owner] = _is_dead(lock_dir, owner)
+        if dead[owner]:
+            orphans.setdefault(owner, []).append(c)
+    if len(orphans) == 0:
+        return []
+
+    def _remove(c):
+        try:
+            c.remove(force=True)
+        except Exception:
+            pass
+
+    doomed = [c for items in orphans.values() for c in items]
+    with ThreadPoolExecutor(max_workers=min(32, len(doomed))) as pool:
+        list(pool.map(_remove, doomed))
+    for owner in orphans:
+        _remove_lock(lock_dir, owner)
+    if logger is not None:
+        fstr = "Removed {} orphaned containers from jobs {}"
+        logger.log(fstr.format(len(doomed), ', '.join(sorted(orphans))))
+    return sorted(orphans)
@@ -0,0 +1,63 @@
+from threading import Lock
+from time import time as _time
+
+# How long (in seconds) a catalog module lookup is reused across jobs
+_MODULE_TTL = 300
+
+
+class SharedResources(object):
+    """
+    Clients and caches that are shared by all of the jobs run by a node
+    daemon.  Everything here has to be safe to use from several job
+    threads at once.
+    """
+
+    def __init__(self, module_ttl=_MODULE_TTL):
+        self.lock = Lock()
+        self.module_ttl = module_ttl
+        self._docker = None
+        self._auth = dict()
+        self._njs = dict()
+        # Image name to id for images known to be on the node
+        self.images = dict()
+        # (module, version) to (lookup time, module info)
+        self.modules = dict()
+        # Declared resources of each module.method
+        self.resources = dict()
+
+    @property
+    def docker(self):
+        with self.lock:
+            if self._docker is None:
+                import docker
+                self._docker = docker.from_env()
+            return self._docker
+
+    def get_auth(self, url):
+        with self.lock:
+            if url not in self._auth:
+                from clients.authclient import KBaseAuth
+                self._auth[url] = KBaseAuth(url)
+            return self._auth[url]
+
+    def get_njs(self, url):
+        with self.lock:
+            if url not in self._njs:
+                from clients.NarrativeJobServiceClient import \
+                    NarrativeJobService
+                self._njs[url] = NarrativeJobService(url=url)
+            return self._njs[url]
+
+    def get_module(self, module, version):
+        """
+        Returns a copy of a recent module lookup or None.
+        """
+        with self.lock:
+            entry = self.modules.get((module, version))
+        if entry is None or _time() - entry[0] > self.module_ttl:
+            return None
+        return dict(entry[1])
+
+    def add_module(self, module, version, module_info):
+        with self.lock:
+            self.modules[(module, version)] = (_time(), dict(module_info))
@@ -0,0 +1,128 @@
+import os
+from time import time as _time
+
+_CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+class Usage(object):
+    """
+    Aggregates resource usage samples for one job.
+
+    CPU time and block I/O are cumulative counters, so the largest value
+    seen is kept.  Memory is kept as the peak RSS.
+    """
+
+    def __init__(self):
+        self.start = _time()
+        self.end = None
+        self.cpu_seconds = 0.0
+        self.max_rss = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+        self.samples = 0
+
+    def update(self, cpu_seconds=0, rss=0, read_bytes=0, write_bytes=0):
+        self.cpu_seconds = max(self.cpu_seconds, cpu_seconds)
+        self.max_rss = max(self.max_rss, rss)
+        self.read_bytes = max(self.read_bytes, read_bytes)
+        self.write_bytes = max(self.write_bytes, write_bytes)
+        self.samples += 1
+
+    def finish(self):
+        if self.end is None:
+            self.end = _time()
+
+    def summary(self):
+        end = self.end if self.end is not None else _time()
+        return {
+            'wall_seconds': round(end - self.start, 3),
+            'cpu_seconds': round(self.cpu_seconds, 3),
+            'max_rss_bytes': self.max_rss,
+            'blkio_read_bytes': self.read_bytes,
+            'blkio_write_bytes': self.write_bytes,
+            'samples': self.samples
+        }
+
+
+def docker_stats_usage(stats):
+    """
+    Convert a Docker stats sample to Usage.update arguments.
+    """
+    cpu = stats.get('cpu_stats', {}).get('cpu_usage', {})
+    mem = stats.get('memory_stats', {})
+    read_bytes = 0
+    write_bytes = 0
+    blkio = stats.get('blkio_stats', {}).get('io_service_bytes_recursive')
+    for item in blkio or []:
+        if item.get('op', '').lower() == 'read':
+            read_bytes += item.get('value', 0)
+        elif item.get('op', '').lower() == 'write':
+            write_bytes += item.get('value', 0)
+    return {
+        'cpu_seconds': cpu.get('total_usage', 0) / 1e9,
+        'rss': max(mem.get('max_usage', 0), mem.get('usage', 0)),
+        'read_bytes': read_bytes,
+        'write_bytes': write_bytes
+    }
+
+
+def _children(proc):
+    # Map of parent pid to child pids for all visible processes
+    children = dict()
+    for pid in os.listdir(proc):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join(proc, pid, 'stat')) as f:
+                stat = f.read()
+        except (OSError, IOError):
+            continue
+        ppid = int(stat[stat.rfind(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(pid))
+    return children
+
+
+def _proc_usage(proc, pid):
+    cpu = 0.0
+    rss = 0
+    read_bytes = 0
+    write_bytes = 0
+    try:
+        with open(os.path.join(proc, str(pid), 'stat')) as f:
+            stat = f.read()
+        fields = stat[stat.rfind(')') + 2:].split()
+        # utime, stime, cutime, cstime
+        cpu = sum(int(x) for x in fields[11:15]) / float(_CLK_TCK)
+        with open(os.path.join(proc, str(pid), 'status')) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+        with open(os.path.join(proc, str(pid), 'io')) as f:
+            for line in f:
+                if line.startswith('read_bytes:'):
+                    read_bytes = int(line.split()[1])
+                elif line.startswith('write_bytes:'):
+                    write_bytes = int(line.split()[1])
+    except (OSError, IOError, ValueError, IndexError):
+        pass
+    return (cpu, rss, read_bytes, write_bytes)
+
+
+def proc_tree_usage(pid, proc='/proc'):
+    """
+    Sum the usage of a process and all its descendants from /proc.
+    """
+    children = _children(proc)
+    todo = [pid]
+    total = [0.0, 0, 0, 0]
+    while len(todo) > 0:
+        p = todo.pop()
+        for (i, value) in enumerate(_proc_usage(proc, p)):
+            total[i] += value
+        todo.extend(children.get(p, []))
+    return {
+        'cpu_seconds': total[0],
+        'rss': total[1],
+        'read_bytes': total[2],
+        'write_bytes': total[3]
+    }
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Compare the JobRunner IPC channel with multiprocessing.Queue.
+
+Throughput: a child process sends a burst of subjob submit messages.
+Latency: a message is bounced between two processes and the round trip
+is timed.
+
+Usage: python bench/bench_ipc.py [messages]
+"""
+import os
+import sys
+from multiprocessing import Process, Queue
+from statistics import median
+from time import time as _time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from JobRunner.ipc import Channel  # noqa: E402
+
+_SUBMIT = {
+    'method': 'RunTester.run_RunTester',
+    'params': [{'depth': 3, 'size': 1000, 'parallel': 5}],
+    'service_ver': 'beta',
+    'parent_job_id': '5d0b9d3de4b0b4ab52a7a0b1'
+}
+
+
+def _producer(q, count):
+    for i in range(count):
+        q.put(['submit', 'job-%d' % (i), _SUBMIT])
+    q.put(['cancel', None, None])
+
+
+def _echo(inq, outq, count):
+    for i in range(count):
+        outq.put(inq.get())
+
+
+def throughput(make, count):
+    q = make()
+    p = Process(target=_producer, args=[q, count])
+    start = _time()
+    p.start()
+    while q.get()[0] != 'cancel':
+        pass
+    elapsed = _time() - start
+    p.join()
+    return count / elapsed
+
+
+def latency(make, count):
+    (inq, outq) = (make(), make())
+    p = Process(target=_echo, args=[inq, outq, count])
+    p.start()
+    times = []
+    for i in range(count):
+        start = _time()
+        inq.put(['finished', 'job-%d' % (i), None])
+        outq.get()
+        times.append(_time() - start)
+    p.join()
+    return median(times) * 1e6
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    for (name, make) in [('multiprocessing.Queue', Queue),
+                         ('Channel', Channel)]:
+        rate = throughput(make, count)
+        rtt = latency(make, min(count, 2000))
+        print('%-22s %9.0f msgs/s  %7.1f us median round trip' %
+              (name, rate, rtt))
+
+
+if __name__ == '__main__':
+    main()
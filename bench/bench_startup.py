@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Measure the time from interpreter start to the first RPC a job runner makes.
+
+A stand-in NJS service is started on localhost.  It records when the first
+request arrives and reports the job as already finished so the runner exits
+right after startup.
+
+Usage: python bench/bench_startup.py [runs] [docker|shifter]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from statistics import median
+from threading import Event, Thread
+from time import time as _time
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class _StubNJS(BaseHTTPRequestHandler):
+    first_rpc = None
+    seen = Event()
+
+    def do_POST(self):
+        if _StubNJS.first_rpc is None:
+            _StubNJS.first_rpc = _time()
+            _StubNJS.seen.set()
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        method = json.loads(body)['method']
+        result = [None]
+        if method.endswith('check_job_canceled'):
+            result = [{'finished': True}]
+        resp = json.dumps({'version': '1.1', 'result': result}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(resp)))
+        self.end_headers()
+        self.wfile.write(resp)
+
+    def log_message(self, *args):
+        pass
+
+
+def _run_once(url, runtime, workdir):
+    env = dict(os.environ)
+    env.update({
+        'KB_AUTH_TOKEN': 'bogus',
+        'KB_ADMIN_AUTH_TOKEN': 'bogus',
+        'CALLBACK_IP': '127.0.0.1',
+        'JOB_DIR': workdir,
+        'PYTHONPATH': _ROOT
+    })
+    if runtime == 'shifter':
+        env['USE_SHIFTER'] = '1'
+    _StubNJS.first_rpc = None
+    _StubNJS.seen.clear()
+    start = _time()
+    proc = subprocess.Popen([sys.executable, 'jobrunner.py', '1234', url],
+                            cwd=_ROOT, env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    _StubNJS.seen.wait(60)
+    proc.wait()
+    if _StubNJS.first_rpc is None:
+        raise RuntimeError('The runner never made an RPC')
+    return _StubNJS.first_rpc - start
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    runtime = sys.argv[2] if len(sys.argv) > 2 else 'shifter'
+    server = HTTPServer(('127.0.0.1', 0), _StubNJS)
+    Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d/services/njs_wrapper' % (server.server_port)
+    workdir = tempfile.mkdtemp()
+    times = [_run_once(url, runtime, workdir) for _ in range(runs)]
+    server.shutdown()
+    print('startup to first RPC (%s, %d runs): min %.3fs median %.3fs '
+          'max %.3fs' % (runtime, runs, min(times), median(times),
+                         max(times)))
+
+
+if __name__ == '__main__':
+    main()
@@ -12,9 +12,13 @@ import requests as _requests
 import random as _random
 import os as _os
 import traceback as _traceback
+import threading as _threading
 from requests.exceptions import ConnectionError
 from urllib3.exceptions import ProtocolError
 
+# Connections are pooled across all clients in the process
+_session = _requests.Session()
+
 try:
     from configparser import ConfigParser as _ConfigParser  # py 3
 except ImportError:
@@ -30,6 +34,13 @@ _CT = 'content-type'
 _AJ = 'application/json'
 _URL_SCHEME = frozenset(['http', 'https'])
 _CHECK_JOB_RETRYS = 3
+# Service Wizard lookups are shared by all clients in the process.  Once
+# an entry is older than the TTL (in seconds) it is still used while it
+# is looked up again in the background.
+_SERVICE_URL_TTL = 300
+_service_urls = dict()
+_service_urls_lock = _threading.Lock()
+_refreshing = set()
 
 
 def _get_token(user_id, password, auth_svc):
@@ -176,7 +187,7 @@ class BaseClient(object):
             arg_hash['context'] = context
 
         body = _json.dumps(arg_hash, cls=_JSONObjectEncoder)
-        ret = _requests.post(url, data=body, headers=self._headers,
+        ret = _session.post(url, data=body, headers=self._headers,
                              timeout=self.timeout,
                              verify=not self.trust_all_ssl_certificates)
         ret.encoding = 'utf-8'
@@ -200,14 +211,49 @@ class BaseClient(object):
             return resp['result'][0]
         return resp['result']
 
+    def _lookup_service_url(self, key):
+        _, service, service_version = key
+        service_status_ret = self._call(
+            self.url, 'ServiceWizard.get_service_status',
+            [{'module_name': service, 'version': service_version}])
+        url = service_status_ret['url']
+        with _service_urls_lock:
+            _service_urls[key] = (time.time(), url)
+        return url
+
+    def _refresh_service_url(self, key):
+        try:
+            self._lookup_service_url(key)
+        except Exception:
+            # Keep using the old URL until a call to it fails
+            pass
+        finally:
+            with _service_urls_lock:
+                _refreshing.discard(key)
+
     def _get_service_url(self, service_method, service_version):
         if not self.lookup_url:
             return self.url
         service, _ = service_method.split('.')
-        service_status_ret = self._call(
-            self.url, 'ServiceWizard.get_service_status',
-            [{'module_name': service, 'version': service_version}])
-        return service_status_ret['url']
+        key = (self.url, service, service_version)
+        with _service_urls_lock:
+            entry = _service_urls.get(key)
+            stale = entry is not None and \
+                time.time() - entry[0] > _SERVICE_URL_TTL and \
+                key not in _refreshing
+            if stale:
+                _refreshing.add(key)
+        if entry is None:
+            return self._lookup_service_url(key)
+        if stale:
+            _threading.Thread(target=self._refresh_service_url, args=[key],
+                              daemon=True).start()
+        return entry[1]
+
+    def _forget_service_url(self, service_method, service_version):
+        service, _ = service_method.split('.')
+        with _service_urls_lock:
+            _service_urls.pop((self.url, service, service_version), None)
 
     def _set_up_context(self, service_ver=None, context=None):
         if service_ver:
@@ -226,6 +272,16 @@ class BaseClient(object):
         return self._call(self.url, mod + '._' + meth + '_submit',
                           args, context)
 
+    def _check_jobs(self, service, job_ids):
+        return self._call(self.url, service + '._check_jobs', [job_ids])
+
+    def _submit_map(self, service_method, args_list, service_ver=None,
+                    context=None):
+        context = self._set_up_context(service_ver, context)
+        mod, meth = service_method.split('.')
+        return self._call(self.url, mod + '._' + meth + '_map',
+                          args_list, context)
+
     def run_job(self, service_method, args, service_ver=None, context=None):
         '''
         Run a SDK method asynchronously.
@@ -265,6 +321,65 @@ class BaseClient(object):
         raise RuntimeError("_check_job failed {} times and exceeded limit".format(
             check_job_failures))
 
+    def run_jobs(self, service_method, args_list, service_ver=None,
+                 context=None):
+        '''
+        Run a SDK method asynchronously once for each list of arguments.
+        The jobs are submitted in one call and their results are returned
+        in the same order.
+        Required arguments:
+        service_method - the service and method to run, e.g. myserv.mymeth.
+        args_list - a list of the lists of arguments to the method.
+        Optional arguments:
+        service_ver - the version of the service to run, e.g. a git hash
+            or dev/beta/release.
+        context - the rpc context dict.
+        '''
+        mod, _ = service_method.split('.')
+        job_ids = self._submit_map(service_method, args_list, service_ver,
+                                   context)
+        results = [None] * len(job_ids)
+        pending = dict((job_id, i) for (i, job_id) in enumerate(job_ids))
+        async_job_check_time = self.async_job_check_time
+        check_job_failures = 0
+        while check_job_failures < _CHECK_JOB_RETRYS:
+            if not pending:
+                return results
+            time.sleep(async_job_check_time)
+            async_job_check_time = (async_job_check_time *
+                                    self.async_job_check_time_scale_percent /
+                                    100.0)
+            if async_job_check_time > self.async_job_check_max_time:
+                async_job_check_time = self.async_job_check_max_time
+
+            ids = list(pending)
+            try:
+                job_states = self._check_jobs(mod, ids)
+            except (ConnectionError, ProtocolError):
+                _traceback.print_exc()
+                check_job_failures += 1
+                continue
+
+            for (job_id, job_state) in zip(ids, job_states):
+                if not job_state['finished']:
+                    continue
+                if 'error' in job_state:
+                    err = job_state['error']
+                    if not isinstance(err, dict):
+                        err = {'message': str(err)}
+                    raise ServerError(err.get('name', 'Unknown'),
+                                      err.get('code', 0),
+                                      err.get('message', ''),
+                                      error=err.get('error'))
+                result = job_state.get('result')
+                if not result:
+                    result = None
+                elif len(result) == 1:
+                    result = result[0]
+                results[pending.pop(job_id)] = result
+        raise RuntimeError("_check_jobs failed {} times and exceeded limit".format(
+            check_job_failures))
+
     def call_method(self, service_method, args, service_ver=None,
                     context=None):
         '''
@@ -279,4 +394,10 @@ class BaseClient(object):
         '''
         url = self._get_service_url(service_method, service_ver)
         context = self._set_up_context(service_ver, context)
-        return self._call(url, service_method, args, context)
+        try:
+            return self._call(url, service_method, args, context)
+        except ConnectionError:
+            # The service may have moved, so look it up again next time
+            if self.lookup_url:
+                self._forget_service_url(service_method, service_ver)
+            raise
@@ -2,10 +2,11 @@
 
 import sys
 import os
-from JobRunner.JobRunner import JobRunner
 
 _TOKEN_ENV = "KB_AUTH_TOKEN"
 _ADMIN_TOKEN_ENV = "KB_ADMIN_AUTH_TOKEN"
+_DAEMON_ENV = "JOBRUNNER_DAEMON"
+_DAEMON_SOCKET = "/tmp/jobrunner.sock"
 
 
 def _get_token():
@@ -34,14 +35,7 @@ def _get_admin_token():
     return admin_token
 
 
-def main():
-    # Input job id and njs_service URL
-    if len(sys.argv) == 3:
-        job_id = sys.argv[1]
-        njs_url = sys.argv[2]
-    else:
-        print("Incorrect usage")
-        sys.exit(1)
+def _get_config(njs_url):
     config = {}
     config['workdir'] = os.environ.get("JOB_DIR", '/tmp/')
     if not os.path.exists(config['workdir']):
@@ -51,12 +45,150 @@ def main():
     config['auth-service-url'] = njs_url.replace('njs_wrapper', auth_ext)
     if 'USE_SHIFTER' in os.environ:
         config['runtime'] = 'shifter'
+    if 'CALLBACK_IN_PROCESS' in os.environ:
+        config['callback_server'] = 'thread'
+    if 'JOBRUNNER_RESUME' in os.environ:
+        config['resume'] = True
+    if 'CGROUP_PARENT' in os.environ:
+        config['cgroup_parent'] = True
+    # Optional subjob and container limits (memory is in MB), the
+    # resource usage sampling interval in seconds (0 disables it) and the
+    # maximum job output size in bytes, the most warm containers to keep
+    # for each subjob image, the fraction of the disk images can fill
+    # before unused ones are removed, and a node-wide file to cache
+    # Shifter image lookups in, where running jobs hold their locks, and
+    # the modules whose subjob results are cached (comma separated), where
+    # and in how many bytes, the modules whose identical concurrent
+    # subjobs share one run, local disk to stage reference data on and how
+    # many bytes of it to use, whether (or where) to mount a scratch
+    # directory shared by the job and its subjobs, where to cache Shock
+    # downloads for the node and in how many bytes, and 'channel' to pass
+    # callback messages over shared memory instead of a queue
+    for (env, key) in [('MAX_SUBJOBS', 'max_subjobs'),
+                       ('MAX_SUBJOB_CPUS', 'max_subjob_cpus'),
+                       ('MAX_SUBJOB_MEMORY', 'max_subjob_memory'),
+                       ('CONTAINER_PIDS_LIMIT', 'container_pids_limit'),
+                       ('STATS_INTERVAL', 'stats_interval'),
+                       ('MAX_OUTPUT_SIZE', 'max_output_size'),
+                       ('WARM_POOL', 'warm_pool'),
+                       ('IMAGE_GC_THRESHOLD', 'image_gc_threshold'),
+                       ('IMAGE_STATE_FILE', 'image_state_file'),
+                       ('SHIFTER_IMAGE_CACHE', 'shifter_image_cache'),
+                       ('JOBRUNNER_LOCK_DIR', 'lock_dir'),
+                       ('RESULT_CACHE_MODULES', 'result_cache_modules'),
+                       ('RESULT_CACHE_DIR', 'result_cache_dir'),
+                       ('RESULT_CACHE_SIZE', 'result_cache_size'),
+                       ('SINGLE_FLIGHT_MODULES', 'single_flight_modules'),
+                       ('REFDATA_LOCAL_DIR', 'refdata_local_dir'),
+                       ('REFDATA_LOCAL_SIZE', 'refdata_local_size'),
+                       ('SHARED_SCRATCH', 'shared_scratch'),
+                       ('SHOCK_CACHE_DIR', 'shock_cache_dir'),
+                       ('SHOCK_CACHE_SIZE', 'shock_cache_size'),
+                       ('JOBRUNNER_IPC', 'ipc')]:
+        if env in os.environ:
+            config[key] = os.environ[env]
+    return config
+
+
+def _run_daemon(path):
+    from JobRunner.JobDaemon import JobDaemon
+    import signal
+    daemon = JobDaemon(path)
+    daemon.start()
+
+    def _stop(sig, bt):
+        daemon.stop()
+
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+    print("Job daemon listening on %s" % (path))
+    daemon.serve()
+
+
+def _hand_off(path, job_id, njs_url, token, at, config):
+    # Returns False if there is no daemon to take the job
+    from JobRunner.JobDaemon import submit_job
+    try:
+        resp = submit_job(path, job_id, njs_url, token, at, config)
+    except OSError:
+        print("No job daemon at %s.  Running the job here." % (path))
+        return False
+    if 'error' in resp:
+        print("An unhandled error was encountered")
+        print(resp['error'])
+    if resp.get('exit_code'):
+        sys.exit(resp['exit_code'])
+    return True
+
+
+def _prefetch(njs_url, modules):
+    from JobRunner.prefetch import prefetch_images
+    runtime = 'shifter' if 'USE_SHIFTER' in os.environ else 'docker'
+    catalog_url = njs_url.replace('njs_wrapper', 'catalog')
+    if prefetch_images(catalog_url, modules, runtime=runtime):
+        sys.exit(1)
+
+
+def _gc(threshold):
+    import docker
+    from JobRunner.ImageRetention import ImageRetention
+    kwargs = {}
+    if 'IMAGE_STATE_FILE' in os.environ:
+        kwargs['state_file'] = os.environ['IMAGE_STATE_FILE']
+    retention = ImageRetention(docker.from_env(), threshold, **kwargs)
+    for image in retention.collect():
+        print("Removed %s" % (image))
+
+
+def _reap():
+    import docker
+    from JobRunner.reaper import reap_orphans
+    kwargs = {}
+    if 'JOBRUNNER_LOCK_DIR' in os.environ:
+        kwargs['lock_dir'] = os.environ['JOBRUNNER_LOCK_DIR']
+    for job_id in reap_orphans(docker.from_env(), **kwargs):
+        print("Removed the orphaned containers of %s" % (job_id))
+
+
+def main():
+    # Run a node daemon that jobs can be handed to
+    if len(sys.argv) in [2, 3] and sys.argv[1] == 'daemon':
+        path = sys.argv[2] if len(sys.argv) == 3 else _DAEMON_SOCKET
+        _run_daemon(path)
+        return
+    # Pull the images for modules (name or name:version) ahead of jobs
+    if len(sys.argv) > 3 and sys.argv[1] == 'prefetch':
+        _prefetch(sys.argv[2], sys.argv[3:])
+        return
+    # Remove containers whose job runner is gone
+    if len(sys.argv) == 2 and sys.argv[1] == 'reap':
+        _reap()
+        return
+    # Remove old images until the disk is below a fraction full
+    if len(sys.argv) in [2, 3] and sys.argv[1] == 'gc':
+        threshold = os.environ.get('IMAGE_GC_THRESHOLD', '0.8')
+        _gc(sys.argv[2] if len(sys.argv) == 3 else threshold)
+        return
+    # Input job id and njs_service URL
+    if len(sys.argv) == 3:
+        job_id = sys.argv[1]
+        njs_url = sys.argv[2]
+    else:
+        print("Incorrect usage")
+        sys.exit(1)
+    config = _get_config(njs_url)
 
     token = _get_token()
     at = _get_admin_token()
-    if not os.path.exists(config['workdir']):
-        os.makedirs(config['workdir'])
 
+    # Hand the job to a node daemon if one is configured
+    if _DAEMON_ENV in os.environ:
+        path = os.environ[_DAEMON_ENV] or _DAEMON_SOCKET
+        if _hand_off(path, job_id, njs_url, token, at, config):
+            return
+
+    # Imported here so usage errors don't pay for loading the runner
+    from JobRunner.JobRunner import JobRunner
     try:
         jr = JobRunner(config, njs_url, job_id, token, at)
         jr.run()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+import unittest
+from time import sleep
+from unittest.mock import patch
+from mock import MagicMock
+from requests.exceptions import ConnectionError
+
+from clients import baseclient
+from clients.baseclient import BaseClient
+
+_WIZARD = 'http://wizard/services/service_wizard'
+
+
+class BaseClientTest(unittest.TestCase):
+
+    def setUp(self):
+        baseclient._service_urls.clear()
+
+    def _client(self, urls):
+        bc = BaseClient(url=_WIZARD, token='bogus', lookup_url=True)
+        bc._call = MagicMock()
+
+        def _call(url, method, params, context=None):
+            if method == 'ServiceWizard.get_service_status':
+                return {'url': urls.pop(0)}
+            if url == 'http://gone':
+                raise ConnectionError('Connection refused')
+            return url
+
+        bc._call.side_effect = _call
+        return bc
+
+    def _lookups(self, bc):
+        return [c for c in bc._call.call_args_list
+                if c[0][1] == 'ServiceWizard.get_service_status']
+
+    def test_cached_lookup(self):
+        bc = self._client(['http://a', 'http://b'])
+        self.assertEqual(bc.call_method('Mod.meth', [], 'dev'), 'http://a')
+        # Other clients in the process share the lookup
+        bc2 = self._client([])
+        bc2._call.side_effect = bc._call.side_effect
+        self.assertEqual(bc2.call_method('Mod.meth', [], 'dev'), 'http://a')
+        self.assertEqual(len(self._lookups(bc)), 1)
+        # Another version is another service
+        self.assertEqual(bc.call_method('Mod.meth', [], 'beta'), 'http://b')
+
+    @patch('clients.baseclient._SERVICE_URL_TTL', 0)
+    def test_stale_refresh(self):
+        bc = self._client(['http://a', 'http://b'])
+        self.assertEqual(bc.call_method('Mod.meth', [], 'dev'), 'http://a')
+        sleep(0.01)
+        # The stale URL is used while it is looked up again
+        self.assertEqual(bc.call_method('Mod.meth', [], 'dev'), 'http://a')
+        for i in range(50):
+            if len(baseclient._refreshing) == 0:
+                break
+            sleep(0.01)
+        self.assertEqual(len(self._lookups(bc)), 2)
+        self.assertEqual(bc.call_method('Mod.meth', [], 'dev'), 'http://b')
+
+    def test_invalidate(self):
+        bc = self._client(['http://gone', 'http://new'])
+        with self.assertRaises(ConnectionError):
+            bc.call_method('Mod.meth', [], 'dev')
+        self.assertEqual(bc.call_method('Mod.meth', [], 'dev'), 'http://new')
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import unittest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from queue import Queue
+from tempfile import mkdtemp
+from threading import Thread
+
+import JobRunner.callback_server as cbs
+from JobRunner.BlobCache import BlobCache
+
+_DATA = b'0123456789' * 1000
+_MD5 = hashlib.md5(_DATA).hexdigest()
+
+
+class _BlobServer(BaseHTTPRequestHandler):
+    """
+    A stand-in for Shock with one node.
+    """
+    downloads = 0
+
+    def _send(self, code, body, ctype='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.headers.get('Authorization') != 'OAuth good':
+            return self._send(401, b'{"error": ["Unauthorized"]}')
+        if self.path == '/node/abc':
+            info = {'name': 'reads.fq', 'size': len(_DATA),
+                    'checksum': {'md5': _MD5}}
+            return self._send(200, json.dumps({'data': {'file': info}})
+                              .encode('utf-8'))
+        if self.path == '/node/abc?download_raw':
+            _BlobServer.downloads += 1
+            return self._send(200, _DATA, 'application/octet-stream')
+        if self.path == '/node/bad':
+            info = {'name': 'bad.fq', 'size': len(_DATA),
+                    'checksum': {'md5': 'bogus'}}
+            return self._send(200, json.dumps({'data': {'file': info}})
+                              .encode('utf-8'))
+        if self.path.startswith('/node/bad?download'):
+            return self._send(200, _DATA, 'application/octet-stream')
+        self._send(404, b'{}')
+
+    def do_POST(self):
+        size = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(size)
+        self._send(200, json.dumps({'path': self.path,
+                                    'size': len(body)}).encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class BlobCacheTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), _BlobServer)
+        cls.url = 'http://127.0.0.1:%d' % (cls.server.server_port)
+        Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        _BlobServer.downloads = 0
+        self.bc = BlobCache(cache_dir=os.path.join(mkdtemp(), 'blobs'),
+                            upstream=self.url)
+
+    def tearDown(self):
+        cbs.blob_cache = None
+
+    def test_fetch(self):
+        headers = {'Authorization': 'OAuth good', 'Host': 'bogus'}
+        (info, resp) = self.bc.node_file('abc', headers)
+        self.assertEqual(info['checksum']['md5'], _MD5)
+        # Concurrent downloads of the same file only fetch it once
+        paths = []
+        ts = [Thread(target=lambda: paths.append(
+              self.bc.fetch('abc', _MD5, headers))) for i in range(4)]
+        for t in ts:
+            t.start()
+        for t in ts:
+            t.join()
+        self.assertEqual(_BlobServer.downloads, 1)
+        self.assertEqual(len(set(paths)), 1)
+        with open(paths[0], 'rb') as f:
+            self.assertEqual(f.read(), _DATA)
+        # Nodes may be private
+        self.assertEqual(os.stat(self.bc.cache_dir).st_mode & 0o777, 0o700)
+        self.assertEqual(os.stat(paths[0]).st_mode & 0o777, 0o600)
+        # A file over the limit is kept until something else is cached
+        self.bc.max_size = 10
+        self.assertEqual(self.bc.evict(keep=_MD5), 0)
+        self.assertEqual(self.bc.evict(), 1)
+        (info, resp) = self.bc.node_file('abc', {})
+        self.assertIsNone(info)
+        self.assertEqual(resp.status_code, 401)
+
+    def _get(self, path, **headers):
+        in_q = Queue()
+        cbs.app.config.update({'token': 'bogus', 'out_q': Queue(),
+                               'in_q': in_q})
+        cbs.blob_cache = self.bc
+        headers.setdefault('Authorization', 'OAuth good')
+        sa = {'access_log': False}
+        return cbs.app.test_client.get(path, headers=headers,
+                                       server_kwargs=sa)[1]
+
+    def test_proxy(self):
+        resp = self._get('/shock/node/abc?download')
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.body, _DATA)
+        self.assertIn('reads.fq', resp.headers['Content-Disposition'])
+        resp = self._get('/shock/node/abc?download_raw', Range='bytes=2-5')
+        self.assertEqual(resp.status, 206)
+        self.assertEqual(resp.body, b'2345')
+        self.assertEqual(resp.headers['Content-Range'],
+                         'bytes 2-5/%d' % (len(_DATA)))
+        resp = self._get('/shock/node/abc?download_raw', Range='bytes=-3')
+        self.assertEqual(resp.body, b'789')
+        resp = self._get('/shock/node/abc?download_raw',
+                         Range='bytes=99999-')
+        self.assertEqual(resp.status, 416)
+        self.assertEqual(_BlobServer.downloads, 1)
+        # The client's own token is checked for every download
+        resp = self._get('/shock/node/abc?download', Authorization='bad')
+        self.assertEqual(resp.status, 401)
+        # Anything else goes straight to Shock
+        resp = self._get('/shock/node/abc')
+        self.assertEqual(resp.json['data']['file']['name'], 'reads.fq')
+        # So does a download that fails to cache
+        resp = self._get('/shock/node/bad?download')
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(resp.body, _DATA)
+        self.assertFalse(os.path.exists(os.path.join(self.bc.cache_dir,
+                                                     'bogus')))
+
+    def test_forward_post(self):
+        cbs.app.config.update({'token': 'bogus', 'out_q': Queue(),
+                               'in_q': Queue()})
+        cbs.blob_cache = self.bc
+        sa = {'access_log': False}
+        resp = cbs.app.test_client.post('/shock/node', data=b'x' * 5000,
+                                        server_kwargs=sa)[1]
+        self.assertEqual(resp.json, {'path': '/node', 'size': 5000})
+        # A failed request to Shock doesn't leave the upload blocked
+        self.bc.upstream = 'http://127.0.0.1:1'
+        resp = cbs.app.test_client.post('/shock/node',
+                                        data=b'x' * 4 * 1024 * 1024,
+                                        server_kwargs=sa)[1]
+        self.assertEqual(resp.status, 500)
+
+    def test_upstream_url(self):
+        # The job runner sends the Shock URL once it has the job
+        in_q = Queue()
+        cbs.app.config.update({'token': 'bogus', 'out_q': Queue(),
+                               'in_q': in_q})
+        cbs.blob_cache = BlobCache(cache_dir=mkdtemp())
+        sa = {'access_log': False}
+        resp = cbs.app.test_client.get('/shock/node/abc',
+                                       server_kwargs=sa)[1]
+        self.assertEqual(resp.status, 404)
+        in_q.put(['shock_url', None, self.url])
+        resp = cbs.app.test_client.get(
+            '/shock/node/abc', headers={'Authorization': 'OAuth good'},
+            server_kwargs=sa)[1]
+        self.assertEqual(resp.status, 200)
@@ -6,11 +6,11 @@ from unittest.mock import patch
 _TOKEN = 'bogus'
 
 
-def _post(data):
+def _post(data, path='/'):
     header = {"Authorization": _TOKEN}
 
     sa = {'access_log': False}
-    return app.test_client.post('/',
+    return app.test_client.post(path,
                                 server_kwargs=sa,
                                 headers=header, data=data)[1]
 
@@ -77,3 +77,112 @@ def test_index_submit_sync(mock_uuid):
     response = _post(data)
     assert 'finished' in response.json
     assert 'foo' in response.json
+
+
+def test_submit_parent():
+    out_q = Queue()
+    in_q = Queue()
+    conf = {
+            'token': _TOKEN,
+            'out_q': out_q,
+            'in_q': in_q
+        }
+    app.config.update(conf)
+    data = json.dumps({'method': 'bogus._test_submit'})
+    response = _post(data, path='/parent')
+    job_id = response.json['result']
+    mess = out_q.get()
+    assert mess[0] == 'submit'
+    assert mess[1] == job_id
+    assert mess[2]['parent_job_id'] == 'parent'
+    assert mess[2]['method'] == 'bogus.test'
+    # A queued job isn't finished
+    data = json.dumps({'method': 'bogus._check_job', 'params': [job_id]})
+    response = _post(data, path='/parent')
+    assert response.json['result'][0]['finished'] is False
+
+
+def test_output_file(tmpdir):
+    out_q = Queue()
+    in_q = Queue()
+    conf = {
+            'token': _TOKEN,
+            'out_q': out_q,
+            'in_q': in_q
+        }
+    app.config.update(conf)
+    of = tmpdir.join('output.json')
+    of.write(json.dumps({'result': ['big']}))
+    ref = {'path': str(of), 'resource_usage': {'cpu_seconds': 1}}
+    in_q.put(['output_file', 'bigjob', ref])
+    data = json.dumps({'method': 'bogus._check_job', 'params': ['bigjob']})
+    response = _post(data)
+    resp = response.json['result'][0]
+    assert resp['finished'] is True
+    assert resp['result'] == ['big']
+    assert resp['resource_usage'] == {'cpu_seconds': 1}
+
+
+@patch('JobRunner.callback_server.uuid', autospec=True)
+def test_output_file_sync(mock_uuid, tmpdir):
+    out_q = Queue()
+    in_q = Queue()
+    conf = {
+            'token': _TOKEN,
+            'out_q': out_q,
+            'in_q': in_q
+        }
+    app.config.update(conf)
+    mock_uuid.uuid1.return_value = 'syncjob'
+    of = tmpdir.join('output.json')
+    of.write('  {  }\n')
+    in_q.put(['output_file', 'syncjob', {'path': str(of), 'empty': True}])
+    data = json.dumps({'method': 'bogus.test'})
+    response = _post(data)
+    assert response.json == {'finished': True}
+
+
+def test_map(tmpdir):
+    out_q = Queue()
+    in_q = Queue()
+    conf = {
+            'token': _TOKEN,
+            'out_q': out_q,
+            'in_q': in_q
+        }
+    app.config.update(conf)
+    data = json.dumps({'method': 'bogus._test_map',
+                       'params': [[{'a': 1}], [{'a': 2}], [{'a': 3}]]})
+    response = _post(data, path='/parent')
+    job_ids = response.json['result'][0]
+    assert len(job_ids) == 3
+    # The whole batch is one message
+    mess = out_q.get()
+    assert mess[0] == 'submit_map'
+    assert [job[0] for job in mess[2]] == job_ids
+    assert mess[2][1][1]['params'] == [{'a': 2}]
+    assert mess[2][1][1]['method'] == 'bogus.test'
+    assert mess[2][1][1]['parent_job_id'] == 'parent'
+    assert out_q.empty()
+    of = tmpdir.join('output.json')
+    of.write(json.dumps({'result': ['big']}))
+    in_q.put(['output', job_ids[0], {'result': [1]}])
+    in_q.put(['output_file', job_ids[2], {'path': str(of)}])
+    data = json.dumps({'method': 'bogus._check_jobs', 'params': [job_ids]})
+    response = _post(data, path='/parent')
+    states = response.json['result'][0]
+    assert states == [{'result': [1], 'finished': True},
+                      {'finished': False},
+                      {'result': ['big'], 'finished': True}]
+    # The output is only read once
+    of.remove()
+    response = _post(data, path='/parent')
+    assert response.json['result'][0] == states
+    # A bad output is an error for its job alone
+    of.write('{"result": [')
+    in_q.put(['output_file', job_ids[1], {'path': str(of)}])
+    response = _post(data, path='/parent')
+    states = response.json['result'][0]
+    assert states[0] == {'result': [1], 'finished': True}
+    assert states[1]['finished'] is True
+    assert states[1]['error']['name'] == 'Output not readable'
@@ -5,6 +5,7 @@ from unittest.mock import patch
 from mock import MagicMock
 
 from JobRunner.CatalogCache import CatalogCache
+from JobRunner.shared import SharedResources
 from nose.plugins.attrib import attr
 from copy import deepcopy
 from .mock_data import CATALOG_GET_MODULE_VERSION, NJS_JOB_PARAMS,\
@@ -47,3 +48,55 @@ class CatalogCacheTest(unittest.TestCase):
         out = cc.get_volume_mounts('bogus', 'method', 'upload')
         self.assertTrue(len(out) > 0)
         self.assertIn('host_dir', out[0])
+        # Later subjobs of the method reuse the lookup
+        self.assertEqual(cc.get_volume_mounts('bogus', 'method', 'upload'),
+                         out)
+        self.assertEqual(cc.catadmin.list_volume_mounts.call_count, 1)
+
+    @patch('JobRunner.CatalogCache.Catalog', autospec=True)
+    def test_resources(self, mock_cc):
+        cc = CatalogCache(self.cfg)
+        cgs = [{'module_name': 'bogus', 'function_name': 'method',
+                'client_groups': ['njs', 'request_cpus=4',
+                                  'request_memory=2G']}]
+        cc.catalog.list_client_group_configs = MagicMock(return_value=cgs)
+        out = cc.get_resources('bogus', 'method')
+        self.assertEqual(out, {'cpus': 4, 'memory': 2048})
+        cc.get_resources('bogus', 'method')
+        self.assertEqual(cc.catalog.list_client_group_configs.call_count, 1)
+        cc.catalog.list_client_group_configs.side_effect = Exception()
+        out = cc.get_resources('bogus', 'other')
+        self.assertEqual(out, {'cpus': 0, 'memory': 0})
+
+    @patch('JobRunner.CatalogCache.Catalog', autospec=True)
+    def test_shared(self, mock_cc):
+        shared = SharedResources()
+        cc = CatalogCache(self.cfg, shared=shared)
+        info = deepcopy(CATALOG_GET_MODULE_VERSION)
+        cc.catalog.get_module_version.return_value = info
+        self.assertFalse(cc.get_module_info('bogus', None)['cached'])
+        # Another job reuses the lookup but it isn't cached for that job
+        cc2 = CatalogCache(self.cfg, shared=shared)
+        out = cc2.get_module_info('bogus', None)
+        self.assertFalse(out['cached'])
+        self.assertEqual(out['git_commit_hash'], info['git_commit_hash'])
+        self.assertEqual(cc2.catalog.get_module_version.call_count, 1)
+        self.assertTrue(cc2.get_module_info('bogus', None)['cached'])
+        # Lookups expire
+        shared.module_ttl = -1
+        cc3 = CatalogCache(self.cfg, shared=shared)
+        cc3.get_module_info('bogus', None)
+        self.assertEqual(cc3.catalog.get_module_version.call_count, 2)
+        self.assertIs(cc3.resource_cache, shared.resources)
+
+    @patch('JobRunner.CatalogCache.Catalog', autospec=True)
+    def test_prefetch(self, mock_cc):
+        cc = CatalogCache(self.cfg)
+        info = deepcopy(CATALOG_GET_MODULE_VERSION)
+        cc.catalog.get_module_version.return_value = info
+        out = cc.prefetch_module_info('bogus', 'release')
+        self.assertEqual(out['git_commit_hash'], info['git_commit_hash'])
+        # A prefetch doesn't count as the job using the module
+        self.assertFalse(cc.get_module_info('bogus', 'release')['cached'])
+        self.assertTrue(cc.get_module_info('bogus', 'release')['cached'])
+        self.assertEqual(cc.catalog.get_module_version.call_count, 1)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+from tempfile import mkdtemp
+
+from JobRunner.cgroups import get_limits
+
+_CG = '/htcondor/slot1_1@host'
+
+
+class CgroupsTest(unittest.TestCase):
+
+    def _write(self, root, path, value):
+        path = os.path.join(root, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(value + '\n')
+
+    def test_v1(self):
+        root = mkdtemp()
+        self._write(root, 'cpu,cpuacct' + _CG + '/cpu.cfs_quota_us', '200000')
+        self._write(root, 'cpu,cpuacct' + _CG + '/cpu.cfs_period_us',
+                    '100000')
+        self._write(root, 'memory' + _CG + '/memory.limit_in_bytes',
+                    str(4 * 1024 ** 3))
+        limits = get_limits(_CG + '\n', root=root)
+        self.assertEqual(limits, {'cpus': 2.0, 'memory': 4 * 1024 ** 3})
+
+    def test_v1_unlimited(self):
+        root = mkdtemp()
+        self._write(root, 'cpu' + _CG + '/cpu.cfs_quota_us', '-1')
+        self._write(root, 'cpu' + _CG + '/cpu.cfs_period_us', '100000')
+        self._write(root, 'memory' + _CG + '/memory.limit_in_bytes',
+                    '9223372036854771712')
+        limits = get_limits(_CG, root=root)
+        self.assertEqual(limits, {'cpus': None, 'memory': None})
+
+    def test_v2(self):
+        root = mkdtemp()
+        self._write(root, _CG[1:] + '/cpu.max', '150000 100000')
+        self._write(root, _CG[1:] + '/memory.max', '1073741824')
+        limits = get_limits(_CG, root=root)
+        self.assertEqual(limits, {'cpus': 1.5, 'memory': 1073741824})
+        self._write(root, _CG[1:] + '/cpu.max', 'max 100000')
+        self._write(root, _CG[1:] + '/memory.max', 'max')
+        limits = get_limits(_CG, root=root)
+        self.assertEqual(limits, {'cpus': None, 'memory': None})
+
+    def test_no_cgroup(self):
+        self.assertEqual(get_limits(None), {'cpus': None, 'memory': None})
+        self.assertEqual(get_limits('Unknown'),
+                         {'cpus': None, 'memory': None})
+        self.assertEqual(get_limits('/bogus', root=mkdtemp()),
+                         {'cpus': None, 'memory': None})
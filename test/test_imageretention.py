@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import unittest
+from collections import namedtuple
+from tempfile import mkdtemp
+from unittest.mock import patch
+from mock import MagicMock
+
+from JobRunner.DockerRunner import DockerRunner
+from JobRunner.ImageRetention import ImageRetention
+
+_Usage = namedtuple('_Usage', ['total', 'used', 'free'])
+
+
+class ImageRetentionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.state = os.path.join(mkdtemp(), 'images.json')
+        self.client = MagicMock()
+        self.ir = ImageRetention(self.client, 0.8, state_file=self.state,
+                                 root='/', min_age=0)
+
+    def _state(self):
+        with open(self.state) as f:
+            return json.load(f)['images']
+
+    def test_touch(self):
+        self.ir.touch('mock_app:latest')
+        self.assertIsNone(self._state()['mock_app:latest']['id'])
+        self.ir.touch('mock_app:latest', 'sha256:a')
+        first = self._state()['mock_app:latest']
+        self.assertEqual(first['id'], 'sha256:a')
+        # Repeated uses by the same runner aren't written every time
+        self.ir.touch('mock_app:latest')
+        self.assertEqual(self._state()['mock_app:latest'], first)
+
+    @patch('JobRunner.ImageRetention.shutil.disk_usage')
+    def test_collect(self, mock_du):
+        for (i, name) in enumerate(['a', 'b', 'c', 'd']):
+            self.ir.touch(name, 'sha256:' + name)
+        # Oldest first
+        state = {'images': dict((n, {'id': 'sha256:' + n, 'last_used': i})
+                                for (i, n) in enumerate('abcd'))}
+        with open(self.state, 'w') as f:
+            json.dump(state, f)
+        c = MagicMock()
+        c.attrs = {'Image': 'sha256:a'}
+        self.client.containers.list.return_value = [c]
+        self.client.df.return_value = {'Images': [
+            {'Id': 'sha256:%s' % n, 'Size': 10, 'SharedSize': 4}
+            for n in 'abcd']}
+        mock_du.return_value = _Usage(100, 70, 30)
+        self.assertEqual(self.ir.collect(), [])
+        # 10 bytes have to go.  The image in use is kept, and each removal
+        # only frees the layers that aren't shared.
+        mock_du.return_value = _Usage(100, 90, 10)
+        self.assertEqual(self.ir.collect(), ['b', 'c'])
+        self.client.images.remove.assert_called_with('c')
+        self.assertEqual(sorted(self._state().keys()), ['a', 'd'])
+        # Recently used images are never removed
+        self.ir.min_age = 3600
+        self.ir.touch('d', 'sha256:d')
+        self.assertEqual(self.ir.collect(), [])
+
+    def test_removed_image(self):
+        from docker.errors import ImageNotFound
+        runner = DockerRunner(logger=MagicMock(), client=self.client)
+        self.client.images.list.return_value = []
+        self.client.images.pull.return_value.id = 'sha256:a'
+        self.assertEqual(runner.get_image('mock_app:latest'), 'sha256:a')
+        self.assertEqual(runner.get_image('mock_app:latest'), 'sha256:a')
+        self.assertEqual(self.client.images.pull.call_count, 1)
+        # An image removed since it was cached is pulled again
+        self.client.images.get.side_effect = ImageNotFound('gone')
+        self.client.images.pull.return_value.id = 'sha256:b'
+        self.assertEqual(runner.get_image('mock_app:latest'), 'sha256:b')
+        self.assertEqual(self.client.images.pull.call_count, 2)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+from multiprocessing import Process
+from tempfile import mkdtemp
+from queue import Empty, Full
+
+from JobRunner.ipc import Channel
+
+
+def _producer(ch, count):
+    for i in range(count):
+        ch.put(['submit', 'job%d' % i, {'method': 'a.b', 'params': [i]}])
+    ch.put(['cancel', None, None])
+
+
+class ChannelTest(unittest.TestCase):
+
+    def test_roundtrip(self):
+        # A small buffer forces the ring to wrap many times
+        ch = Channel(size=1000)
+        p = Process(target=_producer, args=[ch, 2000])
+        p.start()
+        count = 0
+        while True:
+            msg = ch.get(timeout=10)
+            if msg[0] == 'cancel':
+                break
+            self.assertEqual(msg[1], 'job%d' % count)
+            self.assertEqual(msg[2]['params'], [count])
+            count += 1
+        p.join()
+        self.assertEqual(count, 2000)
+        self.assertEqual(msg, ['cancel', None, None])
+
+    def test_empty_full(self):
+        ch = Channel(size=200)
+        with self.assertRaises(Empty):
+            ch.get(timeout=0.1)
+        with self.assertRaises(Empty):
+            ch.get_nowait()
+        # Each message takes 38 bytes
+        for i in range(5):
+            ch.put(['output', 'j%d' % i, {'a': 'x' * 20}])
+        with self.assertRaises(Full):
+            ch.put_nowait(['output', 'j5', {'a': 'x' * 20}])
+        self.assertEqual(ch.get_nowait()[2], {'a': 'x' * 20})
+
+    def test_bad_message(self):
+        ch = Channel(size=100)
+        with self.assertRaises(ValueError):
+            ch.put(['bogus', None, None])
+
+    def test_spill(self):
+        spill_dir = mkdtemp()
+        ch = Channel(size=400, spill_dir=spill_dir)
+        # Messages too big for the buffer go through a file
+        big = {'params': ['x' * 1000]}
+        for i in range(3):
+            ch.put(['submit_map', 'j%d' % i, big])
+        self.assertEqual(len(os.listdir(spill_dir)), 3)
+        for i in range(3):
+            self.assertEqual(ch.get_nowait(), ['submit_map', 'j%d' % i, big])
+        self.assertEqual(os.listdir(spill_dir), [])
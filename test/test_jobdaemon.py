@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import os
+import socket
+import unittest
+from tempfile import mkdtemp
+from threading import Event, Thread
+from unittest.mock import MagicMock, patch
+
+from JobRunner.JobDaemon import JobDaemon, submit_job
+
+
+class JobDaemonTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(mkdtemp(), 'jobrunner.sock')
+        self.daemon = JobDaemon(self.path)
+        self.daemon.start()
+        self.thread = Thread(target=self.daemon.serve, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.daemon.stop()
+        self.thread.join(5)
+        self.assertFalse(self.thread.is_alive())
+
+    @patch('JobRunner.JobDaemon.JobRunner', autospec=True)
+    def test_submit(self, mock_jr):
+        mock_jr.return_value.cbs = MagicMock()
+        mock_jr.return_value.run.return_value = {'result': [1]}
+        config = {'workdir': '/tmp/jr'}
+        resp = submit_job(self.path, '1234', 'http://njs', 'token', 'admin',
+                          config)
+        self.assertEqual(resp, {'result': {'result': [1]}})
+        args = mock_jr.call_args
+        self.assertEqual(args[0][1:], ('http://njs', '1234', 'token',
+                                       'admin'))
+        # Jobs share the daemon's resources and get the client's cgroup
+        self.assertIs(args[1]['shared'], self.daemon.shared)
+        self.assertEqual(args[0][0]['client_pid'], os.getpid())
+        self.assertEqual(args[0][0]['callback_server'], 'process')
+        mock_jr.return_value.cbs.kill.assert_called_with()
+        self.assertEqual(self.daemon.jobs, {})
+
+    @patch('JobRunner.JobDaemon.JobRunner', autospec=True)
+    def test_submit_errors(self, mock_jr):
+        mock_jr.return_value.cbs = MagicMock()
+        mock_jr.return_value.run.side_effect = SystemExit(1)
+        resp = submit_job(self.path, '1234', 'http://njs', 'token', 'admin',
+                          {})
+        self.assertEqual(resp, {'exit_code': 1})
+        mock_jr.return_value.run.side_effect = OSError('Missing workdir')
+        resp = submit_job(self.path, '1234', 'http://njs', 'token', 'admin',
+                          {})
+        self.assertEqual(resp['error'], 'Missing workdir')
+        self.assertEqual(resp['exit_code'], 2)
+        with self.assertRaises(OSError):
+            submit_job(self.path + '.bogus', '1234', 'http://njs', 'token',
+                       'admin', {})
+
+    @patch('JobRunner.JobDaemon.JobRunner', autospec=True)
+    def test_client_gone(self, mock_jr):
+        canceled = Event()
+        jr = mock_jr.return_value
+        jr.job_id = '1234'
+        jr.cbs = MagicMock()
+        jr.run.side_effect = lambda: canceled.wait(10) and {}
+        jr.shutdown.side_effect = lambda sig, bt: canceled.set()
+        # A client that goes away cancels its job
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(self.path)
+        conn.sendall(b'{"job_id": "1234", "njs_url": "http://njs", '
+                     b'"token": "token", "admin_token": "admin"}\n')
+        for i in range(50):
+            if '1234' in self.daemon.jobs:
+                break
+            canceled.wait(0.1)
+        conn.close()
+        self.assertTrue(canceled.wait(10))
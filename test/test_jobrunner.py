@@ -1,10 +1,19 @@
 # -*- coding: utf-8 -*-
+import json
 import os
+import socket
 import unittest
+from multiprocessing import Queue
+import requests
+import time
+from threading import Thread
+from time import sleep
 from unittest.mock import patch
 from mock import MagicMock
 
 from JobRunner.JobRunner import JobRunner
+from JobRunner.provenance import Provenance
+from tempfile import mkdtemp
 from nose.plugins.attrib import attr
 from copy import deepcopy
 from .mock_data import CATALOG_GET_MODULE_VERSION, NJS_JOB_PARAMS, \
@@ -174,3 +183,349 @@ class JobRunnerTest(unittest.TestCase):
         jr.auth.get_user.side_effect = OSError()
         with self.assertRaises(Exception):
             jr.run()
+
+    def _stop_callback_server(self, jr):
+        jr._wait_for_callback_server(timeout=30)
+        jr.cbs.kill()
+        # The killed server may still hold the write lock of the queue
+        # it sent 'ready' on
+        jr.jr_queue = Queue()
+
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    def test_callback_ready(self, mock_njs, mock_auth):
+        jr = JobRunner(self.config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        # The server is started by __init__ and reports when it listens
+        jr.jr_queue.put(['cancel', None, None])
+        self.assertTrue(jr._wait_for_callback_server(timeout=30))
+        resp = requests.get(jr.callback_url)
+        self.assertEqual(resp.json(), {})
+        # Other messages are left for the watch loop
+        self.assertEqual(jr.jr_queue.get(timeout=1)[0], 'cancel')
+        jr.cbs.kill()
+
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    def test_callback_in_process(self, mock_njs, mock_auth):
+        config = deepcopy(self.config)
+        config['callback_server'] = 'thread'
+        jr = JobRunner(config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        self.assertTrue(jr._wait_for_callback_server(timeout=30))
+        # A sync call returns as soon as the output is recorded
+        header = {'Authorization': self.token}
+        data = {'method': 'mock_app.bogus', 'params': [{}]}
+        resp = dict()
+
+        def _call():
+            r = requests.post(jr.callback_url, json=data, headers=header)
+            resp.update(r.json())
+
+        t = Thread(target=_call)
+        start = time.time()
+        t.start()
+        mess = jr.jr_queue.get(timeout=10)
+        self.assertEqual(mess[0], 'submit')
+        jr.callback_queue.put(['output', mess[1], {'result': [1]}])
+        t.join(10)
+        self.assertLess(time.time() - start, 1)
+        self.assertTrue(resp['finished'])
+        self.assertEqual(resp['result'], [1])
+        jr.cbs.kill()
+        jr.cbs.join(10)
+        self.assertFalse(jr.cbs.is_alive())
+
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    def test_container_limits(self, mock_njs, mock_auth):
+        config = deepcopy(self.config)
+        config['max_subjobs'] = 3
+        config['container_pids_limit'] = 512
+        jr = JobRunner(config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        jr.cbs.kill()
+        jr.config['cgroup'] = '/htcondor/slot1'
+        jr.slot_limits = {'cpus': 8.0, 'memory': 16 * 1024 ** 3}
+        jr._cc = MagicMock()
+        jr.cc.get_resources.return_value = {'cpus': 0, 'memory': 0}
+        limits = jr._get_container_limits('mock_app', 'bogus')
+        self.assertNotIn('cgroup_parent', limits)
+        jr.config['cgroup_parent'] = True
+        limits = jr._get_container_limits('mock_app', 'bogus')
+        # The slot is split between the main job and three subjobs
+        self.assertEqual(limits['cgroup_parent'], '/htcondor/slot1')
+        self.assertEqual(limits['pids_limit'], 512)
+        self.assertEqual(limits['cpu_quota'], 2 * limits['cpu_period'])
+        self.assertEqual(limits['mem_limit'], 4 * 1024 ** 3)
+        # Declared resources win, but are capped by the slot
+        jr.cc.get_resources.return_value = {'cpus': 16, 'memory': 8192}
+        limits = jr._get_container_limits('mock_app', 'bogus')
+        self.assertEqual(limits['cpu_quota'], 8 * limits['cpu_period'])
+        self.assertEqual(limits['mem_limit'], 8 * 1024 ** 3)
+
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    def test_prefetch(self, mock_njs, mock_auth):
+        jr = JobRunner(self.config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        jr.cbs.kill()
+        cc = MagicMock()
+        rv = deepcopy(CATALOG_GET_MODULE_VERSION)
+        rv['docker_img_name'] = 'mock_app:latest'
+        cc.prefetch_module_info.return_value = rv
+        jr.mr.runner = MagicMock()
+        jr._prefetch(cc, {'method': 'mock_app.bogus', 'service_ver': 'beta'})
+        cc.prefetch_module_info.assert_called_with('mock_app', 'beta')
+        jr.mr.runner.get_image.assert_called_with('mock_app:latest')
+        # Failures are left for the job to report
+        jr.mr.runner.get_image.side_effect = OSError('No image')
+        jr._prefetch(cc, {'method': 'mock_app.bogus'})
+
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    def test_exec_stats(self, mock_njs, mock_auth):
+        jr = JobRunner(self.config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        jr.cbs.kill()
+        jr._cc = MagicMock()
+        jr.mr = MagicMock()
+        usage = {'cpu_seconds': 1.0, 'max_rss_bytes': 100}
+        jr.mr.get_usage.return_value = usage
+        jr.mr.get_output.return_value = {'result': [1]}
+        # NJS reports the main job, so only its usage is logged
+        output = jr._send_output(self.jobid, False)
+        self.assertEqual(output['resource_usage'], usage)
+        jr.cc.log_exec_stats.assert_not_called()
+        jr.job_info['sub1'] = {'job_id': 'sub1', 'func_name': 'bogus'}
+        of = os.path.join(mkdtemp(), 'output.json')
+        with open(of, 'w') as f:
+            f.write('{"result": [1]}')
+        jr.mr.check_output.return_value = (of, None)
+        jr.inline_output_size = 1024
+        jr._send_output('sub1', True)
+        # The output file is only checked once
+        jr.mr.check_output.assert_called_once_with('sub1')
+        jr.mr.get_output.assert_called_with('sub1', path=of)
+        for i in range(50):
+            if jr.cc.log_exec_stats.called:
+                break
+            sleep(0.1)
+        stats = jr.cc.log_exec_stats.call_args[0][0]
+        self.assertEqual(stats['is_error'], 0)
+        self.assertNotIn('resource_usage', stats)
+        self.assertIn('finish_time', stats)
+
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    def test_output_by_reference(self, mock_njs, mock_auth):
+        config = deepcopy(self.config)
+        config['inline_output_size'] = 20
+        jr = JobRunner(config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        jr.cbs.kill()
+        jr.mr.subjobdir = '/tmp/jr/subjobs'
+        jd = os.path.join(jr.mr.subjobdir, 'sub1')
+        if not os.path.exists(jd):
+            os.makedirs(jd)
+        with open(os.path.join(jd, 'output.json'), 'w') as f:
+            f.write('{"result": ["%s"]}' % ('x' * 100))
+        self.assertIsNone(jr._send_output('sub1', True))
+        mess = jr.callback_queue.get(timeout=1)
+        self.assertEqual(mess[0], 'output_file')
+        self.assertEqual(mess[2]['path'], os.path.join(jd, 'output.json'))
+        with open(os.path.join(jd, 'output.json'), 'w') as f:
+            f.write('{"result": []}')
+        self.assertEqual(jr._send_output('sub1', True), {'result': []})
+        self.assertEqual(jr.callback_queue.get(timeout=1)[0], 'output')
+        # The callback server can't add its keys to a streamed output
+        # that already has them
+        out = {'result': ['x' * 100], 'finished': False}
+        with open(os.path.join(jd, 'output.json'), 'w') as f:
+            f.write(json.dumps(out))
+        self.assertEqual(jr._send_output('sub1', True), out)
+        self.assertEqual(jr.callback_queue.get(timeout=1)[0], 'output')
+
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    def test_resume(self, mock_njs, mock_auth):
+        config = deepcopy(self.config)
+        config['workdir'] = mkdtemp()
+        # Other tests' runners may still hold the default lock
+        config['lock_dir'] = mkdtemp()
+        config['resume'] = True
+        config['max_subjobs'] = 1
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        params = deepcopy(NJS_JOB_PARAMS[0])
+        prov = Provenance(params)
+        prov.add_subaction({'name': 'mock_app', 'ver': '1'})
+        sub = {'parent': self.jobid, 'cpus': 0, 'memory': 0}
+        state = {
+            'job_id': self.jobid,
+            'port': port,
+            'prov': prov.prov,
+            'jobs': {
+                self.jobid: {'status': 'running', 'container': 'c1',
+                             'since': 100},
+                'sub1': dict(sub, status='running', container='c2'),
+                'sub2': dict(sub, status='finished', container='c3',
+                             slot='warm-1'),
+                'sub3': dict(sub, status='queued',
+                             data={'method': 'mock_app.bogus'})
+            }
+        }
+        with open(os.path.join(config['workdir'],
+                               'jobrunner_state.json'), 'w') as f:
+            json.dump(state, f)
+        jr = JobRunner(config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        jr.cbs.kill()
+        # The callback server gets the old port back
+        self.assertEqual(jr.port, port)
+        # Reapers keep the job's containers for the grace in its lock
+        with open(jr.lock.name) as f:
+            self.assertEqual(int(f.read()), jr.resume_grace)
+        jr.mr.runner = MagicMock()
+        jr.mr.runner.usage = dict()
+        jr.mr.runner.offsets = {'sub1': 50}
+        cs = dict((cid, MagicMock(id=cid)) for cid in ['c1', 'c2', 'c9'])
+        jr.mr.runner.find.return_value = dict(cs)
+        jr.prov = Provenance(params)
+        self.assertEqual(jr._resume(config, params), 3)
+        # Live containers are watched from their offsets, and the ones the
+        # job doesn't know about are removed
+        jr.mr.runner.attach.assert_any_call(cs['c1'], self.jobid, False,
+                                            [jr.jr_queue], since=100)
+        jr.mr.runner.attach.assert_any_call(cs['c2'], 'sub1', True,
+                                            [jr.jr_queue], since=1)
+        jr.mr.runner.remove.assert_called_once_with(cs['c9'], 0)
+        self.assertIn('sub1', jr.scheduler.running)
+        self.assertTrue(jr.scheduler.is_queued('sub3'))
+        self.assertEqual(jr.prov.actions, {'mock_app': {'name': 'mock_app',
+                                                        'ver': '1'}})
+        self.assertEqual(jr.callback_queue.get(timeout=1)[0], 'prov')
+        # The finished subjob's output is sent again from its slot
+        mess = jr.callback_queue.get(timeout=1)
+        self.assertEqual(mess[1], 'sub2')
+        self.assertEqual(mess[2]['error']['name'], 'Output not found')
+        self.assertEqual(jr.mr._get_job_dir('sub2', subjob=True),
+                         os.path.join(config['workdir'], 'subjobs',
+                                      'warm-1'))
+        with open(jr.state_file) as f:
+            saved = json.load(f)
+        self.assertEqual(saved['jobs']['sub1']['since'], 50)
+        self.assertEqual(saved['jobs']['sub3']['status'], 'queued')
+        jr._clear_state()
+        self.assertFalse(os.path.exists(jr.state_file))
+
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    def test_result_cache(self, mock_njs, mock_auth):
+        config = deepcopy(self.config)
+        config['result_cache_modules'] = 'mock_app'
+        config['result_cache_dir'] = mkdtemp()
+        jr = JobRunner(config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        self._stop_callback_server(jr)
+        jr.mr.subjobdir = mkdtemp()
+        jr.prov = Provenance(deepcopy(NJS_JOB_PARAMS[0]))
+        info = deepcopy(CATALOG_GET_MODULE_VERSION)
+        data = {'method': 'mock_app.bogus', 'params': [{'a': 1}]}
+        job_config = {'user': 'bogus'}
+        self.assertFalse(jr._check_result_cache(job_config, 'sub1', data,
+                                                info))
+        os.mkdir(os.path.join(jr.mr.subjobdir, 'sub1'))
+        of = os.path.join(jr.mr.subjobdir, 'sub1', 'output.json')
+        with open(of, 'w') as f:
+            f.write('{"result": [1]}')
+        jr._send_output('sub1', True)
+        self.assertEqual(jr.callback_queue.get(timeout=1)[0], 'output_file')
+        # The same call is answered without a container
+        self.assertTrue(jr._check_result_cache(job_config, 'sub2', data,
+                                               info))
+        self.assertEqual(jr.jr_queue.get(timeout=1), ['finished', 'sub2',
+                                                      None])
+        # The module that made the output is in the provenance
+        self.assertEqual(jr.callback_queue.get(timeout=1)[0], 'prov')
+        actions = jr.prov.get_prov()[0]['subactions']
+        self.assertEqual(actions[-1]['commit'], info['git_commit_hash'])
+        # The job has its own copy, so eviction can't remove it
+        for name in os.listdir(config['result_cache_dir']):
+            os.unlink(os.path.join(config['result_cache_dir'], name))
+        self.assertIsNone(jr._send_output('sub2', True))
+        mess = jr.callback_queue.get(timeout=1)
+        self.assertEqual(mess[:2], ['output_file', 'sub2'])
+        self.assertEqual(mess[2]['path'], os.path.join(jr.mr.subjobdir,
+                                                       'sub2', 'output.json'))
+        self.assertTrue(os.path.exists(mess[2]['path']))
+        self.assertEqual(mess[2]['keys'], ['result'])
+        # Other modules and errors aren't cached
+        other = {'method': 'other.bogus', 'params': [{'a': 1}]}
+        self.assertFalse(jr._check_result_cache(job_config, 'sub3', other,
+                                                info))
+        data['params'] = [{'a': 2}]
+        self.assertFalse(jr._check_result_cache(job_config, 'sub4', data,
+                                                info))
+        os.mkdir(os.path.join(jr.mr.subjobdir, 'sub4'))
+        with open(os.path.join(jr.mr.subjobdir, 'sub4', 'output.json'),
+                  'w') as f:
+            f.write('{"error": {"message": "failed"}}')
+        jr._send_output('sub4', True)
+        self.assertFalse(jr._check_result_cache(job_config, 'sub5', data,
+                                                info))
+
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    def test_single_flight(self, mock_njs, mock_auth):
+        config = deepcopy(self.config)
+        config['single_flight_modules'] = 'mock_app'
+        jr = JobRunner(config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        self._stop_callback_server(jr)
+        jr._submit = MagicMock()
+        jr.mr.subjobdir = mkdtemp()
+        data = {'method': 'mock_app.bogus', 'params': [{'a': 1, 'b': 2}]}
+        same = {'method': 'mock_app.bogus', 'params': [{'b': 2, 'a': 1}]}
+        other = {'method': 'other.bogus', 'params': [{'a': 1, 'b': 2}]}
+        for (job_id, d) in [('sub1', data), ('sub2', same), ('sub3', other),
+                            ('sub4', dict(other))]:
+            jr.jr_queue.put(['submit', job_id, d])
+        jr.jr_queue.put(['finished', 'sub1', None])
+        jr.jr_queue.put(['cancel', None, None])
+        jr.mr.cleanup_all = MagicMock()
+        jr.njs.check_job_canceled.return_value = {'finished': False}
+        jr._watch(config)
+        # Only the first of the identical subjobs runs
+        started = [c[0][1] for c in jr._submit.call_args_list]
+        self.assertEqual(started, ['sub1', 'sub3', 'sub4'])
+        # and the one that joined it gets its output too
+        got = [jr.callback_queue.get(timeout=1)[:2] for i in range(2)]
+        self.assertEqual(got, [['output', 'sub1'], ['output', 'sub2']])
+        self.assertEqual(jr.inflight, {})
+        self.assertEqual(jr.followers, {})
+
+    @patch('JobRunner.JobRunner.KBaseAuth', autospec=True)
+    @patch('JobRunner.JobRunner.NJS', autospec=True)
+    def test_submit_map(self, mock_njs, mock_auth):
+        config = deepcopy(self.config)
+        config['max_subjobs'] = 2
+        jr = JobRunner(config, self.njs_url, self.jobid, self.token,
+                       self.admin_token)
+        self._stop_callback_server(jr)
+        jr._submit = MagicMock()
+        jr.mr.subjobdir = mkdtemp()
+        jobs = [['sub%d' % (i), {'method': 'mock_app.bogus',
+                                 'params': [{'a': i}]}] for i in range(3)]
+        jr.jr_queue.put(['submit_map', None, jobs])
+        jr.jr_queue.put(['finished', 'sub0', None])
+        jr.jr_queue.put(['cancel', None, None])
+        jr.mr.cleanup_all = MagicMock()
+        jr.njs.check_job_canceled.return_value = {'finished': False}
+        jr._watch(config)
+        # The batch is scheduled together under the subjob limit
+        started = [c[0][1] for c in jr._submit.call_args_list]
+        self.assertEqual(started, ['sub0', 'sub1', 'sub2'])
+        self.assertEqual(jr.batched, set(['sub1', 'sub2']))
@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
 import unittest
-from unittest.mock import patch
+from subprocess import check_output
+from tempfile import mkdtemp
+from time import sleep, time
+from unittest.mock import MagicMock, patch
 from copy import deepcopy
 from queue import Queue
 
@@ -117,3 +121,137 @@ class MethodRunnerTest(unittest.TestCase):
         cfg['runtime'] = 'bogus'
         with self.assertRaises(OSError):
             MethodRunner(cfg, '1234', logger=MockLogger())
+
+    def test_lazy_runtime_import(self):
+        # The docker runtime shouldn't be imported for shifter jobs
+        code = ("import sys; from JobRunner.MethodRunner import MethodRunner;"
+                "MethodRunner({'token': 'bogus', 'runtime': 'shifter'}, "
+                "'1234'); print('JobRunner.DockerRunner' in sys.modules,"
+                "'docker' in sys.modules)")
+        out = check_output([sys.executable, '-c', code]).decode().split()
+        self.assertEqual(out, ['False', 'False'])
+
+    def test_output_checks(self):
+        cfg = deepcopy(self.cfg)
+        cfg['max_output_size'] = 100
+        mr = MethodRunner(cfg, '1234', logger=MockLogger())
+        mr.subjobdir = '/tmp/mr/subjobs'
+        jd = os.path.join(mr.subjobdir, 'sub1')
+        if not os.path.exists(jd):
+            os.makedirs(jd)
+        of = os.path.join(jd, 'output.json')
+        with open(of, 'w') as f:
+            f.write('{"version": "1.1", "result": [1]}')
+        (ref, err) = mr.get_output_ref('sub1')
+        self.assertIsNone(err)
+        self.assertEqual(ref['path'], of)
+        self.assertEqual(ref['keys'], ['version', 'result'])
+        self.assertEqual(mr.get_output('sub1')['result'], [1])
+        for bad in ['[1, 2]', '{"result": bogus}']:
+            with open(of, 'w') as f:
+                f.write(bad)
+            (ref, err) = mr.get_output_ref('sub1')
+            self.assertEqual(err['error']['name'], 'Malformed output')
+            self.assertEqual(mr.get_output('sub1')['error']['name'],
+                             'Malformed output')
+        with open(of, 'w') as f:
+            f.write('{"result": ["%s"]}' % ('x' * 100))
+        (ref, err) = mr.get_output_ref('sub1')
+        self.assertEqual(err['error']['name'], 'Output too large')
+        self.assertEqual(mr.get_output('sub1')['error']['name'],
+                         'Output too large')
+
+    def test_warm_pool(self):
+        cfg = deepcopy(self.cfg)
+        cfg['workdir'] = mkdtemp()
+        cfg['warm_pool'] = 2
+        mr = MethodRunner(cfg, '1234', logger=MockLogger())
+        mr.runner.docker = MagicMock()
+        mr.runner.get_image = MagicMock(return_value='id')
+        # Subjobs normally run after the main job made the subjob dir
+        mr.subjobdir = os.path.join(cfg['workdir'], 'subjobs')
+        os.mkdir(mr.subjobdir)
+        module_info = deepcopy(CATALOG_GET_MODULE_VERSION)
+        module_info['docker_img_name'] = 'mock_app:latest'
+        params = deepcopy(NJS_JOB_PARAMS[0])
+        q = Queue()
+
+        def _wait_pool(size):
+            for i in range(50):
+                if sum(len(p) for p in mr.runner.pool.values()) == size:
+                    return
+                sleep(0.1)
+            self.fail('Pool never filled')
+
+        # The first launch makes one warm container for the next one
+        mr.run(self.conf, module_info, params, 'sub1', fin_q=q,
+               callback='http://cb/sub1', subjob=True)
+        _wait_pool(1)
+        create = mr.runner.docker.containers.create
+        self.assertEqual(create.call_args[1]['environment'],
+                         {'SDK_CALLBACK_URL': 'http://cb/warm-1'})
+        labels = create.call_args[1]['labels']
+        self.assertEqual(labels['parent_job_id'], '1234')
+        self.assertEqual(labels['job_id'], 'warm-1')
+        # Another method of the image may use it
+        self.assertNotIn('app_id', labels)
+        warm = create.return_value
+        warm.start.reset_mock()
+        # The next subjob runs in the warm container's slot
+        mr.run(self.conf, module_info, params, 'sub2', fin_q=q,
+               callback='http://cb/sub2', subjob=True)
+        warm.start.assert_called_with()
+        job_dir = mr._get_job_dir('sub2', subjob=True)
+        self.assertEqual(os.path.basename(job_dir), 'warm-1')
+        self.assertTrue(os.path.exists(os.path.join(job_dir, 'input.json')))
+        self.assertEqual(mr.slot_jobs['warm-1'], 'sub2')
+        # Two launches in the last minute keep two warm containers
+        _wait_pool(2)
+        mr.drain_pool()
+        self.assertEqual(mr.runner.pool, {})
+        self.assertFalse(os.path.exists(os.path.join(mr.subjobdir,
+                                                     'warm-2')))
+
+    def test_cleanup_all(self):
+        mr = MethodRunner(self.cfg, '1234', logger=MockLogger())
+        mr.runner = MagicMock()
+
+        def _remove(c, grace):
+            if c == 'stuck':
+                sleep(2)
+            elif c == 'bad':
+                raise OSError('Failed')
+            return c == 'running'
+
+        mr.runner.remove.side_effect = _remove
+        mr.containers = ['running'] * 20 + ['done', 'bad', 'stuck']
+        start = time()
+        report = mr.cleanup_all(grace=1, deadline=0.5)
+        # They are stopped in parallel and the deadline is kept
+        self.assertLess(time() - start, 1.5)
+        self.assertEqual(report, {'removed': 20, 'gone': 1, 'failed': 1,
+                                  'pending': 1})
+        mr.runner.remove.assert_called_with('stuck', 1)
+
+    def test_shared_scratch(self):
+        cfg = deepcopy(self.cfg)
+        cfg['workdir'] = mkdtemp()
+        cfg['shared_scratch'] = 'true'
+        mr = MethodRunner(cfg, '1234', logger=MockLogger())
+        mr.runner.docker = MagicMock()
+        mr.runner.get_image = MagicMock(return_value='id')
+        mr.subjobdir = os.path.join(cfg['workdir'], 'subjobs')
+        os.mkdir(mr.subjobdir)
+        module_info = deepcopy(CATALOG_GET_MODULE_VERSION)
+        module_info['docker_img_name'] = 'mock_app:latest'
+        params = deepcopy(NJS_JOB_PARAMS[0])
+        q = Queue()
+        shared = os.path.join(cfg['workdir'], 'shared')
+        for (job_id, subjob) in [('1234', False), ('sub1', True)]:
+            mr.run(self.conf, module_info, params, job_id, fin_q=q,
+                   callback='http://cb/' + job_id, subjob=subjob)
+            vols = mr.runner.docker.containers.create.call_args[1]['volumes']
+            self.assertEqual(vols[shared], {'bind': '/kb/module/work/shared',
+                                            'mode': 'rw'})
+        self.assertTrue(os.path.isdir(shared))
+        mr.cleanup_all()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import unittest
+from tempfile import mkdtemp
+
+from JobRunner.output import scan_output
+
+
+class OutputTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = mkdtemp()
+
+    def _write(self, data):
+        path = os.path.join(self.dir, 'output.json')
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def test_scan(self):
+        out = {'version': '1.1', 'result': [{'a': 'x"}', 'b': [1, {}]}],
+               'id': '1'}
+        info = scan_output(self._write(json.dumps(out)))
+        self.assertEqual(info['keys'], ['version', 'result', 'id'])
+        self.assertFalse(info['empty'])
+        self.assertEqual(info['size'], len(json.dumps(out)))
+        info = scan_output(self._write(' {}\n'))
+        self.assertTrue(info['empty'])
+
+    def test_chunks(self):
+        # Strings, escapes and multibyte characters across chunk edges
+        out = {'a\\"b': ['x"\\y', {'k': [1, 2, '}]']}], 'error': None,
+               'z': u'é' * 10}
+        path = self._write(json.dumps(out, ensure_ascii=False))
+        info = scan_output(path)
+        self.assertEqual(info['keys'][1:], ['error', 'z'])
+        for size in range(1, 40):
+            self.assertEqual(scan_output(path, chunk_size=size), info)
+
+    def test_bad(self):
+        for data in ['[1]', '"x"', '', '{"a": 1', '{"a": [1}', '{} {}',
+                     '{"a": "b', '{"result": bogus}', '{"a": 01}',
+                     '{"a": [1, 2,]}', '{"a" 1}', '{,}', '{"a": 1,}',
+                     '{"a": {"b": 1 "c": 2}}', '{"a": "\\q"}',
+                     '{"a": "\x01"}', '{"a": [tru]}', '{1: 2}']:
+            with self.assertRaises(ValueError):
+                scan_output(self._write(data))
+
+    def test_values(self):
+        # Everything json.load reads is accepted, in any chunk size
+        out = {'n': [0, -1.5e3, 2E-2, True, False, None, float('nan'),
+                     float('-inf')],
+               'o': {'a': 'x', 'b': ['\u2603', '\\', {}], 'c': []},
+               's': ['a' * 50, '\t\n']}
+        path = self._write(json.dumps(out))
+        for size in [1, 2, 3, 7, 1024]:
+            info = scan_output(path, chunk_size=size)
+            self.assertEqual(info['keys'], ['n', 'o', 's'])
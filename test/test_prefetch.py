@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest.mock import patch
+from mock import MagicMock
+
+from JobRunner.prefetch import prefetch_images
+
+
+class PrefetchTest(unittest.TestCase):
+
+    @patch('JobRunner.prefetch.Catalog', autospec=True)
+    def test_prefetch(self, mock_cat):
+        catalog = mock_cat.return_value
+
+        def _get(req):
+            if req['module_name'] == 'bogus':
+                raise ValueError('No module')
+            return {'docker_img_name': 'img/%s:%s' %
+                    (req['module_name'], req.get('version', 'latest'))}
+
+        catalog.get_module_version.side_effect = _get
+        runner = MagicMock()
+        modules = ['mock_app', 'RunTester:beta', 'bogus']
+        failed = prefetch_images('http://catalog', modules, runner=runner)
+        self.assertEqual(failed, ['bogus'])
+        mock_cat.assert_called_with('http://catalog')
+        images = [c[0][0] for c in runner.get_image.call_args_list]
+        self.assertEqual(images, ['img/mock_app:latest',
+                                  'img/RunTester:beta'])
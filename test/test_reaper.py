@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+from tempfile import mkdtemp
+from mock import MagicMock
+
+from JobRunner.reaper import hold_lock, release_lock, reap_orphans
+
+
+def _container(job_id, parent=''):
+    c = MagicMock()
+    c.labels = {'job_id': job_id, 'parent_job_id': parent}
+    return c
+
+
+class ReaperTest(unittest.TestCase):
+
+    def test_lock(self):
+        lock_dir = os.path.join(mkdtemp(), 'locks')
+        f = hold_lock('1234', lock_dir=lock_dir)
+        with self.assertRaises(BlockingIOError):
+            hold_lock('1234', lock_dir=lock_dir)
+        release_lock(f)
+        self.assertEqual(os.listdir(lock_dir), [])
+
+    def test_reap(self):
+        lock_dir = mkdtemp()
+        lock = hold_lock('alive', lock_dir=lock_dir)
+        # A runner that died leaves its lock file unlocked
+        dead = hold_lock('dead', lock_dir=lock_dir)
+        dead.close()
+        cs = [_container('alive'), _container('sub1', 'alive'),
+              _container('dead'), _container('sub2', 'dead'),
+              _container('gone')]
+        client = MagicMock()
+        client.containers.list.return_value = cs
+        self.assertEqual(reap_orphans(client, lock_dir=lock_dir), ['dead'])
+        client.containers.list.assert_called_once_with(
+            all=True, filters={'label': 'job_id'})
+        for c in cs[:2] + cs[4:]:
+            c.remove.assert_not_called()
+        for c in cs[2:4]:
+            c.remove.assert_called_once_with(force=True)
+        # A job without a lock file may have a runner that doesn't use
+        # this lock directory, so it is left alone
+        self.assertEqual(os.listdir(lock_dir), ['alive.lock'])
+        release_lock(lock)
+
+    def test_reap_grace(self):
+        lock_dir = mkdtemp()
+        dead = hold_lock('dead', lock_dir=lock_dir, grace=600)
+        dead.close()
+        cs = [_container('dead'), _container('gone')]
+        client = MagicMock()
+        client.containers.list.return_value = cs
+        # A resumable runner that died recently may still be resumed,
+        # whatever the reaper's own config
+        self.assertEqual(reap_orphans(client, lock_dir=lock_dir), [])
+        cs[0].remove.assert_not_called()
+        os.utime(os.path.join(lock_dir, 'dead.lock'), (0, 0))
+        self.assertEqual(reap_orphans(client, lock_dir=lock_dir), ['dead'])
+        cs[0].remove.assert_called_once_with(force=True)
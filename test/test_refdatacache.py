@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import fcntl
+import os
+import unittest
+from threading import Thread
+from tempfile import mkdtemp
+from mock import MagicMock
+
+from JobRunner.RefDataCache import RefDataCache
+
+
+class RefDataCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.refbase = mkdtemp()
+        self.local = mkdtemp()
+        for version in ['1', '2', '3']:
+            d = os.path.join(self.refbase, 'db', version)
+            os.makedirs(os.path.join(d, 'index'))
+            with open(os.path.join(d, 'index', 'data'), 'w') as f:
+                f.write('x' * 40)
+
+    def test_shared(self):
+        rd = RefDataCache(self.refbase, logger=MagicMock())
+        self.assertEqual(rd.get('db', '1'),
+                         os.path.join(self.refbase, 'db', '1'))
+        # Missing data is still mounted but logged
+        self.assertEqual(rd.get('db', '9'),
+                         os.path.join(self.refbase, 'db', '9'))
+        rd.logger.error.assert_called_once()
+
+    def test_stage(self):
+        rd = RefDataCache(self.refbase, local_dir=self.local, max_size=100)
+        path = rd.get('db', '1')
+        self.assertEqual(path, os.path.join(self.local, 'db', '1'))
+        with open(os.path.join(path, 'index', 'data')) as f:
+            self.assertEqual(f.read(), 'x' * 40)
+        # Another job uses the same copy
+        rd2 = RefDataCache(self.refbase, local_dir=self.local, max_size=100)
+        self.assertEqual(rd2.get('db', '1'), path)
+        # Too big to ever stage
+        rd.max_size = 10
+        self.assertEqual(rd.get('db', '2'),
+                         os.path.join(self.refbase, 'db', '2'))
+
+    def test_evict(self):
+        rd = RefDataCache(self.refbase, local_dir=self.local, max_size=100)
+        rd.get('db', '1')
+        rd.get('db', '2')
+        os.utime(os.path.join(self.local, 'db', '1'), (0, 0))
+        # Both are in use, so the limit is exceeded for now
+        rd.get('db', '3')
+        names = os.listdir(os.path.join(self.local, 'db'))
+        self.assertEqual(sorted(n for n in names if '.staging' not in n),
+                         ['1', '1.lock', '2', '2.lock', '3', '3.lock'])
+        rd.release()
+        rd.get('db', '3')
+        self.assertEqual(rd.evict(), [os.path.join(self.local, 'db', '1')])
+        self.assertFalse(os.path.exists(os.path.join(self.local, 'db', '1')))
+
+    def test_staging(self):
+        rd = RefDataCache(self.refbase, local_dir=self.local, max_size=100)
+        path = rd.get('db', '1')
+        # Another job is copying version 2
+        staging = open(os.path.join(self.local, 'db', '2.staging'), 'a')
+        fcntl.flock(staging, fcntl.LOCK_EX)
+        staging.write('40')
+        staging.flush()
+        lock = open(os.path.join(self.local, '.staging.lock'), 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        # A staged version is used without waiting for either copy
+        rd2 = RefDataCache(self.refbase, local_dir=self.local, max_size=100)
+        t = Thread(target=rd2.get, args=('db', '1'))
+        t.start()
+        t.join(5)
+        self.assertFalse(t.is_alive())
+        self.assertIn(('db', '1'), rd2.held)
+        lock.close()
+        # The copy in progress counts towards the size limit
+        rd.release()
+        rd2.release()
+        rd.get('db', '3')
+        self.assertFalse(os.path.exists(path))
+        staging.close()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+from tempfile import mkdtemp
+
+from JobRunner.ResultCache import ResultCache
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = os.path.join(mkdtemp(), 'results')
+        self.rc = ResultCache('mock_app, other', cache_dir=self.cache_dir,
+                              max_size=100)
+
+    def _output(self, size):
+        path = os.path.join(mkdtemp(), 'output.json')
+        with open(path, 'w') as f:
+            f.write('{"result": ["%s"]}' % ('x' * (size - 16)))
+        return path
+
+    def test_key(self):
+        self.assertTrue(self.rc.allows('other'))
+        self.assertFalse(self.rc.allows('bogus'))
+        key = self.rc.key('abc', 'mock_app.bogus', 'user', [{'a': 1, 'b': 2}])
+        # Key order doesn't matter but everything else does
+        self.assertEqual(key, self.rc.key('abc', 'mock_app.bogus', 'user',
+                                          [{'b': 2, 'a': 1}]))
+        self.assertNotEqual(key, self.rc.key('abd', 'mock_app.bogus',
+                                             'user', [{'a': 1, 'b': 2}]))
+        self.assertNotEqual(key, self.rc.key('abc', 'mock_app.bogus',
+                                             'other', [{'a': 1, 'b': 2}]))
+
+    def test_put_get(self):
+        self.assertIsNone(self.rc.get('a'))
+        self.assertTrue(self.rc.put('a', self._output(40)))
+        with open(self.rc.get('a')) as f:
+            self.assertEqual(len(f.read()), 40)
+        # Too big to ever cache
+        self.assertFalse(self.rc.put('b', self._output(200)))
+        self.assertIsNone(self.rc.get('b'))
+        # Only the runner's user can read the outputs
+        self.assertEqual(os.stat(self.cache_dir).st_mode & 0o777, 0o700)
+        self.assertEqual(os.stat(self.rc.get('a')).st_mode & 0o777, 0o600)
+        # A job gets its own link to an output
+        dest = os.path.join(mkdtemp(), 'sub1', 'output.json')
+        self.assertEqual(self.rc.get('a', dest), dest)
+        os.unlink(self.rc.get('a'))
+        with open(dest) as f:
+            self.assertEqual(len(f.read()), 40)
+        self.assertIsNone(self.rc.get('a', dest))
+
+    def test_evict(self):
+        self.rc.max_size = 130
+        for (i, key) in enumerate(['a', 'b', 'c']):
+            self.rc.put(key, self._output(40))
+            os.utime(self.rc._path(key), (i, i))
+        # Using a result keeps it around
+        self.rc.get('a')
+        self.rc.put('d', self._output(40))
+        self.assertIsNotNone(self.rc.get('a'))
+        self.assertIsNone(self.rc.get('b'))
+        self.assertIsNotNone(self.rc.get('c'))
+        self.assertIsNotNone(self.rc.get('d'))
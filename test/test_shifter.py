@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
 import unittest
+from subprocess import Popen, PIPE
 
 from JobRunner.ShifterRunner import ShifterRunner
+from JobRunner.usage import Usage
 from nose.plugins.attrib import attr
 from queue import Queue
+from tempfile import mkdtemp
 from time import sleep
 
 
@@ -51,3 +55,78 @@ class CatalogCacheTest(unittest.TestCase):
         self.assertEquals(result[0], 'finished')
         self.assertEquals(len(result), 3)
         self.assertIn('line', self.logger.all[0])
+        self.assertNotIn('FOO', os.environ)
+        usage = self.sr.usage['mock_app:latest'].summary()
+        self.assertGreater(usage['wall_seconds'], 1)
+        self.assertGreater(usage['samples'], 0)
+
+    def test_get_image_pull(self):
+        # A fake shifterimg that only finds the image after a pull
+        d = mkdtemp()
+        cmd = os.path.join(d, 'shifterimg')
+        with open(cmd, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'if [ "$1" = "lookup" ]; then\n'
+                    '  [ -f %s/pulled ] && echo abc123\n'
+                    '  exit 0\n'
+                    'fi\n'
+                    'echo $2 >> %s/pulls\n'
+                    'printf "PULLING\\rPULLING\\rREADY\\n"\n'
+                    'touch %s/pulled\n' % (d, d, d))
+        os.chmod(cmd, 0o755)
+        logger = MockLogger()
+        cache = os.path.join(d, 'images.json')
+        sr = ShifterRunner(logger=logger, node_cache=cache)
+        sr.shifterimg = cmd
+        self.assertEqual(sr.get_image('mock_app:latest'), 'abc123')
+        self.assertEqual(logger.lines, ['Pulling image mock_app:latest',
+                                        'Pull of mock_app:latest: PULLING',
+                                        'Pull of mock_app:latest: READY'])
+        with open(os.path.join(d, 'pulls')) as f:
+            self.assertEqual(f.read(), 'mock_app:latest\n')
+        # Other runners on the node use the cached lookup
+        sr = ShifterRunner(logger=logger, node_cache=cache)
+        sr.shifterimg = '/bin/false'
+        self.assertEqual(sr.get_image('mock_app:latest'), 'abc123')
+        # Images that can't be pulled give no id
+        sr.pull_timeout = 0
+        self.assertIsNone(sr.get_image('bogus:latest'))
+        self.assertIn('Failed to pull image bogus:latest', logger.errors)
+
+    def test_readio(self):
+        logger = MockLogger()
+        sr = ShifterRunner(logger=logger)
+        batches = []
+
+        def _log_lines(lines):
+            # Logging goes to NJS, so it is slow
+            batches.append(lines)
+            sleep(0.01)
+
+        logger.log_lines = _log_lines
+        code = ("import sys\n"
+                "for i in range(20000):\n"
+                "    print('line %d' % i)\n"
+                "sys.stderr.write('an error\\nno newline')\n")
+        p = Popen([sys.executable, '-c', code], stdout=PIPE, stderr=PIPE)
+        sr.usage['job'] = Usage()
+        q = Queue()
+        sr._readio(p, 'job', [q])
+        self.assertEqual(q.get(timeout=1), ['finished', 'job', None])
+        lines = [line for batch in batches for line in batch]
+        out = [line['line'] for line in lines if not line['is_error']]
+        err = [line['line'] for line in lines if line['is_error']]
+        self.assertEqual(out, ['line %d' % i for i in range(20000)])
+        self.assertEqual(err, ['an error', 'no newline'])
+        # Lines are logged in batches
+        self.assertLess(len(batches), 200)
+
+    def test_remove(self):
+        sr = ShifterRunner(logger=MockLogger())
+        # A job that ignores SIGTERM is killed after the grace period
+        p = Popen(['sh', '-c', 'trap "" TERM; sleep 30 & wait'],
+                  start_new_session=True)
+        sleep(0.2)
+        self.assertTrue(sr.remove(p, grace=0.5))
+        self.assertIsNotNone(p.poll())
+        self.assertFalse(sr.remove(p, grace=0.5))
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from JobRunner.SubjobScheduler import SubjobScheduler
+
+
+class SubjobSchedulerTest(unittest.TestCase):
+
+    def test_unlimited(self):
+        s = SubjobScheduler(root='main')
+        for i in range(5):
+            s.add('j%d' % (i), 'main', {})
+        started = [s.next() for i in range(5)]
+        self.assertNotIn(None, started)
+        self.assertEqual(s.next(), None)
+
+    def test_max_jobs(self):
+        s = SubjobScheduler(max_jobs=2, root='main')
+        for i in range(4):
+            s.add('j%d' % (i), 'main', {'i': i})
+        self.assertEqual(s.next(), ('j0', {'i': 0}))
+        self.assertEqual(s.next(), ('j1', {'i': 1}))
+        self.assertIsNone(s.next())
+        self.assertTrue(s.is_queued('j2'))
+        s.finished('j0')
+        self.assertEqual(s.next()[0], 'j2')
+        self.assertFalse(s.is_queued('j2'))
+        self.assertEqual(s.clear(), ['j3'])
+        self.assertIsNone(s.next())
+
+    def test_resources(self):
+        s = SubjobScheduler(max_cpus=4, max_memory=1000, root='main')
+        s.add('big', 'main', {}, cpus=3, memory=100)
+        s.add('wide', 'main', {}, cpus=2, memory=100)
+        s.add('small', 'other', {}, cpus=1, memory=100)
+        self.assertEqual(s.next()[0], 'big')
+        # wide doesn't fit next to big, but small from another parent can
+        # be backfilled
+        self.assertEqual(s.next()[0], 'small')
+        self.assertIsNone(s.next())
+        s.finished('big')
+        self.assertEqual(s.next()[0], 'wide')
+        s.add('fat', 'main', {}, memory=1000)
+        self.assertIsNone(s.next())
+
+    def test_oversized(self):
+        s = SubjobScheduler(max_memory=100, root='main')
+        s.add('huge', 'main', {}, memory=1000)
+        # Nothing else is running so it is allowed to start
+        self.assertEqual(s.next()[0], 'huge')
+
+    def test_fair_by_parent(self):
+        s = SubjobScheduler(max_jobs=3, root='main')
+        s.add('a', 'main', {})
+        s.add('b', 'main', {})
+        self.assertEqual(s.next()[0], 'a')
+        self.assertEqual(s.next()[0], 'b')
+        for i in range(3):
+            s.add('a%d' % (i), 'a', {})
+            s.add('b%d' % (i), 'b', {})
+        # a and b wait on their subjobs, which get all three slots
+        self.assertEqual(s.next()[0], 'a0')
+        self.assertEqual(s.next()[0], 'b0')
+        self.assertEqual(s.next()[0], 'a1')
+        self.assertIsNone(s.next())
+        s.finished('b0')
+        # b has fewer running subjobs than a now
+        self.assertEqual(s.next()[0], 'b1')
+        s.finished('a0')
+        self.assertEqual(s.next()[0], 'a2')
+
+    def test_depth_first(self):
+        s = SubjobScheduler(max_jobs=1, root='main')
+        s.add('a', 'main', {})
+        s.add('b', 'main', {})
+        self.assertEqual(s.next()[0], 'a')
+        s.add('a0', 'a', {})
+        # Children of a started subjob run before its queued siblings
+        self.assertEqual(s.next()[0], 'a0')
+
+    def test_waiting_parent(self):
+        s = SubjobScheduler(max_jobs=1, max_cpus=2, root='main')
+        s.add('a', 'main', {}, cpus=2)
+        s.add('b', 'main', {})
+        self.assertEqual(s.next()[0], 'a')
+        # a keeps running while it waits on its own subjob, so it
+        # doesn't hold the slot or CPUs its subjob needs
+        s.add('a0', 'a', {}, cpus=2)
+        self.assertEqual(s.next()[0], 'a0')
+        self.assertIsNone(s.next())
+        # Once its subjob is done a counts again
+        s.finished('a0')
+        self.assertIsNone(s.next())
+        s.finished('a')
+        self.assertEqual(s.next()[0], 'b')
+
+    def test_started(self):
+        s = SubjobScheduler(max_cpus=4, root='main')
+        # A subjob picked up from a runner that died holds its resources
+        s.started('a', 'main', cpus=3)
+        s.add('b', 'main', {}, cpus=2)
+        self.assertIsNone(s.next())
+        s.finished('a')
+        self.assertEqual(s.next()[0], 'b')
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+
+from JobRunner.usage import Usage, docker_stats_usage, proc_tree_usage
+
+_STATS = {
+    'cpu_stats': {'cpu_usage': {'total_usage': 2500000000}},
+    'memory_stats': {'usage': 1000, 'max_usage': 4096},
+    'blkio_stats': {'io_service_bytes_recursive': [
+        {'major': 8, 'minor': 0, 'op': 'Read', 'value': 100},
+        {'major': 8, 'minor': 0, 'op': 'Write', 'value': 50},
+        {'major': 8, 'minor': 0, 'op': 'Total', 'value': 150}
+    ]}
+}
+
+
+class UsageTest(unittest.TestCase):
+
+    def test_usage(self):
+        u = Usage()
+        u.update(cpu_seconds=1.0, rss=100, read_bytes=10, write_bytes=5)
+        u.update(cpu_seconds=3.0, rss=50, read_bytes=20, write_bytes=5)
+        u.finish()
+        s = u.summary()
+        self.assertEqual(s['cpu_seconds'], 3.0)
+        self.assertEqual(s['max_rss_bytes'], 100)
+        self.assertEqual(s['blkio_read_bytes'], 20)
+        self.assertEqual(s['blkio_write_bytes'], 5)
+        self.assertEqual(s['samples'], 2)
+        self.assertGreaterEqual(s['wall_seconds'], 0)
+
+    def test_docker_stats(self):
+        out = docker_stats_usage(_STATS)
+        self.assertEqual(out, {'cpu_seconds': 2.5, 'rss': 4096,
+                               'read_bytes': 100, 'write_bytes': 50})
+        # Stats from a stopped container are mostly empty
+        out = docker_stats_usage({'blkio_stats': {}})
+        self.assertEqual(out['rss'], 0)
+
+    def test_proc_tree(self):
+        out = proc_tree_usage(os.getpid())
+        self.assertGreater(out['cpu_seconds'], 0)
+        self.assertGreater(out['rss'], 0)
+        out = proc_tree_usage(999999999)
+        self.assertEqual(out['rss'], 0)